@@ -0,0 +1,428 @@
+import copy
+import os
+import resource
+import time
+
+import click
+import torch
+from omegaconf import OmegaConf
+
+from models.diffusion import SuperResModel, UNetModel
+from models.quantization import quantize_int8
+from models.vae import VAE, Decoder
+
+
+def __parse_str(s):
+    split = s.split(",")
+    return [int(s) for s in split if s != "" and s is not None]
+
+
+def peak_memory_mb(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # NOTE: On CPU this is the peak RSS of the process, which never decreases
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def time_train_steps(model, batch_fn, device, n_steps=10, n_warmup=2):
+    """
+    Returns the mean time (in seconds) of an optimizer step of the model on the
+    batches from batch_fn, along with the peak memory (in MB) used during it.
+    """
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    model.train()
+    for step in range(n_warmup + n_steps):
+        if step == n_warmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+                torch.cuda.reset_peak_memory_stats(device)
+            start = time.perf_counter()
+        optimizer.zero_grad(set_to_none=True)
+        loss = model(*batch_fn()).square().mean()
+        loss.backward()
+        optimizer.step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / n_steps, peak_memory_mb(device)
+
+
+def time_inference(fn, device, n_iters=10, n_warmup=2):
+    """
+    Returns the mean time (in seconds) of a call of fn without autograd.
+    """
+    with torch.no_grad():
+        for it in range(n_warmup + n_iters):
+            if it == n_warmup:
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+            fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / n_iters
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--image-size", default=256)
+@click.option("--batch-size", default=8)
+@click.option("--dim", default=128)
+@click.option("--dim-mults", default="1,1,2,2,4,4")
+@click.option("--attn-resolutions", default="16,")
+@click.option("--n-residual", default=2)
+@click.option("--dropout", default=0.1)
+@click.option("--n-steps", default=10)
+@click.option("--device", default="cuda")
+@click.option(
+    "--only", default=None, help="Only run one setting (none, all or e.g. 1,2)"
+)
+def ddpm_checkpointing(
+    image_size=256,
+    batch_size=8,
+    dim=128,
+    dim_mults="1,1,2,2,4,4",
+    attn_resolutions="16,",
+    n_residual=2,
+    dropout=0.1,
+    n_steps=10,
+    device="cuda",
+    only=None,
+):
+    # Compares the step time and peak memory of a DDPM decoder training step
+    # without checkpointing, when checkpointing the 1, 2, ... highest resolution
+    # levels (i.e. checkpoint_resolutions=1, then 1,2, and so on) and when
+    # checkpointing every level.
+    # NOTE: On CPU, run each setting in a separate process (see --only) as the
+    # peak RSS reported is the one of the whole process.
+    device = torch.device(device)
+    dim_mults = __parse_str(dim_mults)
+    resolutions = [2**level for level in range(len(dim_mults))]
+    settings = [("none", False)]
+    settings += [
+        (",".join(map(str, resolutions[: i + 1])), resolutions[: i + 1])
+        for i in range(len(resolutions) - 1)
+    ]
+    settings += [("all", True)]
+    if only is not None:
+        settings = [(name, flag) for name, flag in settings if name == only]
+
+    def batch_fn():
+        x = torch.randn(batch_size, 3, image_size, image_size, device=device)
+        t = torch.randint(0, 1000, (batch_size,), device=device)
+        return x, t
+
+    for name, use_checkpoint in settings:
+        torch.manual_seed(0)
+        model = UNetModel(
+            in_channels=3,
+            model_channels=dim,
+            out_channels=3,
+            num_res_blocks=n_residual,
+            attention_resolutions=__parse_str(attn_resolutions),
+            channel_mult=dim_mults,
+            dropout=dropout,
+            use_checkpoint=use_checkpoint,
+        ).to(device)
+        try:
+            step_time, peak_mem = time_train_steps(
+                model, batch_fn, device, n_steps=n_steps
+            )
+            print(
+                f"checkpoint_resolutions={name}: {step_time * 1000:.1f} ms/step, "
+                f"peak memory {peak_mem:.0f} MB"
+            )
+        except RuntimeError as e:
+            # Most likely out of memory
+            print(f"checkpoint_resolutions={name}: failed ({e})")
+        del model
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+
+@cli.command()
+@click.option("--image-size", default=32)
+@click.option("--batch-size", default=64)
+@click.option("--dim-mults", default="1,2,2,2")
+@click.option("--attn-resolutions", default="16,")
+@click.option("--n-heads", default=1)
+@click.option("--dim", default=128)
+@click.option("--n-residual", default=2)
+@click.option("--student-dim", default=64)
+@click.option("--student-n-residual", default=1)
+@click.option("--student-dim-mults", default=None)
+@click.option("--n-iters", default=10)
+@click.option("--device", default="cuda")
+def decoder_throughput(
+    image_size=32,
+    batch_size=64,
+    dim_mults="1,2,2,2",
+    attn_resolutions="16,",
+    n_heads=1,
+    dim=128,
+    n_residual=2,
+    student_dim=64,
+    student_n_residual=1,
+    student_dim_mults=None,
+    n_iters=10,
+    device="cuda",
+):
+    # Compares the number of images a (conditional) teacher and a distilled
+    # student decoder denoise per second, i.e. per sampling step
+    device = torch.device(device)
+    if student_dim_mults is None:
+        student_dim_mults = dim_mults
+
+    x = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    t = torch.randint(0, 1000, (batch_size,), device=device)
+    for name, model_dim, model_n_residual, model_dim_mults in [
+        ("teacher", dim, n_residual, dim_mults),
+        ("student", student_dim, student_n_residual, student_dim_mults),
+    ]:
+        model = SuperResModel(
+            in_channels=3,
+            model_channels=model_dim,
+            out_channels=3,
+            num_res_blocks=model_n_residual,
+            attention_resolutions=__parse_str(attn_resolutions),
+            channel_mult=__parse_str(model_dim_mults),
+            num_heads=n_heads,
+        ).to(device)
+        model.eval()
+        n_params = sum(p.numel() for p in model.parameters())
+        step_time = time_inference(
+            lambda: model(x, t, low_res=x), device, n_iters=n_iters
+        )
+        print(
+            f"{name}: {n_params / 1e6:.1f}M params, "
+            f"{batch_size / step_time:.1f} images/s per sampling step"
+        )
+
+
+@cli.command()
+@click.option("--image-size", default=32)
+@click.option("--batch-size", default=16)
+@click.option("--dim", default=128)
+@click.option("--dim-mults", default="1,2,2,2")
+@click.option("--attn-resolutions", default="16,")
+@click.option("--n-residual", default=2)
+@click.option("--n-heads", default=8)
+@click.option(
+    "--dec-block-config",
+    default="1x1,1u4,1t4,4x2,4u2,4t8,8x3,8u2,8t16,16x7,16u2,16t32,32x15",
+)
+@click.option("--dec-channel-config", default="32:64,16:128,8:256,4:256,1:512")
+@click.option("--z-dim", default=512)
+@click.option("--n-calib-batches", default=4)
+@click.option("--n-iters", default=10)
+def int8_latency(
+    image_size=32,
+    batch_size=16,
+    dim=128,
+    dim_mults="1,2,2,2",
+    attn_resolutions="16,",
+    n_residual=2,
+    n_heads=8,
+    dec_block_config="1x1,1u4,1t4,4x2,4u2,4t8,8x3,8u2,8t16,16x7,16u2,16t32,32x15",
+    dec_channel_config="32:64,16:128,8:256,4:256,1:512",
+    z_dim=512,
+    n_calib_batches=4,
+    n_iters=10,
+):
+    # Compares the CPU latency of the (conditional) DDPM decoder and the VAE
+    # decoder in float32 and int8, along with the relative error of the int8
+    # outputs. The models are randomly initialized and calibrated on random
+    # inputs, see scripts/quantize_ddpm.sh for the FID drift of trained models.
+    device = torch.device("cpu")
+    torch.manual_seed(0)
+    unet = SuperResModel(
+        in_channels=3,
+        model_channels=dim,
+        out_channels=3,
+        num_res_blocks=n_residual,
+        attention_resolutions=__parse_str(attn_resolutions),
+        channel_mult=__parse_str(dim_mults),
+        num_heads=n_heads,
+    )
+    for p in unet.out.parameters():
+        # The output layer is zero-initialized
+        torch.nn.init.normal_(p, std=0.02)
+    vae_dec = Decoder(image_size, dec_block_config, dec_channel_config)
+
+    def unet_inputs():
+        x = torch.randn(batch_size, 3, image_size, image_size)
+        t = torch.randint(0, 1000, (batch_size,))
+        return (x, t), {"low_res": torch.rand_like(x) * 2 - 1}
+
+    def vae_inputs():
+        return (torch.randn(batch_size, z_dim, 1, 1),), {}
+
+    for name, model, input_fn in [
+        ("ddpm decoder", unet, unet_inputs),
+        ("vae decoder", vae_dec, vae_inputs),
+    ]:
+        model.eval()
+        args, kwargs = input_fn()
+        calib_inputs = [input_fn() for _ in range(n_calib_batches)]
+        with torch.no_grad():
+            expected = model(*args, **kwargs)
+
+        for mode in [None, "dynamic", "static"]:
+            qmodel = model
+            if mode is not None:
+                qmodel = copy.deepcopy(model)
+                quantize_int8(
+                    qmodel,
+                    lambda: [qmodel(*a, **kw) for a, kw in calib_inputs],
+                    mode=mode,
+                )
+            latency = time_inference(
+                lambda: qmodel(*args, **kwargs), device, n_iters=n_iters
+            )
+            with torch.no_grad():
+                error = (qmodel(*args, **kwargs) - expected).norm() / expected.norm()
+            print(
+                f"{name} ({mode or 'float32'}): {latency * 1000:.1f} ms/batch, "
+                f"relative error {error:.4f}"
+            )
+
+
+@cli.command()
+@click.option("--image-size", default=256)
+@click.option("--batch-size", default=8)
+@click.option(
+    "--enc-block-config",
+    default="256x3,256d2,256t128,128x3,128d2,128t64,64x5,64d2,64t32,32x7,32d2,32t16,16x9,16d2,16t8,8x7,8d2,8t4,4x5,4d4,4t1,1x2",
+)
+@click.option(
+    "--enc-channel-config",
+    default="256:64,128:64,64:64,32:128,16:128,8:256,4:512,1:1024",
+)
+@click.option(
+    "--dec-block-config",
+    default="1x2,1u4,1t4,4x4,4u2,4t8,8x6,8u2,8t16,16x8,16u2,16t32,32x5,32u2,32t64,64x4,64u2,64t128,128x2,128u2,128t256,256x2",
+)
+@click.option(
+    "--dec-channel-config",
+    default="256:64,128:64,64:64,32:128,16:128,8:256,4:512,1:1024",
+)
+@click.option("--n-iters", default=10)
+@click.option("--device", default="cuda")
+def vae_fused(
+    image_size=256,
+    batch_size=8,
+    enc_block_config="256x3,256d2,256t128,128x3,128d2,128t64,64x5,64d2,64t32,32x7,32d2,32t16,16x9,16d2,16t8,8x7,8d2,8t4,4x5,4d4,4t1,1x2",
+    enc_channel_config="256:64,128:64,64:64,32:128,16:128,8:256,4:512,1:1024",
+    dec_block_config="1x2,1u4,1t4,4x4,4u2,4t8,8x6,8u2,8t16,16x8,16u2,16t32,32x5,32u2,32t64,64x4,64u2,64t128,128x2,128u2,128t256,256x2",
+    dec_channel_config="256:64,128:64,64:64,32:128,16:128,8:256,4:512,1:1024",
+    n_iters=10,
+    device="cuda",
+):
+    # Compares the encode and decode latency of the VAE (CelebA-HQ 256 config by
+    # default) with its fused inference version, and checks the numerical parity
+    # of the two. The biases are randomized as they are zero-initialized.
+    device = torch.device(device)
+    torch.manual_seed(0)
+    vae = VAE(
+        image_size,
+        enc_block_config,
+        dec_block_config,
+        enc_channel_config,
+        dec_channel_config,
+    )
+    for name, p in vae.named_parameters():
+        if name.endswith("bias"):
+            torch.nn.init.normal_(p, std=0.02)
+    vae = vae.to(device).eval()
+    fused_vae = copy.deepcopy(vae).convert_to_fused()
+    assert list(fused_vae.state_dict()) == list(vae.state_dict())
+
+    x = torch.rand(batch_size, 3, image_size, image_size, device=device)
+    with torch.no_grad():
+        mu, _ = vae.encode(x)
+        expected = {"encode": mu, "decode": vae.decode(mu)}
+
+    for name, model in [("eager", vae), ("fused", fused_vae)]:
+        with torch.no_grad():
+            outputs = {"encode": model.encode(x)[0], "decode": model.decode(mu)}
+        for op, fn in [
+            ("encode", lambda: model.encode(x)),
+            ("decode", lambda: model.decode(mu)),
+        ]:
+            latency = time_inference(fn, device, n_iters=n_iters)
+            error = (outputs[op] - expected[op]).abs().max()
+            print(
+                f"vae {op} ({name}): {latency * 1000:.1f} ms/batch, "
+                f"max abs error {error:.2e}"
+            )
+
+
+@cli.command()
+@click.option(
+    "--config-path",
+    default=os.path.join(
+        os.path.dirname(__file__), "configs/dataset/celebahq/train.yaml"
+    ),
+)
+@click.option("--batch-size", default=None, type=int)
+@click.option("--n-steps", default=10)
+@click.option("--device", default="cuda")
+def vae_precision(config_path, batch_size=None, n_steps=10, device="cuda"):
+    # Compares the VAE training step time and peak memory in float32, fp16 (native
+    # AMP with a gradient scaler, as Lightning precision=16) and bf16 on a VAE
+    # config (CelebA-HQ 256 by default). Each setting starts from the same
+    # initialization and trains on the same batch, so the final (per pixel) loss
+    # also shows whether a precision diverges.
+    config = OmegaConf.load(config_path).vae
+    batch_size = batch_size or config.training.batch_size
+    image_size = config.data.image_size
+    device = torch.device(device)
+
+    x = torch.rand(batch_size, 3, image_size, image_size, device=device)
+    for precision in ["32", "16", "bf16"]:
+        if precision == "16" and device.type != "cuda":
+            print("vae train (16): skipped as fp16 autocast requires a GPU")
+            continue
+
+        torch.manual_seed(0)
+        vae = VAE(
+            image_size,
+            config.model.enc_block_config,
+            config.model.dec_block_config,
+            config.model.enc_channel_config,
+            config.model.dec_channel_config,
+            alpha=config.training.alpha,
+            lr=config.training.lr,
+            bf16=precision == "bf16",
+        ).to(device)
+        optimizer = vae.configure_optimizers()
+        scaler = torch.cuda.amp.GradScaler(enabled=precision == "16")
+
+        for step in range(n_steps + 2):
+            if step == 2:
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                    torch.cuda.reset_peak_memory_stats(device)
+                start = time.perf_counter()
+            optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(device.type, enabled=precision == "16"):
+                # training_step logs through the Trainer, which is not attached here
+                loss, _, _ = vae.compute_loss(x)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        step_time = (time.perf_counter() - start) / n_steps
+        print(
+            f"vae train ({precision}): {step_time * 1000:.1f} ms/step, "
+            f"{peak_memory_mb(device):.0f} MB peak, "
+            f"final loss {loss.item() / x.numel():.5f} per pixel"
+        )
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,6 +1,22 @@
 import torch
 from torch.utils.data import Dataset
-from joblib import load
+from models.expde import GaussianMixtureSampler
+from models.diffusion.noise import Z_DDPM_STREAM, Z_VAE_STREAM, counter_randn
+
+
+def counter_latents(seed, size, stream, chunk_size=256):
+    """
+    Materializes counter-based latents of the given size (including the batch
+    dimension), where the latent at index i only depends on (seed, stream, i).
+    """
+    n_samples, *dims = size
+    out = torch.empty(size)
+    for start in range(0, n_samples, chunk_size):
+        indices = torch.arange(start, min(start + chunk_size, n_samples))
+        out[start : start + len(indices)] = counter_randn(
+            seed, indices, dims, stream=stream
+        )
+    return out
 
 
 class LatentDataset(Dataset):
@@ -10,49 +26,127 @@ class LatentDataset(Dataset):
         z_ddpm_size,
         share_ddpm_latent=False,
         expde_model_path=None,
-        
+        counter_noise=False,
+        lazy=False,
         **kwargs
     ):
         # NOTE: The batch index must be included in the latent code size input
         n_samples, *dims = z_ddpm_size
+        self.seed = kwargs.get("seed", 0)
+        self.n_samples = n_samples
+        self.z_vae_dims = list(z_vae_size[1:])
+        self.z_ddpm_dims = dims
 
-        self.z_vae = torch.randn(z_vae_size)
+        # With counter-based noise, the latents of a sample only depend on the seed
+        # and its global index. The index is then returned along with the latents
+        # so that the sampler noise can be keyed by it as well. Lazy datasets
+        # generate the (same) counter-based latents of a sample on demand instead
+        # of materializing all of them upfront.
+        self.lazy = lazy
+        self.counter_noise = counter_noise or lazy
         self.share_ddpm_latent = share_ddpm_latent
 
         # Load the Ex-PDE model and sample z_vae from it instead!
+        self.expde = None
         if expde_model_path is not None and expde_model_path != "":
             print("Found an Ex-PDE model. Will sample z_vae from it instead!")
-            gmm = load(expde_model_path)
-            gmm.set_params(random_state=kwargs.get("seed", 0))
-            self.z_vae = (
-                torch.from_numpy(gmm.sample(n_samples)[0]).view(z_vae_size).float()
-            )
-            assert self.z_vae.size() == z_vae_size
+            self.expde = GaussianMixtureSampler.load(expde_model_path)
 
-        if self.share_ddpm_latent:
-            self.z_ddpm = torch.randn(dims)
+        self.z_vae = None
+        if self.lazy:
+            pass
+        elif self.counter_noise:
+            self.z_vae = torch.cat(
+                [
+                    self._counter_z_vae(
+                        torch.arange(start, min(start + 256, n_samples))
+                    )
+                    for start in range(0, n_samples, 256)
+                ]
+            )
+        elif self.expde is not None:
+            generator = torch.Generator().manual_seed(self.seed)
+            self.z_vae = self.expde.sample(n_samples, generator=generator).view(
+                z_vae_size
+            )
         else:
-            self.z_ddpm = torch.randn(z_ddpm_size)
+            self.z_vae = torch.randn(z_vae_size)
+
+        self.z_ddpm = None
+        if self.counter_noise and not self.lazy:
+            self.z_ddpm = counter_latents(
+                self.seed,
+                [1] + dims if self.share_ddpm_latent else z_ddpm_size,
+                Z_DDPM_STREAM,
+            )
+            if self.share_ddpm_latent:
+                self.z_ddpm = self.z_ddpm[0]
+        elif self.lazy and self.share_ddpm_latent:
+            # A single shared latent is cheap enough to keep around
+            self.z_ddpm = counter_randn(self.seed, 0, dims, stream=Z_DDPM_STREAM)
+        elif not self.counter_noise:
+            self.z_ddpm = torch.randn(dims if self.share_ddpm_latent else z_ddpm_size)
+
+    def _counter_z_vae(self, indices):
+        if self.expde is not None:
+            z = self.expde.sample_indexed(self.seed, indices)
+            return z.view(-1, *self.z_vae_dims)
+        return counter_randn(self.seed, indices, self.z_vae_dims, stream=Z_VAE_STREAM)
 
     def __getitem__(self, idx):
         if self.share_ddpm_latent:
-            return self.z_ddpm, self.z_vae[idx]
-        return self.z_ddpm[idx], self.z_vae[idx]
+            z_ddpm = self.z_ddpm
+        elif self.z_ddpm is None:
+            z_ddpm = counter_randn(
+                self.seed, idx, self.z_ddpm_dims, stream=Z_DDPM_STREAM
+            )
+        else:
+            z_ddpm = self.z_ddpm[idx]
+
+        if self.z_vae is None:
+            z_vae = self._counter_z_vae(torch.tensor([idx]))[0]
+        else:
+            z_vae = self.z_vae[idx]
+
+        if self.counter_noise:
+            return z_ddpm, z_vae, idx
+        return z_ddpm, z_vae
 
     def __len__(self):
-        return int(self.z_vae.size(0))
+        return self.n_samples
 
 
 class UncondLatentDataset(Dataset):
-    def __init__(self, z_ddpm_size, **kwargs):
+    def __init__(self, z_ddpm_size, counter_noise=False, lazy=False, **kwargs):
         # NOTE: The batch index must be included in the latent code size input
-        self.z_ddpm = torch.randn(z_ddpm_size)
+        n_samples, *dims = z_ddpm_size
+        self.seed = kwargs.get("seed", 0)
+        self.n_samples = n_samples
+        self.z_ddpm_dims = dims
+
+        # See LatentDataset for the counter-based and lazy modes
+        self.lazy = lazy
+        self.counter_noise = counter_noise or lazy
+        self.z_ddpm = None
+        if self.counter_noise and not self.lazy:
+            self.z_ddpm = counter_latents(self.seed, z_ddpm_size, Z_DDPM_STREAM)
+        elif not self.counter_noise:
+            self.z_ddpm = torch.randn(z_ddpm_size)
 
     def __getitem__(self, idx):
-        return self.z_ddpm[idx]
+        if self.z_ddpm is None:
+            z_ddpm = counter_randn(
+                self.seed, idx, self.z_ddpm_dims, stream=Z_DDPM_STREAM
+            )
+        else:
+            z_ddpm = self.z_ddpm[idx]
+
+        if self.counter_noise:
+            return z_ddpm, idx
+        return z_ddpm
 
     def __len__(self):
-        return int(self.z_ddpm.size(0))
+        return self.n_samples
 
 
 class ZipDataset(Dataset):
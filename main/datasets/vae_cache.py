@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+class VAECacheDataset(Dataset):
+    """
+    Pairs the images of a dataset with their cached VAE posteriors (and
+    optionally reconstructions), as written by `extract_latents.py cache-vae`.
+    The cache is a directory of memory-mapped .npy arrays aligned with the
+    dataset indices:
+        mu.npy, logvar.npy: the (N, z_dim, 1, 1) posterior parameters.
+        recons.npy: (optional) the (N, C, H, W) float16 VAE reconstructions of mu,
+                    in [0, 1].
+    NOTE: The cache is only valid for the deterministic transforms it was
+    computed with (e.g. no random flips).
+    :param dataset: the image dataset the cache was computed on.
+    :param cache_path: the cache directory.
+    :param use_recons: whether to also return the cached reconstructions.
+    """
+
+    def __init__(self, dataset, cache_path, use_recons=False):
+        self.dataset = dataset
+        self.cache_path = cache_path
+        self.use_recons = use_recons
+
+        names = ["mu", "logvar"] + (["recons"] if use_recons else [])
+        self.paths = [os.path.join(cache_path, f"{name}.npy") for name in names]
+        for path in self.paths:
+            if not os.path.exists(path):
+                raise ValueError(f"The VAE cache file: {path} does not exist")
+            n_cached = np.load(path, mmap_mode="r").shape[0]
+            if n_cached != len(dataset):
+                raise ValueError(
+                    f"The VAE cache at {path} has {n_cached} entries but the "
+                    f"dataset has {len(dataset)} images"
+                )
+
+        # NOTE: The arrays are opened lazily in each worker process as memory maps
+        # should not be pickled
+        self._arrays = None
+
+    def __getitem__(self, idx):
+        if self._arrays is None:
+            self._arrays = [np.load(path, mmap_mode="r") for path in self.paths]
+        cached = [torch.from_numpy(np.array(a[idx])).float() for a in self._arrays]
+        return (self.dataset[idx], *cached)
+
+    def __len__(self):
+        return len(self.dataset)
@@ -0,0 +1,119 @@
+import copy
+import logging
+import os
+
+import hydra
+import pytorch_lightning as pl
+from omegaconf import OmegaConf
+from pytorch_lightning.callbacks import ModelCheckpoint
+from pytorch_lightning.utilities.seed import seed_everything
+
+from models.diffusion import DDPMWrapper, DistillWrapper
+from models.vae import VAE
+from train_ddpm import build_ddpm, get_train_loader, get_trainer_kwargs
+from util import get_ddpm_train_dataset
+
+logger = logging.getLogger(__name__)
+
+
+def __parse_str(s):
+    split = s.split(",")
+    return [int(s) for s in split if s != "" and s is not None]
+
+
+@hydra.main(config_path="configs")
+def distill(config):
+    # Get config and setup
+    config = config.dataset.ddpm
+    logger.info(OmegaConf.to_yaml(config))
+
+    # Set seed
+    seed_everything(config.training.seed, workers=True)
+
+    # Dataset
+    image_size = config.data.image_size
+    dataset = get_ddpm_train_dataset(config)
+
+    vae = VAE.load_from_checkpoint(
+        config.training.vae_chkpt_path,
+        input_res=image_size,
+    )
+    vae.eval()
+
+    for p in vae.parameters():
+        p.requires_grad = False
+
+    # Load the teacher (the architecture is given by the model section)
+    ddpm_type = config.training.type
+    teacher_wrapper = DDPMWrapper.load_from_checkpoint(
+        config.distill.teacher_chkpt_path,
+        online_network=build_ddpm(config),
+        target_network=build_ddpm(config),
+        vae=vae,
+        conditional=False if ddpm_type == "uncond" else True,
+        strict=True,
+    )
+    teacher_ddpm = teacher_wrapper.target_network
+
+    # Student (and its EMA copy, with non-trainable parameters)
+    online_ddpm = build_ddpm(
+        config,
+        dim=config.distill.dim,
+        n_residual=config.distill.n_residual,
+        dim_mults=config.distill.dim_mults,
+        use_checkpoint=__parse_str(config.model.checkpoint_resolutions),
+    )
+    target_ddpm = build_ddpm(config, decoder=copy.deepcopy(online_ddpm.decoder))
+    for p in target_ddpm.parameters():
+        p.requires_grad = False
+
+    n_teacher = sum(p.numel() for p in teacher_ddpm.decoder.parameters())
+    n_student = sum(p.numel() for p in online_ddpm.decoder.parameters())
+    logger.info(
+        f"Distilling a DDPM with type: {type(online_ddpm)} from {n_teacher} to "
+        f"{n_student} decoder parameters"
+    )
+
+    ddpm_wrapper = DistillWrapper(
+        teacher_ddpm,
+        online_ddpm,
+        target_ddpm,
+        vae,
+        lr=config.training.lr,
+        cfd_rate=config.training.cfd_rate,
+        n_anneal_steps=config.training.n_anneal_steps,
+        loss=config.training.loss,
+        conditional=False if ddpm_type == "uncond" else True,
+        grad_clip_val=config.training.grad_clip,
+        z_cond=config.training.z_cond,
+        data_loss_weight=config.distill.data_loss_weight,
+    )
+
+    # Trainer
+    train_kwargs, loader_kws = get_trainer_kwargs(config)
+    restore_path = config.training.restore_path
+    if restore_path != "":
+        # Restore checkpoint
+        train_kwargs["resume_from_checkpoint"] = restore_path
+
+    # Setup callbacks
+    chkpt_callback = ModelCheckpoint(
+        dirpath=os.path.join(config.training.results_dir, "checkpoints"),
+        filename=f"ddpmv2-distill-{config.training.chkpt_prefix}"
+        + "-{epoch:02d}-{loss:.4f}",
+        every_n_epochs=config.training.chkpt_interval,
+        save_on_train_epoch_end=True,
+    )
+    train_kwargs["max_epochs"] = config.training.epochs
+    train_kwargs["callbacks"].insert(0, chkpt_callback)
+
+    # Loader
+    loader = get_train_loader(config, dataset, **loader_kws)
+
+    logger.info(f"Running Trainer with kwargs: {train_kwargs}")
+    trainer = pl.Trainer(**train_kwargs)
+    trainer.fit(ddpm_wrapper, train_dataloader=loader)
+
+
+if __name__ == "__main__":
+    distill()
@@ -46,6 +46,10 @@ def generate_recons(config):
     )
     vae.eval()
 
+    # Fused inference version of the VAE (state dict is unchanged)
+    if config_ddpm.evaluation.fused_vae:
+        vae.convert_to_fused()
+
     # Load pretrained wrapper
     attn_resolutions = __parse_str(config_ddpm.model.attn_resolutions)
     dim_mults = __parse_str(config_ddpm.model.dim_mults)
@@ -59,11 +63,16 @@ def generate_recons(config):
         use_checkpoint=False,
         dropout=config_ddpm.model.dropout,
         num_heads=config_ddpm.model.n_heads,
+        attn_chunk_size=config_ddpm.model.attn_chunk_size,
         z_dim=config_ddpm.evaluation.z_dim,
         use_scale_shift_norm=config_ddpm.evaluation.z_cond,
         use_z=config_ddpm.evaluation.z_cond,
     )
 
+    # Fused GroupNorm+SiLU and channels-last execution (state dict is unchanged)
+    if config_ddpm.evaluation.fused_unet:
+        decoder.convert_to_fused()
+
     ema_decoder = copy.deepcopy(decoder)
     decoder.eval()
     ema_decoder.eval()
@@ -102,6 +111,10 @@ def generate_recons(config):
         z_cond=config_ddpm.evaluation.z_cond,
         ddpm_latents=ddpm_latents,
         strict=True,
+        compile_decoder=config_ddpm.evaluation.compile_decoder or None,
+        compile_cache_dir=config_ddpm.evaluation.compile_cache_dir or None,
+        n_recons=config_ddpm.evaluation.n_recons,
+        recons_chunk_size=config_ddpm.evaluation.recons_chunk_size or None,
     )
 
     # Dataset
@@ -150,6 +163,7 @@ def generate_recons(config):
         conditional=True,
         sample_prefix=config_ddpm.evaluation.sample_prefix,
         save_mode=config_ddpm.evaluation.save_mode,
+        stream=config_ddpm.evaluation.save_stream,
         save_vae=config_ddpm.evaluation.save_vae,
         is_norm=config_ddpm.data.norm,
     )
@@ -11,11 +11,11 @@ import os
 import hydra
 import torch
 from models.diffusion import DDPM, DDPMv2, DDPMWrapper, SuperResModel
+from models.expde import GaussianMixtureSampler
 from models.vae import VAE
 from pytorch_lightning.utilities.seed import seed_everything
 from tqdm import tqdm
 from util import configure_device, plot_interpolations, save_as_images
-from joblib import load
 
 
 def __parse_str(s):
@@ -47,6 +47,10 @@ def interpolate_ddpm(config):
     )
     vae.eval()
 
+    # Fused inference version of the VAE (state dict is unchanged)
+    if config_ddpm.evaluation.fused_vae:
+        vae.convert_to_fused()
+
     # Superres Model
     attn_resolutions = __parse_str(config_ddpm.model.attn_resolutions)
     dim_mults = __parse_str(config_ddpm.model.dim_mults)
@@ -60,11 +64,16 @@ def interpolate_ddpm(config):
         use_checkpoint=False,
         dropout=config_ddpm.model.dropout,
         num_heads=config_ddpm.model.n_heads,
+        attn_chunk_size=config_ddpm.model.attn_chunk_size,
         z_dim=config_ddpm.evaluation.z_dim,
         use_scale_shift_norm=config_ddpm.evaluation.z_cond,
         use_z=config_ddpm.evaluation.z_cond,
     )
 
+    # Fused GroupNorm+SiLU and channels-last execution (state dict is unchanged)
+    if config_ddpm.evaluation.fused_unet:
+        decoder.convert_to_fused()
+
     ema_decoder = copy.deepcopy(decoder)
     decoder.eval()
     ema_decoder.eval()
@@ -102,6 +111,8 @@ def interpolate_ddpm(config):
         z_cond=config_ddpm.evaluation.z_cond,
         ddpm_latents=ddpm_latents,
         strict=True,
+        compile_decoder=config_ddpm.evaluation.compile_decoder or None,
+        compile_cache_dir=config_ddpm.evaluation.compile_cache_dir or None,
     )
 
     ddpm_wrapper.to(dev)
@@ -119,10 +130,11 @@ def interpolate_ddpm(config):
             print(
                 "Found an Ex-PDE model. Will sample latents for interpolation from it instead!"
             )
-            gmm = load(expde_model_path)
-            gmm.set_params(random_state=config_ddpm.evaluation.seed)
-            z = gmm.sample(1)[0]
-            z_1 = torch.from_numpy(z[0]).view(1, z_dim, 1, 1).to(dev).float()
+            gmm = GaussianMixtureSampler.load(expde_model_path).to(dev)
+            z = gmm.sample_indexed(
+                config_ddpm.evaluation.seed, torch.arange(1, device=dev)
+            )
+            z_1 = z[0].view(1, z_dim, 1, 1)
             assert z_1.size() == (1, z_dim, 1, 1)
 
         recons_inter = vae(z_1)
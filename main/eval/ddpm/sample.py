@@ -13,6 +13,7 @@ import pytorch_lightning as pl
 from datasets.latent import UncondLatentDataset
 from models.callbacks import ImageWriter
 from models.diffusion import DDPM, DDPMWrapper, UNetModel
+from models.quantization import quantize_ddpm_wrapper
 from pytorch_lightning.utilities.seed import seed_everything
 from torch.utils.data import DataLoader
 from util import configure_device
@@ -50,8 +51,13 @@ def sample(config):
         use_checkpoint=False,
         dropout=config.model.dropout,
         num_heads=config.model.n_heads,
+        attn_chunk_size=config.model.attn_chunk_size,
     )
 
+    # Fused GroupNorm+SiLU and channels-last execution (state dict is unchanged)
+    if config.evaluation.fused_unet:
+        decoder.convert_to_fused()
+
     ema_decoder = copy.deepcopy(decoder)
     decoder.eval()
     ema_decoder.eval()
@@ -84,12 +90,18 @@ def sample(config):
         sample_method=config.evaluation.sample_method,
         sample_from=config.evaluation.sample_from,
         data_norm=config.data.norm,
+        noise_seed=config.evaluation.seed,
         strict=False,
+        compile_decoder=config.evaluation.compile_decoder or None,
+        compile_cache_dir=config.evaluation.compile_cache_dir or None,
     )
 
     # Create predict dataset of latents
     z_dataset = UncondLatentDataset(
         (n_samples, 3, image_size, image_size),
+        counter_noise=config.evaluation.counter_noise,
+        lazy=config.evaluation.lazy_latents,
+        seed=config.evaluation.seed,
     )
 
     # Setup devices
@@ -116,6 +128,16 @@ def sample(config):
         **loader_kws,
     )
 
+    # Post-training int8 quantization (CPU only)
+    if config.evaluation.quantize != "":
+        assert device == "cpu"
+        quantize_ddpm_wrapper(
+            ddpm_wrapper,
+            val_loader,
+            mode=config.evaluation.quantize,
+            n_batches=config.evaluation.n_calib_batches,
+        )
+
     # Predict trainer
     write_callback = ImageWriter(
         config.evaluation.save_path,
@@ -125,6 +147,7 @@ def sample(config):
         conditional=False,
         sample_prefix=config.evaluation.sample_prefix,
         save_mode=config.evaluation.save_mode,
+        stream=config.evaluation.save_stream,
     )
 
     test_kwargs["callbacks"] = [write_callback]
@@ -14,6 +14,7 @@ import torch
 from datasets.latent import LatentDataset
 from models.callbacks import ImageWriter
 from models.diffusion import DDPM, DDPMv2, DDPMWrapper, SuperResModel
+from models.quantization import quantize_ddpm_wrapper
 from models.vae import VAE
 from pytorch_lightning.utilities.seed import seed_everything
 from torch.utils.data import DataLoader
@@ -46,6 +47,10 @@ def sample_cond(config):
     )
     vae.eval()
 
+    # Fused inference version of the VAE (state dict is unchanged)
+    if config_ddpm.evaluation.fused_vae:
+        vae.convert_to_fused()
+
     # Load pretrained wrapper
     attn_resolutions = __parse_str(config_ddpm.model.attn_resolutions)
     dim_mults = __parse_str(config_ddpm.model.dim_mults)
@@ -59,11 +64,16 @@ def sample_cond(config):
         use_checkpoint=False,
         dropout=config_ddpm.model.dropout,
         num_heads=config_ddpm.model.n_heads,
+        attn_chunk_size=config_ddpm.model.attn_chunk_size,
         z_dim=config_ddpm.evaluation.z_dim,
         use_scale_shift_norm=config_ddpm.evaluation.z_cond,
         use_z=config_ddpm.evaluation.z_cond,
     )
 
+    # Fused GroupNorm+SiLU and channels-last execution (state dict is unchanged)
+    if config_ddpm.evaluation.fused_unet:
+        decoder.convert_to_fused()
+
     ema_decoder = copy.deepcopy(decoder)
     decoder.eval()
     ema_decoder.eval()
@@ -102,6 +112,9 @@ def sample_cond(config):
         z_cond=config_ddpm.evaluation.z_cond,
         strict=True,
         ddpm_latents=ddpm_latents,
+        noise_seed=config_ddpm.evaluation.seed,
+        compile_decoder=config_ddpm.evaluation.compile_decoder or None,
+        compile_cache_dir=config_ddpm.evaluation.compile_cache_dir or None,
     )
 
     # Create predict dataset of latents
@@ -111,6 +124,8 @@ def sample_cond(config):
         share_ddpm_latent=True if ddpm_latent_path != "" else False,
         expde_model_path=config_vae.evaluation.expde_model_path,
         seed=config_ddpm.evaluation.seed,
+        counter_noise=config_ddpm.evaluation.counter_noise,
+        lazy=config_ddpm.evaluation.lazy_latents,
     )
 
     # Setup devices
@@ -138,6 +153,17 @@ def sample_cond(config):
         **loader_kws,
     )
 
+    # Post-training int8 quantization (CPU only)
+    if config_ddpm.evaluation.quantize != "":
+        assert device == "cpu"
+        assert not config_ddpm.evaluation.fused_vae
+        quantize_ddpm_wrapper(
+            ddpm_wrapper,
+            val_loader,
+            mode=config_ddpm.evaluation.quantize,
+            n_batches=config_ddpm.evaluation.n_calib_batches,
+        )
+
     # Predict trainer
     write_callback = ImageWriter(
         config_ddpm.evaluation.save_path,
@@ -148,6 +174,7 @@ def sample_cond(config):
         sample_prefix=config_ddpm.evaluation.sample_prefix,
         save_vae=config_ddpm.evaluation.save_vae,
         save_mode=config_ddpm.evaluation.save_mode,
+        stream=config_ddpm.evaluation.save_stream,
         is_norm=config_ddpm.data.norm,
     )
 
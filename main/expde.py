@@ -1,9 +1,10 @@
 import click
 import os
 import numpy as np
-from joblib import dump
+from joblib import dump, load
 
 from sklearn.mixture import GaussianMixture
+from models.expde import GaussianMixtureSampler
 
 
 @click.group()
@@ -33,6 +34,22 @@ def fit_gmm(
     os.makedirs(save_path, exist_ok=True)
     s = dump(gmm, os.path.join(save_path, f"gmm_{n_components}.joblib"))
 
+    # Export the torch sampler used during sampling
+    GaussianMixtureSampler.from_sklearn(gmm).save(
+        os.path.join(save_path, f"gmm_{n_components}.pt")
+    )
+
+
+@cli.command()
+@click.argument("gmm-path")
+@click.option("--save-path", default=None)
+def export_gmm(gmm_path, save_path=None):
+    # Export a previously fitted sklearn model to a torch sampler
+    gmm = load(gmm_path)
+    if save_path is None:
+        save_path = os.path.splitext(gmm_path)[0] + ".pt"
+    GaussianMixtureSampler.from_sklearn(gmm).save(save_path)
+
 
 if __name__ == "__main__":
     cli()
@@ -1,11 +1,13 @@
 import click
+import json
 import os
+import time
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 
 from tqdm import tqdm
-from util import configure_device, get_dataset
+from util import get_dataset, get_device
 from models.vae import VAE
 
 
@@ -14,6 +16,157 @@ def cli():
     pass
 
 
+def open_stores(save_path, specs, proc_id=0, timeout=600):
+    """
+    Opens the preallocated memory-mapped .npy arrays of an extraction run for
+    writing. The arrays are created (by the process with proc_id 0) if they
+    do not exist yet, while the other processes wait for them.
+    :param specs: a dict mapping file names to (shape, dtype) of the arrays.
+    :return: a dict mapping the file names to the writable memory maps.
+    """
+    paths = {name: os.path.join(save_path, name) for name in specs}
+    if proc_id == 0:
+        for name, (shape, dtype) in specs.items():
+            if os.path.exists(paths[name]):
+                continue
+            # NOTE: Written to a temporary file first so that the other processes
+            # never open a partially written header
+            tmp_path = paths[name] + ".tmp"
+            np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+            os.replace(tmp_path, paths[name])
+    else:
+        start = time.time()
+        while not all(os.path.exists(path) for path in paths.values()):
+            if time.time() - start > timeout:
+                raise RuntimeError(f"Timed out waiting for the arrays in {save_path}")
+            time.sleep(1)
+
+    stores = {}
+    for name, (shape, dtype) in specs.items():
+        stores[name] = np.load(paths[name], mmap_mode="r+")
+        if stores[name].shape != tuple(shape) or stores[name].dtype != dtype:
+            raise ValueError(
+                f"The existing array {paths[name]} has shape {stores[name].shape} "
+                f"({stores[name].dtype}) but {tuple(shape)} ({np.dtype(dtype)}) "
+                "was expected. Use a new --save-path."
+            )
+    return stores
+
+
+def check_manifest(marker_path, manifest, proc_id=0, timeout=600):
+    """
+    Writes the manifest of an extraction run (by the process with proc_id 0) next
+    to its shard markers, or checks it against the manifest of the run that wrote
+    the existing markers, so that a run never resumes from the shards of a run
+    with different settings.
+    """
+    path = os.path.join(marker_path, "manifest.json")
+    if proc_id == 0 and not os.path.exists(path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    else:
+        start = time.time()
+        while not os.path.exists(path):
+            if time.time() - start > timeout:
+                raise RuntimeError(f"Timed out waiting for the manifest {path}")
+            time.sleep(1)
+
+    with open(path) as f:
+        existing = json.load(f)
+    if existing != manifest:
+        diff = sorted(
+            k
+            for k in set(existing) | set(manifest)
+            if existing.get(k) != manifest.get(k)
+        )
+        raise ValueError(
+            f"The shards at {marker_path} were written with different settings "
+            f"({', '.join(diff)}). Use a new --save-path."
+        )
+
+
+def extract_sharded(
+    dataset,
+    save_path,
+    specs,
+    batch_fn,
+    run_name,
+    settings,
+    batch_size=64,
+    workers=1,
+    shard_size=10000,
+    n_procs=1,
+    proc_id=0,
+    pin_memory=False,
+):
+    """
+    Runs batch_fn over a dataset in order and writes its outputs to memory-mapped
+    arrays aligned with the dataset indices. The dataset is split into shards of
+    shard_size images, and the shards are distributed round-robin over n_procs
+    (independently launched) processes. A marker file is written once a shard is
+    flushed to disk, so that an interrupted run resumes from the completed shards.
+    The markers of a run are kept under save_path/shards_{run_name} along with a
+    manifest of its settings, which a resumed run must match.
+    :param specs: a dict mapping file names to (shape, dtype) of the outputs.
+    :param batch_fn: a callable (batch, shard_idx, batch_idx) -> dict mapping the
+                     file names to the (batch-first) outputs of a batch.
+    :param run_name: the name of the extraction command.
+    :param settings: a (JSON serializable) dict of the settings that determine the
+                     outputs, e.g. the checkpoint and the image size.
+    """
+    assert 0 <= proc_id < n_procs
+    N = len(dataset)
+    n_shards = (N + shard_size - 1) // shard_size
+    marker_path = os.path.join(save_path, f"shards_{run_name}")
+    os.makedirs(marker_path, exist_ok=True)
+    manifest = dict(settings)
+    manifest.update(
+        n=N,
+        shard_size=shard_size,
+        arrays={
+            name: [list(shape), np.dtype(dtype).str]
+            for name, (shape, dtype) in specs.items()
+        },
+    )
+    check_manifest(marker_path, manifest, proc_id=proc_id)
+    stores = open_stores(save_path, specs, proc_id=proc_id)
+
+    shards = [
+        shard_idx
+        for shard_idx in range(proc_id, n_shards, n_procs)
+        if not os.path.exists(os.path.join(marker_path, f"{shard_idx}.done"))
+    ]
+    print(
+        f"Process {proc_id}: {len(shards)} of {n_shards} shards left to extract "
+        f"at {save_path}"
+    )
+
+    for shard_idx in tqdm(shards):
+        start = shard_idx * shard_size
+        end = min(N, start + shard_size)
+        loader = DataLoader(
+            Subset(dataset, range(start, end)),
+            batch_size,
+            num_workers=workers,
+            pin_memory=pin_memory,
+            shuffle=False,
+            drop_last=False,
+        )
+
+        idx = start
+        for batch_idx, batch in enumerate(loader):
+            outputs = batch_fn(batch, shard_idx, batch_idx)
+            for name, out in outputs.items():
+                stores[name][idx : idx + out.size(0)] = out.cpu().numpy()
+            idx += batch.size(0)
+
+        for store in stores.values():
+            store.flush()
+        open(os.path.join(marker_path, f"{shard_idx}.done"), "w").close()
+
+
 @cli.command()
 @click.argument("vae-chkpt-path")
 @click.argument("root")
@@ -21,6 +174,13 @@ def cli():
 @click.option("--dataset-name", default="cifar10")
 @click.option("--image-size", default=32)
 @click.option("--save-path", default=os.getcwd())
+@click.option("--batch-size", default=64)
+@click.option("--workers", default=1)
+@click.option("--shard-size", default=10000, help="Images per (resumable) shard")
+@click.option("--n-procs", default=1, help="Number of extraction processes")
+@click.option("--proc-id", default=0, help="Index of this process")
+@click.option("--save-posterior", is_flag=True, default=False)
+@click.option("--seed", default=0)
 def extract(
     vae_chkpt_path,
     root,
@@ -28,42 +188,144 @@ def extract(
     dataset_name="cifar10",
     image_size=32,
     save_path=os.getcwd(),
+    batch_size=64,
+    workers=1,
+    shard_size=10000,
+    n_procs=1,
+    proc_id=0,
+    save_posterior=False,
+    seed=0,
 ):
-    # dev, _ = configure_device(device)
-    dev = 'cuda'
+    """
+    Writes sampled VAE latents (and optionally the posterior parameters mu and
+    logvar) of a dataset as latents_{dataset}.npy (mu_{dataset}.npy and
+    logvar_{dataset}.npy). Launch one process per device with the same
+    --n-procs and a different --proc-id to extract in parallel.
+    """
+    dev = get_device(device)
 
     # Dataset
     dataset = get_dataset(dataset_name, root, image_size, norm=False, flip=False)
-
-    # Loader
-    loader = DataLoader(
-        dataset,
-        64,
-        num_workers=1,
-        pin_memory=True,
-        shuffle=False,
-        drop_last=False,
-    )
+    N = len(dataset)
 
     # Load VAE
     vae = VAE.load_from_checkpoint(vae_chkpt_path, input_res=image_size).to(dev)
     vae.eval()
 
-    z_list = []
-    for _, batch in tqdm(enumerate(loader)):
-        batch = batch.to(dev)
+    with torch.no_grad():
+        z_shape = vae.encode(dataset[0].unsqueeze(0).to(dev))[0].shape[1:]
+    names = {"z": f"latents_{dataset_name}.npy"}
+    if save_posterior:
+        names["mu"] = f"mu_{dataset_name}.npy"
+        names["logvar"] = f"logvar_{dataset_name}.npy"
+    specs = {name: ((N, *z_shape), np.float32) for name in names.values()}
+
+    def batch_fn(batch, shard_idx, batch_idx):
+        # NOTE: The noise is seeded per shard so that resumed (or parallel) runs
+        # sample the same latents
+        if batch_idx == 0:
+            torch.manual_seed(seed + shard_idx)
         with torch.no_grad():
-            mu, logvar = vae.encode(batch)
+            mu, logvar = vae.encode(batch.to(dev))
             z = vae.reparameterize(mu, logvar)
+        outputs = {"z": z, "mu": mu, "logvar": logvar}
+        return {names[k]: outputs[k] for k in names}
 
-        # Not transferring to CPU leads to memory overflow in GPU!
-        z_list.append(z.cpu())
+    extract_sharded(
+        dataset,
+        save_path,
+        specs,
+        batch_fn,
+        run_name="extract",
+        settings={
+            "vae_chkpt_path": os.path.abspath(vae_chkpt_path),
+            "dataset_name": dataset_name,
+            "image_size": image_size,
+            "seed": seed,
+        },
+        batch_size=batch_size,
+        workers=workers,
+        shard_size=shard_size,
+        n_procs=n_procs,
+        proc_id=proc_id,
+        pin_memory=dev.type == "cuda",
+    )
 
-    cat_z = torch.cat(z_list, dim=0)
 
-    # Save the latents as numpy array
-    os.makedirs(save_path, exist_ok=True)
-    np.save(os.path.join(save_path, f"latents_{dataset_name}.npy"), cat_z.numpy())
+@cli.command()
+@click.argument("vae-chkpt-path")
+@click.argument("root")
+@click.option("--device", default="gpu:0")
+@click.option("--dataset-name", default="cifar10")
+@click.option("--image-size", default=32)
+@click.option("--save-path", default=os.getcwd())
+@click.option("--batch-size", default=64)
+@click.option("--workers", default=1)
+@click.option("--shard-size", default=10000, help="Images per (resumable) shard")
+@click.option("--n-procs", default=1, help="Number of extraction processes")
+@click.option("--proc-id", default=0, help="Index of this process")
+@click.option("--save-recons", is_flag=True, default=False)
+def cache_vae(
+    vae_chkpt_path,
+    root,
+    device="gpu:0",
+    dataset_name="cifar10",
+    image_size=32,
+    save_path=os.getcwd(),
+    batch_size=64,
+    workers=1,
+    shard_size=10000,
+    n_procs=1,
+    proc_id=0,
+    save_recons=False,
+):
+    """Writes the VAE cache read by `VAECacheDataset` during DDPM training."""
+    dev = get_device(device)
+
+    # Dataset (in order and without random flips so the cache is aligned)
+    dataset = get_dataset(dataset_name, root, image_size, norm=False, flip=False)
+    N = len(dataset)
+
+    # Load VAE
+    vae = VAE.load_from_checkpoint(vae_chkpt_path, input_res=image_size).to(dev)
+    vae.eval()
+
+    x = dataset[0].unsqueeze(0).to(dev)
+    with torch.no_grad():
+        z_shape = vae.encode(x)[0].shape[1:]
+    specs = {
+        "mu.npy": ((N, *z_shape), np.float32),
+        "logvar.npy": ((N, *z_shape), np.float32),
+    }
+    if save_recons:
+        specs["recons.npy"] = ((N, *x.shape[1:]), np.float16)
+
+    def batch_fn(batch, shard_idx, batch_idx):
+        with torch.no_grad():
+            mu, logvar = vae.encode(batch.to(dev))
+            outputs = {"mu.npy": mu, "logvar.npy": logvar}
+            if save_recons:
+                outputs["recons.npy"] = vae.decode(mu).half()
+        return outputs
+
+    extract_sharded(
+        dataset,
+        save_path,
+        specs,
+        batch_fn,
+        run_name="cache_vae",
+        settings={
+            "vae_chkpt_path": os.path.abspath(vae_chkpt_path),
+            "dataset_name": dataset_name,
+            "image_size": image_size,
+        },
+        batch_size=batch_size,
+        workers=workers,
+        shard_size=shard_size,
+        n_procs=n_procs,
+        proc_id=proc_id,
+        pin_memory=dev.type == "cuda",
+    )
 
 
 if __name__ == "__main__":
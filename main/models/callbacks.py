@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Sequence, Union
 
 import torch
@@ -71,9 +72,12 @@ class ImageWriter(BasePredictionWriter):
         save_vae=False,
         save_mode="image",
         is_norm=True,
+        stream=False,
+        max_pending=4,
     ):
         super().__init__(write_interval)
         assert eval_mode in ["sample", "recons"]
+        assert max_pending > 0
         self.output_dir = output_dir
         self.compare = compare
         self.n_steps = 1000 if n_steps is None else n_steps
@@ -84,6 +88,90 @@ class ImageWriter(BasePredictionWriter):
         self.is_norm = is_norm
         self.save_fn = save_as_images if save_mode == "image" else save_as_np
 
+        # When streaming, sampler checkpoints are offloaded to (pinned) host
+        # memory as soon as they are reached and written by a background
+        # worker while sampling continues. At most max_pending writes are in
+        # flight, so that host copies do not pile up when writes fall behind
+        self.stream = stream
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = []
+
+    def on_predict_start(self, trainer, pl_module):
+        if self.stream:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            self._pending = []
+
+    def on_predict_batch_start(
+        self, trainer, pl_module, batch, batch_idx, dataloader_idx=0
+    ):
+        if not self.stream:
+            return
+        self._collect(self.max_pending)
+        rank = pl_module.global_rank
+
+        def _offload(step, x):
+            if x.is_cuda:
+                samples = torch.empty(
+                    x.shape, dtype=x.dtype, device="cpu", pin_memory=True
+                )
+                samples.copy_(x, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+            else:
+                samples, event = x.cpu(), None
+            self._collect(self.max_pending - 1)
+            self._pending.append(
+                self._executor.submit(
+                    self._write_async, str(step), samples, event, rank, batch_idx
+                )
+            )
+
+        pl_module.sample_callback = _offload
+
+    def on_predict_end(self, trainer, pl_module):
+        if self.stream:
+            pl_module.sample_callback = None
+            self._drain()
+            self._executor.shutdown()
+            self._executor = None
+
+    def _drain(self):
+        self._collect(0)
+
+    def _collect(self, max_pending):
+        # Surface any exception raised by the finished background writes, and
+        # wait for the oldest ones while more than max_pending are in flight
+        pending = []
+        for future in self._pending:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        while len(pending) > max_pending:
+            pending.pop(0).result()
+        self._pending = pending
+
+    def _write_async(self, k, samples, event, rank, batch_idx):
+        if event is not None:
+            event.synchronize()
+        self._write_samples(k, samples, rank, batch_idx)
+
+    def _write_samples(self, k, ddpm_samples, rank, batch_idx):
+        # Setup dirs
+        base_save_path = os.path.join(self.output_dir, k)
+        img_save_path = os.path.join(base_save_path, "images")
+        os.makedirs(img_save_path, exist_ok=True)
+
+        # Save
+        self.save_fn(
+            ddpm_samples,
+            file_name=os.path.join(
+                img_save_path, f"output_{self.sample_prefix }_{rank}_{batch_idx}"
+            ),
+            denorm=self.is_norm,
+        )
+
     def write_on_batch_end(
         self,
         trainer,
@@ -116,22 +204,9 @@ class ImageWriter(BasePredictionWriter):
         # Write output images
         # NOTE: We need to use gpu rank during saving to prevent
         # processes from overwriting images
+        # (When streaming, the dict is empty as checkpoints were already written)
         for k, ddpm_samples in ddpm_samples_dict.items():
-            ddpm_samples = ddpm_samples.cpu()
-
-            # Setup dirs
-            base_save_path = os.path.join(self.output_dir, k)
-            img_save_path = os.path.join(base_save_path, "images")
-            os.makedirs(img_save_path, exist_ok=True)
-
-            # Save
-            self.save_fn(
-                ddpm_samples,
-                file_name=os.path.join(
-                    img_save_path, f"output_{self.sample_prefix }_{rank}_{batch_idx}"
-                ),
-                denorm=self.is_norm,
-            )
+            self._write_samples(k, ddpm_samples.cpu(), rank, batch_idx)
 
         # FIXME: This is currently broken. Separate this from the core logic
         # into a new function. Uncomment when ready!
@@ -4,3 +4,4 @@ from .ddpm_form2 import DDPMv2
 from .wrapper import DDPMWrapper
 from .spaced_diff import SpacedDiffusion
 from .spaced_diff_form2 import SpacedDiffusionForm2
+from .distill import DistillWrapper, ProgressiveDistillWrapper
@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import os
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+
+class _DecoderCall(nn.Module):
+    # Positional-only view of a decoder call with a fixed set of keyword inputs,
+    # as required for tracing
+    def __init__(self, decoder, kwarg_names):
+        super().__init__()
+        self.decoder = decoder
+        self.kwarg_names = kwarg_names
+        self.train(decoder.training)
+
+    def forward(self, x, t, *kwarg_values):
+        return self.decoder(x, t, **dict(zip(self.kwarg_names, kwarg_values)))
+
+
+def model_hash(module):
+    """
+    Returns a hash of the architecture and the weights of a module.
+    """
+    h = hashlib.sha1(repr(module).encode())
+    for name, tensor in module.state_dict().items():
+        h.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        data = tensor.detach().cpu().contiguous().view(-1).view(torch.uint8)
+        h.update(data.numpy().tobytes())
+    return h.hexdigest()
+
+
+class CompiledDecoder(nn.Module):
+    """
+    Runs a sampling decoder through TorchScript ("trace"), specialized to each
+    input signature (the names, shapes, dtypes and devices of its inputs). Every signature is compiled and warmed up on its
+    first call, and its output is checked against the eager decoder. If anything
+    fails, the signature falls back to the eager decoder.
+
+    Traced decoders are frozen and cached on disk under cache_dir keyed by the
+    model hash and the input signature, so the tracing cost is paid once per
+    checkpoint.
+    NOTE: Compiled signatures run without autograd and are meant for sampling only.
+    :param decoder: the eager decoder (a UNetModel or SuperResModel).
+    :param backend: one of ['trace'].
+    :param cache_dir: if specified, the directory used to cache compiled decoders.
+    """
+
+    def __init__(self, decoder, backend="trace", cache_dir=None):
+        super().__init__()
+        assert backend in ["trace"]
+        self.decoder = decoder
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self._compiled = {}
+        self._model_hash = None
+
+    def embed_timesteps(self, timesteps):
+        return self.decoder.embed_timesteps(timesteps)
+
+    def embed_z(self, z):
+        return self.decoder.embed_z(z)
+
+    def forward(self, x, t, **kwargs):
+        names = tuple(sorted(k for k, v in kwargs.items() if v is not None))
+        args = (x, t) + tuple(kwargs[k] for k in names)
+        key = (names,) + tuple((tuple(a.shape), a.dtype, str(a.device)) for a in args)
+        if key not in self._compiled:
+            self._compiled[key] = self._compile(names, args, key)
+        return self._compiled[key](*args)
+
+    def _cache_path(self, key):
+        if not self.cache_dir:
+            return None
+        if self._model_hash is None:
+            self._model_hash = model_hash(self.decoder)
+        signature = hashlib.sha1(f"{key}:{torch.__version__}".encode()).hexdigest()
+        return os.path.join(
+            self.cache_dir, f"decoder_{self._model_hash[:16]}_{signature[:16]}.pt"
+        )
+
+    def _compile(self, names, args, key):
+        eager_fn = _DecoderCall(self.decoder, names)
+        try:
+            with torch.no_grad():
+                fn = self._trace(eager_fn, args, key)
+
+                # Warm-up, also validating the compiled decoder against eager
+                out = fn(*args)
+                expected = eager_fn(*args)
+                if not torch.allclose(out, expected, rtol=1e-3, atol=1e-4):
+                    raise RuntimeError("compiled decoder does not match eager outputs")
+        except Exception as e:
+            logger.warning(
+                f"Could not {self.backend} the decoder, falling back to eager: {e}"
+            )
+            return eager_fn
+        return fn
+
+    def _trace(self, eager_fn, args, key):
+        path = self._cache_path(key)
+        if path is not None and os.path.exists(path):
+            logger.info(f"Loading the traced decoder from {path}")
+            return torch.jit.load(path, map_location=args[0].device)
+
+        fn = torch.jit.trace(eager_fn, args, check_trace=False)
+        if not self.decoder.training:
+            # Freezing inlines the weights and enables inference-only optimizations
+            fn = torch.jit.freeze(fn)
+        if path is not None:
+            # Write atomically as several jobs may share the cache
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.jit.save(fn, tmp_path)
+            os.replace(tmp_path, path)
+        return fn
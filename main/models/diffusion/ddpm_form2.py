@@ -1,5 +1,11 @@
 import torch
 import torch.nn as nn
+from models.diffusion.sampling import (
+    get_sampler_plan,
+    GuidedDecoder,
+    p_sample_loop,
+)
+from models.diffusion.schedule import get_noise_schedule
 
 
 def extract(a, t, x_shape):
@@ -24,136 +30,21 @@ class DDPMv2(nn.Module):
         self.beta_2 = beta_2
         self.var_type = var_type
 
-        # Main constants
-        self.register_buffer(
-            "betas", torch.linspace(self.beta_1, self.beta_2, steps=self.T).double()
-        )
-        dev = self.betas.device
-        alphas = 1.0 - self.betas
-        alpha_bar = torch.cumprod(alphas, dim=0)
-        alpha_bar_shifted = torch.cat([torch.tensor([1.0], device=dev), alpha_bar[:-1]])
-
-        assert alpha_bar_shifted.shape == torch.Size(
-            [
-                self.T,
-            ]
-        )
-
-        # Auxillary consts
-        self.register_buffer("sqrt_alpha_bar", torch.sqrt(alpha_bar))
-        self.register_buffer("minus_sqrt_alpha_bar", torch.sqrt(1.0 - alpha_bar))
-        self.register_buffer("sqrt_recip_alphas_cumprod", torch.sqrt(1.0 / alpha_bar))
-        self.register_buffer(
-            "sqrt_recipm1_alphas_cumprod", torch.sqrt(1.0 / alpha_bar - 1)
-        )
-
-        # Posterior q(x_t-1|x_t,x_0,t) covariance of the forward process
-        self.register_buffer(
-            "post_variance", self.betas * (1.0 - alpha_bar_shifted) / (1.0 - alpha_bar)
-        )
-        # Clipping because post_variance is 0 before the chain starts
-        self.register_buffer(
+        # Schedule constants (shared between all modules with the same schedule)
+        self.schedule = get_noise_schedule(self.T, self.beta_1, self.beta_2)
+        for name in [
+            "betas",
+            "sqrt_alpha_bar",
+            "minus_sqrt_alpha_bar",
+            "sqrt_recip_alphas_cumprod",
+            "sqrt_recipm1_alphas_cumprod",
+            "post_variance",
             "post_log_variance_clipped",
-            torch.log(
-                torch.cat(
-                    [
-                        torch.tensor([self.post_variance[1]], device=dev),
-                        self.post_variance[1:],
-                    ]
-                )
-            ),
-        )
-
-        # q(x_t-1 | x_t, x_0) mean coefficients
-        self.register_buffer(
             "post_coeff_1",
-            self.betas * torch.sqrt(alpha_bar_shifted) / (1.0 - alpha_bar),
-        )
-        self.register_buffer(
             "post_coeff_2",
-            torch.sqrt(alphas) * (1 - alpha_bar_shifted) / (1 - alpha_bar),
-        )
-        self.register_buffer(
             "post_coeff_3",
-            1 - self.post_coeff_2,
-        )
-
-    def _predict_xstart_from_eps(self, x_t, t, eps, cond=None):
-        assert x_t.shape == eps.shape
-        x_hat = 0 if cond is None else cond
-        assert x_hat.shape == x_t.shape
-        return (
-            extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_hat
-            - extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
-        )
-
-    def get_posterior_mean_covariance(
-        self, x_t, t, clip_denoised=True, cond=None, z_vae=None, guidance_weight=0.0
-    ):
-        B = x_t.size(0)
-        t_ = torch.full((x_t.size(0),), t, device=x_t.device, dtype=torch.long)
-        assert t_.shape == torch.Size(
-            [
-                B,
-            ]
-        )
-        x_hat = 0 if cond is None else cond
-
-        # Compute updated score
-        if guidance_weight == 0:
-            eps_score = self.decoder(x_t, t_, low_res=cond, z=z_vae)
-        else:
-            eps_score = (1 + guidance_weight) * self.decoder(
-                x_t, t_, low_res=cond, z=z_vae
-            ) - guidance_weight * self.decoder(
-                x_t,
-                t_,
-                low_res=torch.zeros_like(cond),
-                z=torch.zeros_like(z_vae) if z_vae is not None else None,
-            )
-        # Generate the reconstruction from x_t
-        x_recons = self._predict_xstart_from_eps(x_t, t_, eps_score, cond=cond)
-
-        # Clip
-        if clip_denoised:
-            x_recons.clamp_(-1.0, 1.0)
-
-        # Compute posterior mean from the reconstruction
-        post_mean = (
-            extract(self.post_coeff_1, t_, x_t.shape) * x_recons
-            + extract(self.post_coeff_2, t_, x_t.shape) * x_t
-            + extract(self.post_coeff_3, t_, x_t.shape) * x_hat
-        )
-
-        # Extract posterior variance
-        p_variance, p_log_variance = {
-            # for fixedlarge, we set the initial (log-)variance like so
-            # to get a better decoder log likelihood.
-            "fixedlarge": (
-                torch.cat(
-                    [
-                        torch.tensor([self.post_variance[1]], device=x_t.device),
-                        self.betas[1:],
-                    ]
-                ),
-                torch.log(
-                    torch.cat(
-                        [
-                            torch.tensor([self.post_variance[1]], device=x_t.device),
-                            self.betas[1:],
-                        ]
-                    )
-                ),
-            ),
-            "fixedsmall": (
-                self.post_variance,
-                self.post_log_variance_clipped,
-            ),
-        }[self.var_type]
-        post_variance = extract(p_variance, t_, x_t.shape)
-        post_log_variance = extract(p_log_variance, t_, x_t.shape)
-        return post_mean, post_variance, post_log_variance
+        ]:
+            self.register_buffer(name, getattr(self.schedule, name).clone())
 
     def sample(
         self,
@@ -164,53 +55,29 @@ class DDPMv2(nn.Module):
         guidance_weight=0.0,
         checkpoints=[],
         ddpm_latents=None,
+        callback=None,
+        noise_fn=None,
     ):
         # The sampling process goes here. This sampler also supports truncated sampling.
         # For spaced sampling (used in DDIM etc.) see SpacedDiffusion model in spaced_diff.py
-        x = x_t
-        B, *_ = x_t.shape
-        sample_dict = {}
-
-        if ddpm_latents is not None:
-            ddpm_latents = ddpm_latents.to(x_t.device)
-
-        num_steps = self.T if n_steps is None else n_steps
-        checkpoints = [num_steps] if checkpoints == [] else checkpoints
-        for idx, t in enumerate(reversed(range(0, num_steps))):
-            z = (
-                torch.randn_like(x_t)
-                if ddpm_latents is None
-                else torch.stack([ddpm_latents[idx]] * B)
-            )
-            (
-                post_mean,
-                post_variance,
-                post_log_variance,
-            ) = self.get_posterior_mean_covariance(
-                x,
-                t,
+        plan = get_sampler_plan(self, device=x_t.device)
+        return p_sample_loop(
+            plan,
+            GuidedDecoder(
+                self.decoder,
                 cond=cond,
                 z_vae=z_vae,
                 guidance_weight=guidance_weight,
-            )
-            nonzero_mask = (
-                torch.tensor(t != 0, device=x.device)
-                .float()
-                .view(-1, *([1] * (len(x_t.shape) - 1)))
-            )  # no noise when t == 0
-
-            # Langevin step!
-            x = post_mean + nonzero_mask * torch.exp(0.5 * post_log_variance) * z
-
-            if t == 0:
-                # NOTE: In the final step we remove the vae reconstruction bias
-                # added to the images as it degrades quality
-                x -= cond
-
-            # Add results
-            if idx + 1 in checkpoints:
-                sample_dict[str(idx + 1)] = x
-        return sample_dict
+                timesteps=plan.timesteps,
+            ),
+            x_t,
+            num_steps=n_steps,
+            x_hat=cond,
+            checkpoints=checkpoints,
+            ddpm_latents=ddpm_latents,
+            callback=callback,
+            noise_fn=noise_fn,
+        )
 
     def compute_noisy_input(self, x_start, eps, t, low_res=None):
         assert eps.shape == x_start.shape
@@ -0,0 +1,170 @@
+import torch
+from models.diffusion.ddpm_form2 import DDPMv2
+from models.diffusion.wrapper import DDPMWrapper
+from util import space_timesteps
+
+
+class DistillWrapper(DDPMWrapper):
+    """
+    Distills a trained DDPM (the teacher) into a smaller student decoder (e.g. a
+    narrower or shallower UNet) by regressing the noise predictions of the
+    teacher on the same noisy inputs and VAE conditioning.
+
+    The teacher is not registered as a submodule, so the checkpoints of this
+    module have the same keys as a DDPMWrapper with the student decoder and can
+    be loaded (and sampled from) by the DDPM eval scripts.
+    :param teacher_network: the trained DDPM (or DDPMv2), usually the EMA network
+                            of a DDPMWrapper. Must use the same noise schedule and
+                            formulation as the student.
+    :param data_loss_weight: weight of the standard denoising loss on the true
+                             noise, added to the distillation loss.
+    """
+
+    def __init__(self, teacher_network, *args, data_loss_weight=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        assert type(teacher_network) is type(self.online_network)
+        assert teacher_network.T == self.online_network.T
+        self.data_loss_weight = data_loss_weight
+
+        # NOTE: Kept in a list to hide the teacher from the module tree (and
+        # the state dict)
+        self._teacher = [teacher_network.eval().requires_grad_(False)]
+
+    @property
+    def teacher_network(self):
+        return self._teacher[0]
+
+    def on_train_start(self):
+        self.teacher_network.to(self.device)
+
+    def distill_loss(self, x, cond=None, z=None):
+        # Sample timepoints and noise
+        t = torch.randint(
+            0, self.online_network.T, size=(x.size(0),), device=self.device
+        )
+        eps = torch.randn_like(x)
+
+        # Teacher and student predictions on the same noisy input
+        with torch.no_grad():
+            eps_teacher = self.teacher_network(x, eps, t, low_res=cond, z=z)
+        eps_pred = self.online_network(x, eps, t, low_res=cond, z=z)
+
+        loss = self.criterion(eps_teacher, eps_pred)
+        self.log("distill_loss", loss, prog_bar=True)
+        if self.data_loss_weight > 0:
+            loss = loss + self.data_loss_weight * self.criterion(eps, eps_pred)
+        return loss
+
+    def training_step(self, batch, batch_idx):
+        # Optimizers
+        optim = self.optimizers()
+        lr_sched = self.lr_schedulers()
+
+        x, *cached = batch if isinstance(batch, (list, tuple)) else [batch]
+        cond, z = self.get_train_cond(x, *cached)
+        loss = self.distill_loss(x, cond=cond, z=z.squeeze() if self.z_cond else None)
+
+        # Clip gradients and Optimize
+        optim.zero_grad()
+        self.manual_backward(loss)
+        torch.nn.utils.clip_grad_norm_(
+            self.online_network.decoder.parameters(), self.grad_clip_val
+        )
+        optim.step()
+
+        # Scheduler step
+        lr_sched.step()
+        self.log("loss", loss, prog_bar=True)
+        return loss
+
+
+class ProgressiveDistillWrapper(DistillWrapper):
+    """
+    One stage of progressive distillation (Salimans & Ho): trains a student to
+    match two deterministic DDIM steps of the teacher with a single DDIM step,
+    halving the number of sampling steps. The teacher samples with 2 * n_steps
+    and the student with n_steps 'trailing' spaced timesteps, so that every
+    student step spans exactly two teacher steps. The student (usually
+    initialized from the teacher) is then sampled with
+    resample_strategy='spaced', skip_strategy='trailing' and sample_method='ddim'.
+
+    Supports both formulations, in which case the DDIM steps are taken on
+    x_t - cond. The loss is the squared error of the x_0 predictions weighted by
+    max(SNR, 1) as in the paper.
+    :param n_steps: the number of sampling steps of the student.
+    """
+
+    def __init__(self, teacher_network, *args, n_steps=None, **kwargs):
+        super().__init__(teacher_network, *args, **kwargs)
+        T = self.online_network.T
+        teacher_timesteps = space_timesteps(T, 2 * n_steps, type="trailing")
+        if len(set(teacher_timesteps)) != 2 * n_steps:
+            raise ValueError(f"cannot distill {T} timesteps into {n_steps} steps")
+        self.n_steps = n_steps
+        self.pred_steps = n_steps
+        self.skip_strategy = "trailing"
+
+        # Student step i goes from timestep teacher_timesteps[2i + 1] through the
+        # intermediate teacher timestep teacher_timesteps[2i] to
+        # teacher_timesteps[2i - 1] (or to the data, denoted by -1, for i = 0)
+        self.step_timesteps = teacher_timesteps[1::2]
+        self.mid_timesteps = teacher_timesteps[0::2]
+        self.prev_timesteps = [-1] + teacher_timesteps[1:-1:2]
+
+    def _ddim_step(self, decoder, x_t, t, t_prev, alpha_bar, cond=None, z=None):
+        # Deterministic DDIM step from t to t_prev as in `ddim_sample_loop`
+        x_hat = 0 if cond is None or not self.is_form2 else cond
+        a_t, s_t = self._coeffs(alpha_bar, t)
+        a_prev, s_prev = self._coeffs(alpha_bar, t_prev)
+        eps = decoder(x_t, t, low_res=cond, z=z)
+        x_recons = ((x_t - x_hat - s_t * eps) / a_t).clamp(-1.0, 1.0)
+        return a_prev * x_recons + s_prev * eps + x_hat
+
+    def _coeffs(self, alpha_bar, t):
+        # sqrt(alpha_bar_t) and sqrt(1 - alpha_bar_t) with alpha_bar_{-1} = 1
+        a = alpha_bar[t + 1].view(-1, 1, 1, 1)
+        return torch.sqrt(a), torch.sqrt(1 - a)
+
+    @property
+    def is_form2(self):
+        return isinstance(self.online_network, DDPMv2)
+
+    def distill_loss(self, x, cond=None, z=None):
+        B = x.size(0)
+        alpha_bar = torch.cat(
+            [x.new_ones(1), self.online_network.schedule.alpha_bar.to(x)]
+        )
+
+        # Sample the student steps and the noisy inputs
+        idx = torch.randint(0, self.n_steps, size=(B,))
+        t, t_mid, t_prev = [
+            torch.tensor(timesteps, device=self.device)[idx]
+            for timesteps in [
+                self.step_timesteps,
+                self.mid_timesteps,
+                self.prev_timesteps,
+            ]
+        ]
+        x_hat = 0 if cond is None or not self.is_form2 else cond
+        a_t, s_t = self._coeffs(alpha_bar, t)
+        x_t = a_t * x + s_t * torch.randn_like(x) + x_hat
+
+        # Two teacher DDIM steps
+        teacher = self.teacher_network.decoder
+        with torch.no_grad():
+            x_mid = self._ddim_step(teacher, x_t, t, t_mid, alpha_bar, cond, z)
+            x_prev = self._ddim_step(teacher, x_mid, t_mid, t_prev, alpha_bar, cond, z)
+
+            # The x_0 for which a single DDIM step from t lands on x_prev
+            a_prev, s_prev = self._coeffs(alpha_bar, t_prev)
+            ratio = s_prev / s_t
+            x_target = (x_prev - x_hat - ratio * (x_t - x_hat)) / (a_prev - ratio * a_t)
+
+        # Student x_0 prediction (single step)
+        eps_pred = self.online_network.decoder(x_t, t, low_res=cond, z=z)
+        x_pred = (x_t - x_hat - s_t * eps_pred) / a_t
+
+        weight = torch.clamp(a_t**2 / s_t**2, min=1.0).view(-1)
+        loss = (weight * (x_pred - x_target).square().mean(dim=(1, 2, 3))).mean()
+        self.log("distill_loss", loss, prog_bar=True)
+        return loss
@@ -0,0 +1,106 @@
+import math
+import operator
+from functools import reduce
+
+import torch
+
+# Independent noise streams drawn from the same (seed, sample index) key
+Z_VAE_STREAM = 0
+Z_DDPM_STREAM = 1
+SAMPLER_STREAM = 2
+EXPDE_COMPONENT_STREAM = 3
+
+_MASK_32 = 0xFFFFFFFF
+
+
+def _hash32(x):
+    # lowbias32 integer hash (Chris Wellons) on int64 tensors holding uint32 values.
+    # Products may wrap around in int64 but their low 32 bits are still exact.
+    x = x & _MASK_32
+    x = x ^ (x >> 16)
+    x = (x * 0x7FEB352D) & _MASK_32
+    x = x ^ (x >> 15)
+    x = (x * 0x846CA68B) & _MASK_32
+    x = x ^ (x >> 16)
+    return x
+
+
+def _counter_key(seed, stream, indices, step):
+    key = _hash32(torch.full_like(indices, int(seed)))
+    key = _hash32(key ^ int(stream))
+    key = _hash32(key ^ indices)
+    return _hash32(key ^ int(step))
+
+
+def counter_rand(seed, indices, step=0, stream=SAMPLER_STREAM, device=None):
+    """
+    Uniform [0, 1) float64 noise with one value per sample index, computed like
+    `counter_randn`.
+    :return: a tensor of shape (len(indices),), or a scalar tensor for an int index.
+    """
+    scalar = not torch.is_tensor(indices)
+    indices = torch.as_tensor(indices, dtype=torch.long, device=device).view(-1)
+    u = _counter_key(seed, stream, indices, step).double() / 2.0**32
+    return u[0] if scalar else u
+
+
+def counter_randn(
+    seed, indices, shape, step=0, stream=SAMPLER_STREAM, device=None, dtype=None
+):
+    """
+    Standard normal noise computed as a pure function of (seed, stream, sample
+    index, step, element) using a counter-based hash and the Box-Muller transform.
+    Unlike torch.randn, the noise of a sample does not depend on the batch it is
+    drawn in or on the partitioning of the samples across processes.
+    :param seed: the global noise seed.
+    :param indices: an int or a 1-D tensor of global sample indices.
+    :param shape: the per-sample shape of the noise.
+    :param step: the sampler step the noise is drawn for.
+    :param stream: the noise stream, used to decorrelate the different latents of
+                   a sample.
+    :return: a tensor of shape (len(indices), *shape), or shape for an int index.
+    """
+    scalar = not torch.is_tensor(indices)
+    indices = torch.as_tensor(indices, dtype=torch.long, device=device).view(-1, 1)
+    shape = tuple(shape)
+    numel = reduce(operator.mul, shape, 1)
+    n_pairs = (numel + 1) // 2
+
+    key = _counter_key(seed, stream, indices, step)
+
+    # Hashing the element counter before mixing in the key avoids two keys that
+    # differ in their low bits yielding shifted copies of the same stream
+    counter = 2 * torch.arange(n_pairs, dtype=torch.long, device=indices.device)
+    u1 = (_hash32(key ^ _hash32(counter)) + 1).double() / 2.0**32
+    u2 = _hash32(key ^ _hash32(counter + 1)).double() / 2.0**32
+
+    r = torch.sqrt(-2.0 * torch.log(u1))
+    theta = 2.0 * math.pi * u2
+    z = torch.cat([r * torch.cos(theta), r * torch.sin(theta)], dim=1)[:, :numel]
+    z = z.to(torch.get_default_dtype() if dtype is None else dtype)
+    z = z.view(-1, *shape)
+    return z[0] if scalar else z
+
+
+class CounterNoise:
+    """
+    Sampler noise keyed by (global sample index, step), see `counter_randn`. Used
+    as the `noise_fn` of the sampling loops for reproducible sharded sampling.
+    :param seed: the global noise seed.
+    :param indices: a 1-D tensor with the global index of each sample in the batch.
+    """
+
+    def __init__(self, seed, indices):
+        self.seed = seed
+        self.indices = indices
+
+    def __call__(self, step, x):
+        return counter_randn(
+            self.seed,
+            self.indices.to(x.device),
+            x.shape[1:],
+            step=step,
+            stream=SAMPLER_STREAM,
+            device=x.device,
+            dtype=x.dtype,
+        )
@@ -0,0 +1,457 @@
+from collections import namedtuple
+
+import torch
+
+StepCoefficients = namedtuple(
+    "StepCoefficients",
+    [
+        "sqrt_recip_alphas_cumprod",
+        "sqrt_recipm1_alphas_cumprod",
+        "post_coeff_1",
+        "post_coeff_2",
+        "post_coeff_3",
+        "post_variance",
+        "post_log_variance",
+        "noise_std",
+        "sqrt_alpha_bar_prev",
+        "ddim_sigma",
+        "ddim_eps_coeff",
+        "log_snr",
+        "dpm_x_coeff",
+        "dpm_x0_coeff",
+    ],
+)
+
+
+class SamplerPlan:
+    """
+    Per-step coefficient tables of a diffusion process. A plan is built once for a
+    given (schedule, var_type, eta, device) and lets the sampling loops index plain
+    python scalars instead of gathering from the schedule buffers at every step.
+    :param schedule: the NoiseSchedule to sample with.
+    :param var_type: the DDPM variance type. One of ['fixedlarge', 'fixedsmall'].
+    :param eta: the DDIM noise scale.
+    :param device: the device on which the model timesteps are stored.
+    """
+
+    def __init__(self, schedule, var_type, eta=0.0, device=None):
+        self.var_type = var_type
+        self.eta = eta
+
+        betas = schedule.betas
+        alpha_bar = schedule.alpha_bar
+        alpha_bar_prev = schedule.alpha_bar_shifted
+        post_variance = schedule.post_variance
+
+        # for fixedlarge, we set the initial (log-)variance like so
+        # to get a better decoder log likelihood.
+        variance = {
+            "fixedlarge": torch.cat([post_variance[1:2], betas[1:]]),
+            "fixedsmall": post_variance,
+        }[self.var_type]
+        # Clipping because post_variance is 0 before the chain starts
+        log_variance = torch.log(torch.cat([post_variance[1:2], variance[1:]]))
+
+        # No noise is added in the last step of the chain
+        noise_std = torch.exp(0.5 * log_variance)
+        noise_std[0] = 0.0
+
+        # DDIM (Song et al.) Equation 12
+        ddim_sigma = (
+            eta
+            * torch.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
+            * torch.sqrt(1 - alpha_bar / alpha_bar_prev)
+        )
+        ddim_sigma[0] = 0.0
+        ddim_eps_coeff = torch.sqrt(1 - alpha_bar_prev - ddim_sigma**2)
+
+        # DPM-Solver++ (Lu et al.) first order update coefficients written without
+        # the half log-SNR lambda_t, which is infinite at the end of the chain
+        sigma, sigma_prev = schedule.minus_sqrt_alpha_bar, torch.sqrt(
+            1 - alpha_bar_prev
+        )
+        log_snr = torch.log(schedule.sqrt_alpha_bar / sigma)
+        dpm_x_coeff = sigma_prev / sigma
+        dpm_x0_coeff = (
+            torch.sqrt(alpha_bar_prev) - dpm_x_coeff * schedule.sqrt_alpha_bar
+        )
+
+        self.coeffs = torch.stack(
+            [
+                schedule.sqrt_recip_alphas_cumprod,
+                schedule.sqrt_recipm1_alphas_cumprod,
+                schedule.post_coeff_1,
+                schedule.post_coeff_2,
+                schedule.post_coeff_3,
+                variance,
+                log_variance,
+                noise_std,
+                torch.sqrt(alpha_bar_prev),
+                ddim_sigma,
+                ddim_eps_coeff,
+                log_snr,
+                dpm_x_coeff,
+                dpm_x0_coeff,
+            ],
+            dim=1,
+        ).contiguous()
+        self.steps = [StepCoefficients(*row) for row in self.coeffs.tolist()]
+
+        # Timesteps seen by the decoder (these differ from the step index for spaced sampling)
+        self.timesteps = torch.as_tensor(
+            schedule.timestep_map, dtype=torch.long, device=device
+        )
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, t):
+        return self.steps[t]
+
+    def model_timesteps(self, t, batch_size):
+        # Zero-copy batch of decoder timesteps for step t
+        return self.timesteps[t : t + 1].expand(batch_size)
+
+
+def get_sampler_plan(diffusion, eta=0.0, device=None):
+    """
+    Returns the SamplerPlan of `diffusion` for the given eta and device. Plans are
+    memoized on the (shared) noise schedule of the diffusion process.
+    """
+    device = device if device is not None else diffusion.betas.device
+    return diffusion.schedule.get_plan(diffusion.var_type, eta=eta, device=device)
+
+
+class GuidedDecoder:
+    """
+    Predicts the noise in x_t with the decoder, optionally using classifier-free
+    guidance. For guided sampling, the conditional and unconditional branches are
+    evaluated in a single decoder call on a batch of size 2B, and the zeroed
+    unconditional inputs are built once per sampling run. If the decoder supports
+    it (see UNetModel.embed_timesteps/embed_z), the timestep embeddings of the
+    schedule and the projection of z_vae are also computed once per run and
+    looked up at every step, and the upsampled cond is written once into an input
+    buffer that x_t is copied into at every step (see SuperResModel.prepare_input).
+    :param decoder: the noise prediction network.
+    :param cond: the conditioning signal (VAE reconstruction), if any.
+    :param z_vae: the VAE latent code, if any.
+    :param guidance_weight: the classifier-free guidance weight.
+    :param timesteps: the 1-D tensor of decoder timesteps used in this run, if
+        known upfront.
+    """
+
+    def __init__(
+        self, decoder, cond=None, z_vae=None, guidance_weight=0.0, timesteps=None
+    ):
+        self.decoder = decoder
+        self.guidance_weight = guidance_weight
+        self.cond = cond
+        self.z_vae = z_vae
+
+        if guidance_weight != 0:
+            if cond is not None:
+                self.cond = torch.cat([cond, torch.zeros_like(cond)])
+            if z_vae is not None:
+                self.z_vae = torch.cat([z_vae, torch.zeros_like(z_vae)])
+
+        # z_vae is constant across the sampling steps
+        self.z_emb = None
+        if self.z_vae is not None and hasattr(decoder, "embed_z"):
+            self.z_emb = decoder.embed_z(self.z_vae)
+
+        # Embedding table of the schedule timesteps, indexed by decoder timestep
+        self.time_emb_table = None
+        if timesteps is not None and hasattr(decoder, "embed_timesteps"):
+            self.time_emb_table = decoder.embed_timesteps(timesteps)
+            self.time_emb_index = torch.zeros(
+                int(timesteps.max()) + 1, dtype=torch.long, device=timesteps.device
+            )
+            self.time_emb_index[timesteps] = torch.arange(
+                len(timesteps), device=timesteps.device
+            )
+
+        self.prepared_input = None
+        self.use_prepared_input = self.cond is not None and hasattr(
+            decoder, "prepare_input"
+        )
+
+    def _decode(self, x, t):
+        kwargs = {"low_res": self.cond}
+        if self.use_prepared_input:
+            kwargs = {"prepared_input": self._prepared_input(x.shape)}
+        if self.z_emb is not None:
+            kwargs["z_emb"] = self.z_emb
+        else:
+            kwargs["z"] = self.z_vae
+        if self.time_emb_table is not None:
+            kwargs["time_emb"] = self.time_emb_table[self.time_emb_index[t]]
+        return self.decoder(x, t, **kwargs)
+
+    def _prepared_input(self, shape):
+        # Allocated on the first step, shape is that of the (batched) decoder input
+        if self.prepared_input is None or self.prepared_input.shape[0] != shape[0]:
+            self.prepared_input = self.decoder.prepare_input(self.cond, shape)
+        return self.prepared_input
+
+    def __call__(self, x, t):
+        if self.guidance_weight == 0:
+            return self._decode(x, t)
+
+        if self.use_prepared_input:
+            # Write both guidance branches in place instead of concatenating
+            B, C, *spatial = x.shape
+            prepared_input = self._prepared_input((2 * B, C, *spatial))
+            prepared_input[:B, :C].copy_(x)
+            prepared_input[B:, :C].copy_(x)
+            x = prepared_input[:, :C]
+        else:
+            x = torch.cat([x, x])
+        eps_cond, eps_uncond = self._decode(x, torch.cat([t, t])).chunk(2)
+        return eps_cond.mul_(1 + self.guidance_weight).sub_(
+            eps_uncond, alpha=self.guidance_weight
+        )
+
+
+def predict_xstart(x, eps, coeffs, x_hat=None, clip_denoised=True):
+    # Generate the reconstruction from x_t
+    if x_hat is not None:
+        x = x - x_hat
+    x_recons = torch.add(
+        x * coeffs.sqrt_recip_alphas_cumprod,
+        eps,
+        alpha=-coeffs.sqrt_recipm1_alphas_cumprod,
+    )
+    if clip_denoised:
+        x_recons.clamp_(-1.0, 1.0)
+    return x_recons
+
+
+def posterior_mean(x_recons, x, coeffs, x_hat=None):
+    # Compute posterior mean from the reconstruction
+    post_mean = torch.add(x_recons * coeffs.post_coeff_1, x, alpha=coeffs.post_coeff_2)
+    if x_hat is not None:
+        post_mean.add_(x_hat, alpha=coeffs.post_coeff_3)
+    return post_mean
+
+
+def ddim_mean(x_recons, eps, coeffs, x_hat=None):
+    mean_pred = torch.add(
+        x_recons * coeffs.sqrt_alpha_bar_prev, eps, alpha=coeffs.ddim_eps_coeff
+    )
+    if x_hat is not None:
+        # NOTE: The x_hat coefficients of the form-2 DDIM update sum up to one
+        mean_pred.add_(x_hat)
+    return mean_pred
+
+
+def p_sample_loop(
+    plan,
+    eps_fn,
+    x_t,
+    num_steps=None,
+    x_hat=None,
+    clip_denoised=True,
+    checkpoints=[],
+    ddpm_latents=None,
+    callback=None,
+    noise_fn=None,
+):
+    """
+    Ancestral (DDPM) sampling loop shared by all the diffusion formulations.
+    :param plan: the SamplerPlan to sample with.
+    :param eps_fn: a callable mapping (x, decoder timesteps) to the predicted noise,
+        usually a GuidedDecoder.
+    :param x_hat: the VAE reconstruction for formulation-2 models, None otherwise.
+    :param callback: if specified, a callable invoked with (step, x) as soon as each
+        checkpoint is reached. Checkpoints are then streamed to the callback instead
+        of being retained in the returned dict.
+    :param noise_fn: if specified, a callable mapping (step, x) to the noise drawn
+        at that step, e.g. a CounterNoise. Defaults to torch.randn_like.
+    """
+    x = x_t
+    B, *_ = x_t.shape
+    sample_dict = {}
+
+    if ddpm_latents is not None:
+        # No-op when the latents already live on the sampling device
+        ddpm_latents = ddpm_latents.to(device=x_t.device, dtype=x_t.dtype)
+
+    num_steps = len(plan) if num_steps is None else num_steps
+    checkpoints = [num_steps] if checkpoints == [] else checkpoints
+    for idx, t in enumerate(reversed(range(0, num_steps))):
+        if ddpm_latents is not None:
+            z = ddpm_latents[idx].expand_as(x_t)
+        elif noise_fn is not None:
+            z = noise_fn(idx, x_t)
+        else:
+            z = torch.randn_like(x_t)
+        assert z.shape == x_t.shape
+        coeffs = plan[t]
+        eps = eps_fn(x, plan.model_timesteps(t, B))
+        x_recons = predict_xstart(
+            x, eps, coeffs, x_hat=x_hat, clip_denoised=clip_denoised
+        )
+
+        # Langevin step!
+        x = posterior_mean(x_recons, x, coeffs, x_hat=x_hat)
+        if coeffs.noise_std != 0:
+            x.add_(z, alpha=coeffs.noise_std)
+
+        if t == 0 and x_hat is not None:
+            # NOTE: In the final step we remove the vae reconstruction bias
+            # added to the images as it degrades quality
+            x -= x_hat
+
+        # Add results
+        if idx + 1 in checkpoints:
+            if callback is not None:
+                callback(idx + 1, x)
+            else:
+                sample_dict[str(idx + 1)] = x
+    return sample_dict
+
+
+def ddim_sample_loop(
+    plan,
+    eps_fn,
+    x_t,
+    x_hat=None,
+    clip_denoised=True,
+    checkpoints=[],
+    callback=None,
+    noise_fn=None,
+):
+    """
+    DDIM sampling loop shared by all the spaced diffusion formulations.
+    """
+    x = x_t
+    B, *_ = x_t.shape
+    sample_dict = {}
+
+    num_steps = len(plan)
+    checkpoints = [num_steps] if checkpoints == [] else checkpoints
+    for idx, t in enumerate(reversed(range(0, num_steps))):
+        z = torch.randn_like(x_t) if noise_fn is None else noise_fn(idx, x_t)
+        coeffs = plan[t]
+        eps = eps_fn(x, plan.model_timesteps(t, B))
+        x_recons = predict_xstart(
+            x, eps, coeffs, x_hat=x_hat, clip_denoised=clip_denoised
+        )
+
+        x = ddim_mean(x_recons, eps, coeffs, x_hat=x_hat)
+        if coeffs.ddim_sigma != 0:
+            x.add_(z, alpha=coeffs.ddim_sigma)
+
+        if t == 0 and x_hat is not None:
+            # NOTE: In the final step we remove the vae reconstruction bias
+            # added to the images as it degrades quality
+            x -= x_hat
+
+        # Add results
+        if idx + 1 in checkpoints:
+            if callback is not None:
+                callback(idx + 1, x)
+            else:
+                sample_dict[str(idx + 1)] = x
+    return sample_dict
+
+
+def plms_sample_loop(
+    plan, eps_fn, x_t, x_hat=None, clip_denoised=True, checkpoints=[], callback=None
+):
+    """
+    Pseudo linear multistep (PLMS) sampling loop from PNDM (Liu et al.). The noise
+    used in each deterministic DDIM update is a linear multistep combination of the
+    current and the (up to three) past eps predictions, so every step costs a
+    single network evaluation.
+    """
+    x = x_t
+    B, *_ = x_t.shape
+    sample_dict = {}
+    eps_history = []
+
+    num_steps = len(plan)
+    checkpoints = [num_steps] if checkpoints == [] else checkpoints
+    for idx, t in enumerate(reversed(range(0, num_steps))):
+        coeffs = plan[t]
+        eps = eps_fn(x, plan.model_timesteps(t, B))
+
+        # Linear multistep (Adams-Bashforth) combination of the eps predictions
+        if len(eps_history) == 0:
+            eps_prime = eps
+        elif len(eps_history) == 1:
+            eps_prime = (3 * eps - eps_history[-1]) / 2
+        elif len(eps_history) == 2:
+            eps_prime = (23 * eps - 16 * eps_history[-1] + 5 * eps_history[-2]) / 12
+        else:
+            eps_prime = (
+                55 * eps
+                - 59 * eps_history[-1]
+                + 37 * eps_history[-2]
+                - 9 * eps_history[-3]
+            ) / 24
+        eps_history = eps_history[-2:] + [eps]
+
+        x_recons = predict_xstart(
+            x, eps_prime, coeffs, x_hat=x_hat, clip_denoised=clip_denoised
+        )
+        x = ddim_mean(x_recons, eps_prime, coeffs, x_hat=x_hat)
+
+        if t == 0 and x_hat is not None:
+            # NOTE: In the final step we remove the vae reconstruction bias
+            # added to the images as it degrades quality
+            x -= x_hat
+
+        # Add results
+        if idx + 1 in checkpoints:
+            if callback is not None:
+                callback(idx + 1, x)
+            else:
+                sample_dict[str(idx + 1)] = x
+    return sample_dict
+
+
+def dpm_solver_sample_loop(
+    plan, eps_fn, x_t, x_hat=None, clip_denoised=True, checkpoints=[], callback=None
+):
+    """
+    Multistep second order DPM-Solver++ (2M) sampling loop (Lu et al.). The
+    solver integrates the diffusion ODE in terms of the (clipped) x_0 predictions,
+    reusing the prediction of the previous step for the second order correction.
+    For formulation-2 models the ODE is solved for x_t - x_hat.
+    """
+    x = x_t
+    B, *_ = x_t.shape
+    sample_dict = {}
+    x_recons_prev = None
+
+    num_steps = len(plan)
+    checkpoints = [num_steps] if checkpoints == [] else checkpoints
+    for idx, t in enumerate(reversed(range(0, num_steps))):
+        coeffs = plan[t]
+        eps = eps_fn(x, plan.model_timesteps(t, B))
+        x_recons = predict_xstart(
+            x, eps, coeffs, x_hat=x_hat, clip_denoised=clip_denoised
+        )
+
+        # First order updates for the first and the last step of the chain
+        d = x_recons
+        if x_recons_prev is not None and t != 0:
+            h = plan[t - 1].log_snr - coeffs.log_snr
+            h_last = coeffs.log_snr - plan[t + 1].log_snr
+            r = h_last / h
+            d = torch.add(x_recons * (1 + 0.5 / r), x_recons_prev, alpha=-0.5 / r)
+        x_recons_prev = x_recons
+
+        y = x if x_hat is None else x - x_hat
+        x = torch.add(y * coeffs.dpm_x_coeff, d, alpha=coeffs.dpm_x0_coeff)
+        if x_hat is not None and t != 0:
+            x.add_(x_hat)
+
+        # Add results
+        if idx + 1 in checkpoints:
+            if callback is not None:
+                callback(idx + 1, x)
+            else:
+                sample_dict[str(idx + 1)] = x
+    return sample_dict
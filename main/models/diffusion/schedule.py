@@ -0,0 +1,96 @@
+from functools import lru_cache
+
+import torch
+from models.diffusion.sampling import SamplerPlan
+
+
+class NoiseSchedule:
+    """
+    The (double precision) constants of a linear beta schedule, optionally
+    restricted to a subset of its timesteps as in spaced sampling. Schedules are
+    immutable and shared between all the diffusion modules that use them, see
+    `get_noise_schedule`.
+    :param T: the number of diffusion steps of the base process.
+    :param beta_1: the first beta of the base process.
+    :param beta_2: the last beta of the base process.
+    :param timesteps: a sorted tuple of the base timesteps to retain, or None to
+                      keep all of them.
+    """
+
+    def __init__(self, T, beta_1, beta_2, timesteps=None):
+        self.T = T
+        self.beta_1 = beta_1
+        self.beta_2 = beta_2
+
+        betas = torch.linspace(beta_1, beta_2, steps=T).double()
+        alpha_bar = torch.cumprod(1.0 - betas, dim=0)
+        if timesteps is not None:
+            # Respace the base process by keeping the alpha_bar of the retained steps
+            timestep_map = torch.as_tensor(timesteps, dtype=torch.long)
+            alpha_bar = alpha_bar[timestep_map]
+            betas = 1.0 - alpha_bar / torch.cat(
+                [torch.ones(1, dtype=torch.float64), alpha_bar[:-1]]
+            )
+            timesteps = list(timesteps)
+        self.timestep_map = list(range(T)) if timesteps is None else timesteps
+
+        alphas = 1.0 - betas
+        alpha_bar_shifted = torch.cat(
+            [torch.ones(1, dtype=torch.float64), alpha_bar[:-1]]
+        )
+        self.betas = betas
+        self.alpha_bar = alpha_bar
+        self.alpha_bar_shifted = alpha_bar_shifted
+
+        # Auxillary consts
+        self.sqrt_alpha_bar = torch.sqrt(alpha_bar)
+        self.minus_sqrt_alpha_bar = torch.sqrt(1.0 - alpha_bar)
+        self.sqrt_recip_alphas_cumprod = torch.sqrt(1.0 / alpha_bar)
+        self.sqrt_recipm1_alphas_cumprod = torch.sqrt(1.0 / alpha_bar - 1)
+
+        # Posterior q(x_t-1|x_t,x_0,t) covariance of the forward process
+        self.post_variance = betas * (1.0 - alpha_bar_shifted) / (1.0 - alpha_bar)
+        # Clipping because post_variance is 0 before the chain starts
+        self.post_log_variance_clipped = torch.log(
+            torch.cat([self.post_variance[1:2], self.post_variance[1:]])
+        )
+
+        # q(x_t-1 | x_t, x_0) mean coefficients
+        self.post_coeff_1 = betas * torch.sqrt(alpha_bar_shifted) / (1.0 - alpha_bar)
+        self.post_coeff_2 = (
+            torch.sqrt(alphas) * (1 - alpha_bar_shifted) / (1 - alpha_bar)
+        )
+        self.post_coeff_3 = 1 - self.post_coeff_2
+
+        self._plans = {}
+
+    def __len__(self):
+        return len(self.timestep_map)
+
+    def get_plan(self, var_type, eta=0.0, device=None):
+        """
+        Returns the (memoized) SamplerPlan of this schedule for the given
+        variance type, DDIM eta and device.
+        """
+        device = torch.device("cpu" if device is None else device)
+        key = (var_type, float(eta), device)
+        if key not in self._plans:
+            self._plans[key] = SamplerPlan(self, var_type, eta=eta, device=device)
+        return self._plans[key]
+
+
+@lru_cache(maxsize=64)
+def _noise_schedule(T, beta_1, beta_2, timesteps):
+    return NoiseSchedule(T, beta_1, beta_2, timesteps=timesteps)
+
+
+def get_noise_schedule(T, beta_1, beta_2, use_timesteps=None):
+    """
+    Returns the shared NoiseSchedule keyed by (T, beta_1, beta_2, timestep subset).
+    :param use_timesteps: a collection (sequence or set) of timesteps from the
+                          base process to retain, or None to keep all of them.
+    """
+    timesteps = None
+    if use_timesteps is not None:
+        timesteps = tuple(sorted(set(int(t) for t in use_timesteps if 0 <= t < T)))
+    return _noise_schedule(int(T), float(beta_1), float(beta_2), timesteps)
@@ -1,5 +1,6 @@
 import math
 from abc import abstractmethod
+from typing import Optional
 
 import torch as th
 import torch.nn as nn
@@ -11,6 +12,45 @@ class GroupNorm32(nn.GroupNorm):
         return super().forward(x.float()).type(x.dtype)
 
 
+@th.jit.script
+def group_norm_silu(
+    x: th.Tensor,
+    num_groups: int,
+    weight: Optional[th.Tensor],
+    bias: Optional[th.Tensor],
+    eps: float,
+):
+    # Group statistics are computed on a view of x, which avoids the copy a
+    # reshape would make for channels-last inputs. The normalization, affine and
+    # SiLU are a single elementwise chain that the TorchScript fuser emits as one
+    # kernel (on GPU), so the normalized output is written to memory only once.
+    shape = x.shape
+    xg = x.view([shape[0], num_groups, -1] + shape[2:])
+    dims = [d for d in range(2, xg.dim())]
+    var, mean = th.var_mean(xg, dims, unbiased=False, keepdim=True)
+    h = ((xg - mean) * th.rsqrt(var + eps)).view(shape)
+    param_shape = [shape[1]] + [1] * (len(shape) - 2)
+    if weight is not None:
+        h = h * weight.view(param_shape)
+    if bias is not None:
+        h = h + bias.view(param_shape)
+    return h * th.sigmoid(h)
+
+
+class GroupNormSiLU(GroupNorm32):
+    """
+    A GroupNorm32 followed by a SiLU, computed in float32 by the scripted
+    `group_norm_silu`. Replaces a [GroupNorm32, SiLU] pair in the fused execution
+    mode of UNetModel.
+    """
+
+    def forward(self, x):
+        h = group_norm_silu(
+            x.float(), self.num_groups, self.weight, self.bias, self.eps
+        )
+        return h.type(x.dtype)
+
+
 def conv_nd(dims, *args, **kwargs):
     """
     Create a 1D, 2D, or 3D convolution module.
@@ -92,7 +132,8 @@ def checkpoint(func, inputs, params, flag):
                    explicitly take as arguments.
     :param flag: if False, disable gradient checkpointing.
     """
-    if flag:
+    # Nothing needs to be recomputed when no graph is built (e.g. during sampling)
+    if flag and th.is_grad_enabled():
         args = tuple(inputs) + tuple(params)
         return CheckpointFunction.apply(func, len(inputs), *args)
     else:
@@ -100,11 +141,21 @@ def checkpoint(func, inputs, params, flag):
 
 
 class CheckpointFunction(th.autograd.Function):
+    # NOTE: The RNG and autocast states (including the autocast dtypes) of the
+    # forward pass are restored when recomputing it, so that dropout masks and
+    # compute dtypes match the ones the gradients are taken against.
     @staticmethod
     def forward(ctx, run_function, length, *args):
         ctx.run_function = run_function
         ctx.input_tensors = list(args[:length])
         ctx.input_params = list(args[length:])
+        ctx.gpu_autocast = (th.is_autocast_enabled(), th.get_autocast_gpu_dtype())
+        ctx.cpu_autocast = (th.is_autocast_cpu_enabled(), th.get_autocast_cpu_dtype())
+        ctx.cpu_rng_state = th.get_rng_state()
+        ctx.gpu_devices = sorted(
+            {x.device.index for x in ctx.input_tensors if x.is_cuda}
+        )
+        ctx.gpu_rng_states = [th.cuda.get_rng_state(d) for d in ctx.gpu_devices]
         with th.no_grad():
             output_tensors = ctx.run_function(*ctx.input_tensors)
         return output_tensors
@@ -112,12 +163,20 @@ class CheckpointFunction(th.autograd.Function):
     @staticmethod
     def backward(ctx, *output_grads):
         ctx.input_tensors = [x.detach().requires_grad_(True) for x in ctx.input_tensors]
-        with th.enable_grad():
-            # Fixes a bug where the first op in run_function modifies the
-            # Tensor storage in place, which is not allowed for detach()'d
-            # Tensors.
-            shallow_copies = [x.view_as(x) for x in ctx.input_tensors]
-            output_tensors = ctx.run_function(*shallow_copies)
+        with th.random.fork_rng(devices=ctx.gpu_devices):
+            th.set_rng_state(ctx.cpu_rng_state)
+            for d, state in zip(ctx.gpu_devices, ctx.gpu_rng_states):
+                th.cuda.set_rng_state(state, d)
+            gpu_enabled, gpu_dtype = ctx.gpu_autocast
+            cpu_enabled, cpu_dtype = ctx.cpu_autocast
+            with th.enable_grad(), th.autocast(
+                "cuda", dtype=gpu_dtype, enabled=gpu_enabled
+            ), th.autocast("cpu", dtype=cpu_dtype, enabled=cpu_enabled):
+                # Fixes a bug where the first op in run_function modifies the
+                # Tensor storage in place, which is not allowed for detach()'d
+                # Tensors.
+                shallow_copies = [x.view_as(x) for x in ctx.input_tensors]
+                output_tensors = ctx.run_function(*shallow_copies)
         input_grads = th.autograd.grad(
             output_tensors,
             ctx.input_tensors + ctx.input_params,
@@ -311,7 +370,7 @@ class AttentionBlock(nn.Module):
     https://github.com/hojonathanho/diffusion/blob/1e0dceb3b3495bbe19116a5e1b3596cd0706c543/diffusion_tf/models/unet.py#L66.
     """
 
-    def __init__(self, channels, num_heads=1, use_checkpoint=False):
+    def __init__(self, channels, num_heads=1, use_checkpoint=False, chunk_size=None):
         super().__init__()
         self.channels = channels
         self.num_heads = num_heads
@@ -319,7 +378,7 @@ class AttentionBlock(nn.Module):
 
         self.norm = normalization(channels)
         self.qkv = conv_nd(1, channels, channels * 3, 1)
-        self.attention = QKVAttention()
+        self.attention = QKVAttention(chunk_size=chunk_size)
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
@@ -339,8 +398,15 @@ class AttentionBlock(nn.Module):
 class QKVAttention(nn.Module):
     """
     A module which performs QKV attention.
+    :param chunk_size: if specified, attention is computed over blocks of
+        chunk_size queries and keys with an online softmax, so that the full
+        T x T weight matrix is never materialized.
     """
 
+    def __init__(self, chunk_size=None):
+        super().__init__()
+        self.chunk_size = chunk_size
+
     def forward(self, qkv):
         """
         Apply QKV attention.
@@ -350,12 +416,45 @@ class QKVAttention(nn.Module):
         ch = qkv.shape[1] // 3
         q, k, v = th.split(qkv, ch, dim=1)
         scale = 1 / math.sqrt(math.sqrt(ch))
+        if self.chunk_size and qkv.shape[2] > self.chunk_size:
+            return self._chunked_forward(q * scale, k * scale, v)
         weight = th.einsum(
             "bct,bcs->bts", q * scale, k * scale
         )  # More stable with f16 than dividing afterwards
         weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
         return th.einsum("bts,bcs->bct", weight, v)
 
+    def _chunked_forward(self, q, k, v):
+        # Online softmax over key blocks (as in FlashAttention), accumulated in
+        # float32. Peak memory is O(chunk_size^2) per head instead of O(T^2).
+        length = q.shape[2]
+        out = th.empty_like(v)
+        for q_start in range(0, length, self.chunk_size):
+            q_chunk = q[:, :, q_start : q_start + self.chunk_size]
+            running_max, denom, acc = None, None, None
+            for k_start in range(0, length, self.chunk_size):
+                k_chunk = k[:, :, k_start : k_start + self.chunk_size]
+                v_chunk = v[:, :, k_start : k_start + self.chunk_size].float()
+                weight = th.einsum("bct,bcs->bts", q_chunk, k_chunk).float()
+                chunk_max = weight.amax(dim=-1, keepdim=True)
+                if running_max is None:
+                    new_max = chunk_max
+                else:
+                    new_max = th.maximum(running_max, chunk_max)
+                weight = th.exp(weight - new_max)
+                if running_max is None:
+                    denom = weight.sum(dim=-1, keepdim=True)
+                    acc = th.einsum("bts,bcs->bct", weight, v_chunk)
+                else:
+                    correction = th.exp(running_max - new_max)
+                    denom = denom * correction + weight.sum(dim=-1, keepdim=True)
+                    acc = acc * correction.transpose(1, 2) + th.einsum(
+                        "bts,bcs->bct", weight, v_chunk
+                    )
+                running_max = new_max
+            out[:, :, q_start : q_start + self.chunk_size] = acc / denom.transpose(1, 2)
+        return out
+
 
 class UNetModel(nn.Module):
     """
@@ -375,8 +474,13 @@ class UNetModel(nn.Module):
     :param dims: determines if the signal is 1D, 2D, or 3D.
     :param num_classes: if specified (as an int), then this model will be
         class-conditional with `num_classes` classes.
-    :param use_checkpoint: use gradient checkpointing to reduce memory usage.
+    :param use_checkpoint: use gradient checkpointing to reduce memory usage. Either
+        a bool, or a collection of downsample rates (like attention_resolutions)
+        to only checkpoint the blocks at those resolutions. For example, if this
+        contains 1, then the full-resolution blocks will be checkpointed.
     :param num_heads: the number of attention heads in each attention layer.
+    :param attn_chunk_size: if specified, attention layers are computed in blocks
+        of this many positions to bound their memory, see QKVAttention.
     """
 
     def __init__(
@@ -396,7 +500,8 @@ class UNetModel(nn.Module):
         num_heads=1,
         num_heads_upsample=-1,
         use_scale_shift_norm=False,
-        use_z=False
+        use_z=False,
+        attn_chunk_size=None,
     ):
         super().__init__()
 
@@ -415,6 +520,13 @@ class UNetModel(nn.Module):
         self.use_checkpoint = use_checkpoint
         self.num_heads = num_heads
         self.num_heads_upsample = num_heads_upsample
+        self.dims = dims
+        self.channels_last = False
+
+        def checkpoint_at(ds):
+            if isinstance(use_checkpoint, bool):
+                return use_checkpoint
+            return ds in use_checkpoint
 
         time_embed_dim = model_channels * 4
         self.time_embed = nn.Sequential(
@@ -453,7 +565,7 @@ class UNetModel(nn.Module):
                         dropout,
                         out_channels=mult * model_channels,
                         dims=dims,
-                        use_checkpoint=use_checkpoint,
+                        use_checkpoint=checkpoint_at(ds),
                         use_scale_shift_norm=use_scale_shift_norm,
                     )
                 ]
@@ -461,7 +573,10 @@ class UNetModel(nn.Module):
                 if ds in attention_resolutions:
                     layers.append(
                         AttentionBlock(
-                            ch, use_checkpoint=use_checkpoint, num_heads=num_heads
+                            ch,
+                            use_checkpoint=checkpoint_at(ds),
+                            num_heads=num_heads,
+                            chunk_size=attn_chunk_size,
                         )
                     )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -479,16 +594,21 @@ class UNetModel(nn.Module):
                 time_embed_dim,
                 dropout,
                 dims=dims,
-                use_checkpoint=use_checkpoint,
+                use_checkpoint=checkpoint_at(ds),
                 use_scale_shift_norm=use_scale_shift_norm,
             ),
-            AttentionBlock(ch, use_checkpoint=use_checkpoint, num_heads=num_heads),
+            AttentionBlock(
+                ch,
+                use_checkpoint=checkpoint_at(ds),
+                num_heads=num_heads,
+                chunk_size=attn_chunk_size,
+            ),
             ResBlock(
                 ch,
                 time_embed_dim,
                 dropout,
                 dims=dims,
-                use_checkpoint=use_checkpoint,
+                use_checkpoint=checkpoint_at(ds),
                 use_scale_shift_norm=use_scale_shift_norm,
             ),
         )
@@ -503,7 +623,7 @@ class UNetModel(nn.Module):
                         dropout,
                         out_channels=model_channels * mult,
                         dims=dims,
-                        use_checkpoint=use_checkpoint,
+                        use_checkpoint=checkpoint_at(ds),
                         use_scale_shift_norm=use_scale_shift_norm,
                     )
                 ]
@@ -512,8 +632,9 @@ class UNetModel(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
+                            use_checkpoint=checkpoint_at(ds),
                             num_heads=num_heads_upsample,
+                            chunk_size=attn_chunk_size,
                         )
                     )
                 if level and i == num_res_blocks:
@@ -534,26 +655,79 @@ class UNetModel(nn.Module):
         """
         return next(self.input_blocks.parameters()).dtype
 
-    def forward(self, x, timesteps, z=None, y=None, **kwargs):
+    def convert_to_fused(self, channels_last=True):
+        """
+        Switch the model to the fused execution mode. Every GroupNorm32 directly
+        followed by a SiLU is replaced by a GroupNormSiLU sharing its parameters
+        (so the state dict is unchanged), and the model optionally runs in the
+        channels-last memory format. The out_layers of ResBlocks using scale-shift
+        norm are kept as is since the modulation sits between the two ops.
+        :return: the model itself.
+        """
+        sequentials = [self.out]
+        for module in self.modules():
+            if isinstance(module, ResBlock):
+                sequentials.append(module.in_layers)
+                if not module.use_scale_shift_norm:
+                    sequentials.append(module.out_layers)
+
+        for layers in sequentials:
+            norm, act = layers[0], layers[1]
+            if type(norm) is GroupNorm32 and isinstance(act, nn.SiLU):
+                fused = GroupNormSiLU(
+                    norm.num_groups, norm.num_channels, eps=norm.eps, affine=norm.affine
+                )
+                fused.weight, fused.bias = norm.weight, norm.bias
+                layers[0], layers[1] = fused, nn.Identity()
+
+        if channels_last:
+            assert self.dims == 2, "channels-last is only supported for 2D models"
+            self.to(memory_format=th.channels_last)
+            self.channels_last = True
+        return self
+
+    @property
+    def memory_format(self):
+        return th.channels_last if self.channels_last else th.contiguous_format
+
+    def embed_timesteps(self, timesteps):
+        """
+        Compute the timestep embedding (before adding any conditioning).
+        :param timesteps: a 1-D batch of timesteps.
+        :return: an [N x time_embed_dim] Tensor.
+        """
+        return self.time_embed(timestep_embedding(timesteps, self.model_channels))
+
+    def embed_z(self, z):
+        """
+        Project the latent code z to the timestep embedding space.
+        """
+        assert self.proj is not None
+        return self.proj(z)
+
+    def forward(
+        self, x, timesteps, z=None, y=None, time_emb=None, z_emb=None, **kwargs
+    ):
         """
         Apply the model to an input batch.
         :param x: an [N x C x ...] Tensor of inputs.
         :param timesteps: a 1-D batch of timesteps.
         :param y: an [N] Tensor of labels, if class-conditional.
+        :param time_emb: if specified, the precomputed `embed_timesteps(timesteps)`.
+        :param z_emb: if specified, the precomputed `embed_z(z)`, used instead of z.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert (y is not None) == (
             self.num_classes is not None
         ), "must specify y if and only if the model is class-conditional"
 
-        hs = []
-        emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
+        emb = self.embed_timesteps(timesteps) if time_emb is None else time_emb
 
         # Incorporate latent code infomation (if any)
-        z_proj = None
-        if z is not None:
-            assert self.proj is not None
-            z_proj = self.proj(z)
+        z_proj = z_emb
+        if z_proj is None and z is not None:
+            z_proj = self.embed_z(z)
+        if z_proj is not None:
             assert z_proj.shape == emb.shape
             emb = emb + z_proj
 
@@ -562,13 +736,17 @@ class UNetModel(nn.Module):
             assert y.shape == (x.shape[0],)
             emb = emb + self.label_emb(y)
 
-        h = x.type(self.inner_dtype)
+        h = x.type(self.inner_dtype).contiguous(memory_format=self.memory_format)
+        hs = []
         for module in self.input_blocks:
             h = module(h, emb)
             hs.append(h)
         h = self.middle_block(h, emb)
         for module in self.output_blocks:
             cat_in = th.cat([h, hs.pop()], dim=1)
+            # Releases h (and the popped skip) before the block runs, instead of
+            # keeping them alive until the block returns
+            del h
             h = module(cat_in, emb)
         h = h.type(x.dtype)
         return self.out(h)
@@ -583,7 +761,37 @@ class SuperResModel(UNetModel):
     def __init__(self, in_channels, *args, **kwargs):
         super().__init__(in_channels * 2, *args, **kwargs)
 
-    def forward(self, x, timesteps, low_res=None, **kwargs):
+    def prepare_input(self, low_res, x_shape):
+        """
+        Preallocate the model input for a sampling run conditioned on a constant
+        low_res, with the upsampled low_res already written in its last channels.
+        :param low_res: an [N x C x h x w] Tensor of low-resolution images.
+        :param x_shape: the [N x C x H x W] shape of the noisy inputs.
+        :return: an [N x 2C x H x W] Tensor to pass as `prepared_input`.
+        """
+        n, c, new_height, new_width = x_shape
+        prepared_input = th.empty(
+            n,
+            2 * c,
+            new_height,
+            new_width,
+            dtype=low_res.dtype,
+            device=low_res.device,
+            memory_format=self.memory_format,
+        )
+        prepared_input[:, c:] = F.interpolate(
+            low_res, (new_height, new_width), mode="nearest"
+        )
+        return prepared_input
+
+    def forward(self, x, timesteps, low_res=None, prepared_input=None, **kwargs):
+        if prepared_input is not None:
+            # x is written in place, so the buffer must not be shared with a
+            # forward pass whose graph is still needed (i.e. sampling only)
+            if x.data_ptr() != prepared_input.data_ptr():
+                prepared_input[:, : x.size(1)].copy_(x)
+            return super().forward(prepared_input, timesteps, **kwargs)
+
         _, _, new_height, new_width = x.shape
 
         if low_res is not None:
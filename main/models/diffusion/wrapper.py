@@ -1,11 +1,55 @@
+from collections import OrderedDict, namedtuple
+
 import pytorch_lightning as pl
 import torch
 import torch.nn as nn
+from models.diffusion.compiled import CompiledDecoder
+from models.diffusion.noise import CounterNoise
 from models.diffusion.spaced_diff import SpacedDiffusion
 from models.diffusion.spaced_diff_form2 import SpacedDiffusionForm2
 from models.diffusion.ddpm_form2 import DDPMv2
 from util import space_timesteps
 
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "size", "maxsize"])
+
+
+class SpacedDiffusionCache:
+    """
+    A bounded LRU cache of spaced samplers keyed by
+    (n_steps, skip_strategy, formulation, sample_from).
+    :param maxsize: the maximum number of samplers to keep around.
+    """
+
+    def __init__(self, maxsize=4):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self._samplers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, build_fn):
+        if key in self._samplers:
+            self.hits += 1
+            self._samplers.move_to_end(key)
+            return self._samplers[key]
+
+        self.misses += 1
+        sampler = build_fn()
+        self._samplers[key] = sampler
+        if len(self._samplers) > self.maxsize:
+            self._samplers.popitem(last=False)
+            self.evictions += 1
+        return sampler
+
+    def clear(self):
+        self._samplers.clear()
+
+    def info(self):
+        return CacheInfo(
+            self.hits, self.misses, self.evictions, len(self._samplers), self.maxsize
+        )
+
 
 class DDPMWrapper(pl.LightningModule):
     def __init__(
@@ -30,13 +74,20 @@ class DDPMWrapper(pl.LightningModule):
         guidance_weight=0.0,
         z_cond=False,
         ddpm_latents=None,
+        spaced_cache_size=4,
+        noise_seed=0,
+        compile_decoder=None,
+        compile_cache_dir=None,
+        n_recons=1,
+        recons_chunk_size=None,
     ):
         super().__init__()
         assert loss in ["l1", "l2"]
         assert eval_mode in ["sample", "recons"]
         assert resample_strategy in ["truncated", "spaced"]
-        assert sample_method in ["ddpm", "ddim"]
-        assert skip_strategy in ["uniform", "quad"]
+        assert sample_method in ["ddpm", "ddim", "plms", "dpm_solver"]
+        assert skip_strategy in ["uniform", "quad", "trailing"]
+        assert compile_decoder in [None, "trace"]
 
         self.z_cond = z_cond
         self.online_network = online_network
@@ -61,13 +112,55 @@ class DDPMWrapper(pl.LightningModule):
         self.pred_checkpoints = pred_checkpoints
         self.temp = temp
         self.guidance_weight = guidance_weight
-        self.ddpm_latents = ddpm_latents
+        # Number of (stochastic) VAE reconstructions refined per image in the
+        # recons mode, decoded in micro-batches of recons_chunk_size latents
+        self.n_recons = n_recons
+        self.recons_chunk_size = recons_chunk_size
+        # Shared DDPM latents are registered as a (non-persistent) buffer so that
+        # they are moved to the sampling device once along with the module
+        self.register_buffer("ddpm_latents", ddpm_latents, persistent=False)
+        # Seed of the counter-based sampler noise, used when the prediction
+        # batches carry the global index of each sample
+        self.noise_seed = noise_seed
 
         # Disable automatic optimization
         self.automatic_optimization = False
 
-        # Spaced Diffusion (for spaced re-sampling)
-        self.spaced_diffusion = None
+        # Optional callable invoked with (step, x) as each prediction checkpoint
+        # is reached. When set, checkpoints are streamed instead of returned.
+        self.sample_callback = None
+
+        # Spaced Diffusion samplers (for spaced re-sampling)
+        self.spaced_cache = SpacedDiffusionCache(maxsize=spaced_cache_size)
+
+        # Optionally sample with a compiled copy of the decoder. The compiled
+        # networks are kept in a plain dict so that they are not registered as
+        # submodules (and do not show up in the state dict).
+        self.compile_decoder = compile_decoder
+        self.compile_cache_dir = compile_cache_dir
+        self._compiled_networks = {}
+
+    def _sampling_network(self):
+        sample_nw = (
+            self.target_network if self.sample_from == "target" else self.online_network
+        )
+        if self.compile_decoder is None:
+            return sample_nw
+
+        if self.sample_from not in self._compiled_networks:
+            decoder = CompiledDecoder(
+                sample_nw.decoder,
+                backend=self.compile_decoder,
+                cache_dir=self.compile_cache_dir,
+            )
+            self._compiled_networks[self.sample_from] = type(sample_nw)(
+                decoder,
+                beta_1=sample_nw.beta_1,
+                beta_2=sample_nw.beta_2,
+                T=sample_nw.T,
+                var_type=sample_nw.var_type,
+            )
+        return self._compiled_networks[self.sample_from]
 
     def forward(
         self,
@@ -77,43 +170,70 @@ class DDPMWrapper(pl.LightningModule):
         n_steps=None,
         ddpm_latents=None,
         checkpoints=[],
+        callback=None,
+        noise_fn=None,
     ):
-        sample_nw = (
-            self.target_network if self.sample_from == "target" else self.online_network
-        )
-        spaced_nw = (
-            SpacedDiffusionForm2
-            if isinstance(self.online_network, DDPMv2)
-            else SpacedDiffusion
-        )
+        sample_nw = self._sampling_network()
+        is_form2 = isinstance(self.online_network, DDPMv2)
+        spaced_nw = SpacedDiffusionForm2 if is_form2 else SpacedDiffusion
         # For spaced resampling
         if self.resample_strategy == "spaced":
             num_steps = n_steps if n_steps is not None else self.online_network.T
-            indices = space_timesteps(sample_nw.T, num_steps, type=self.skip_strategy)
-            if self.spaced_diffusion is None:
-                self.spaced_diffusion = spaced_nw(sample_nw, indices).to(x.device)
+            key = (
+                num_steps,
+                self.skip_strategy,
+                "form2" if is_form2 else "form1",
+                self.sample_from,
+            )
+            spaced_diffusion = self.spaced_cache.get(
+                key,
+                lambda: spaced_nw(
+                    sample_nw,
+                    space_timesteps(sample_nw.T, num_steps, type=self.skip_strategy),
+                ),
+            ).to(x.device)
 
             if self.sample_method == "ddim":
-                return self.spaced_diffusion.ddim_sample(
+                return spaced_diffusion.ddim_sample(
+                    x,
+                    cond=cond,
+                    z_vae=z,
+                    guidance_weight=self.guidance_weight,
+                    checkpoints=checkpoints,
+                    callback=callback,
+                    noise_fn=noise_fn,
+                )
+            if self.sample_method in ["plms", "dpm_solver"]:
+                # NOTE: These solvers are deterministic and draw no step noise
+                sample_fn = {
+                    "plms": spaced_diffusion.plms_sample,
+                    "dpm_solver": spaced_diffusion.dpm_solver_sample,
+                }[self.sample_method]
+                return sample_fn(
                     x,
                     cond=cond,
                     z_vae=z,
                     guidance_weight=self.guidance_weight,
                     checkpoints=checkpoints,
+                    callback=callback,
                 )
-            return self.spaced_diffusion(
+            return spaced_diffusion(
                 x,
                 cond=cond,
                 z_vae=z,
                 guidance_weight=self.guidance_weight,
                 checkpoints=checkpoints,
                 ddpm_latents=ddpm_latents,
+                callback=callback,
+                noise_fn=noise_fn,
             )
 
         # For truncated resampling
-        if self.sample_method == "ddim":
-            raise ValueError("DDIM is only supported for spaced sampling")
-        return sample_nw.sample(
+        if self.sample_method != "ddpm":
+            raise ValueError(
+                f"{self.sample_method} is only supported for spaced sampling"
+            )
+        return sample_nw.to(x.device).sample(
             x,
             cond=cond,
             z_vae=z,
@@ -121,29 +241,52 @@ class DDPMWrapper(pl.LightningModule):
             guidance_weight=self.guidance_weight,
             checkpoints=checkpoints,
             ddpm_latents=ddpm_latents,
+            callback=callback,
+            noise_fn=noise_fn,
         )
 
-    def training_step(self, batch, batch_idx):
-        # Optimizers
-        optim = self.optimizers()
-        lr_sched = self.lr_schedulers()
+    def spaced_cache_info(self):
+        """
+        Returns the hit/miss/eviction statistics of the spaced sampler cache.
+        """
+        return self.spaced_cache.info()
 
+    def get_train_cond(self, x, mu=None, logvar=None, recons=None):
+        """
+        Returns the VAE conditioning signal (cond, z) of a training batch, or
+        (None, None) for unconditional models. The VAE posterior (and the
+        reconstructions) are only computed if they are not given, e.g. when
+        training on a VAECacheDataset.
+        """
         cond = None
         z = None
         if self.conditional:
-            x = batch
             with torch.no_grad():
-                mu, logvar = self.vae.encode(x * 0.5 + 0.5)
-                z = self.vae.reparameterize(mu, logvar)
-                cond = self.vae.decode(z)
+                if mu is None:
+                    mu, logvar = self.vae.encode(x * 0.5 + 0.5)
+                if recons is None:
+                    z = self.vae.reparameterize(mu, logvar)
+                    cond = self.vae.decode(z)
+                else:
+                    # Cached reconstructions are decoded from the posterior mean
+                    z = mu
+                    cond = recons
                 cond = 2 * cond - 1
 
             # Set the conditioning signal based on clf-free guidance rate
             if torch.rand(1)[0] < self.cfd_rate:
                 cond = torch.zeros_like(x)
                 z = torch.zeros_like(z)
-        else:
-            x = batch
+        return cond, z
+
+    def training_step(self, batch, batch_idx):
+        # Optimizers
+        optim = self.optimizers()
+        lr_sched = self.lr_schedulers()
+
+        # Batches of a VAECacheDataset also carry the cached VAE outputs
+        x, *cached = batch if isinstance(batch, (list, tuple)) else [batch]
+        cond, z = self.get_train_cond(x, *cached)
 
         # Sample timepoints
         t = torch.randint(
@@ -180,7 +323,8 @@ class DDPMWrapper(pl.LightningModule):
                 raise ValueError(
                     "Guidance weight cannot be non-zero when using unconditional DDPM"
                 )
-            x_t = batch
+            # Counter-based latent datasets also return the sample indices
+            x_t, *indices = batch if isinstance(batch, (list, tuple)) else [batch]
             return self(
                 x_t,
                 cond=None,
@@ -188,10 +332,13 @@ class DDPMWrapper(pl.LightningModule):
                 n_steps=self.pred_steps,
                 checkpoints=self.pred_checkpoints,
                 ddpm_latents=None,
+                callback=self.sample_callback,
+                noise_fn=self._noise_fn(indices),
             )
 
+        indices = []
         if self.eval_mode == "sample":
-            x_t, z = batch
+            x_t, z, *indices = batch
             recons = self.vae(z)
             recons = 2 * recons - 1
 
@@ -200,11 +347,20 @@ class DDPMWrapper(pl.LightningModule):
 
             # Formulation-2 initial latent
             if isinstance(self.online_network, DDPMv2):
-                x_t = recons + self.temp * torch.randn_like(recons)
+                # NOTE: The (index keyed) dataset latent is reused with counter noise
+                noise = x_t if indices else self.temp * torch.randn_like(recons)
+                x_t = recons + noise
         else:
-            img = batch
-            recons = self.vae.forward_recons(img * 0.5 + 0.5)
-            recons = 2 * recons - 1
+            # Each image is repeated n_recons times (image major)
+            recons, z = self.vae.forward_recons_multi(
+                batch * 0.5 + 0.5,
+                n_samples=self.n_recons,
+                chunk_size=self.recons_chunk_size,
+                return_z=True,
+            )
+            recons = 2 * recons.flatten(0, 1) - 1
+            z = z.flatten(0, 1)
+            img = batch.repeat_interleave(self.n_recons, dim=0)
 
             # DDPM encoder
             x_t = self.online_network.compute_noisy_input(
@@ -226,10 +382,18 @@ class DDPMWrapper(pl.LightningModule):
                 n_steps=self.pred_steps,
                 checkpoints=self.pred_checkpoints,
                 ddpm_latents=self.ddpm_latents,
+                callback=self.sample_callback,
+                noise_fn=self._noise_fn(indices),
             ),
             recons,
         )
 
+    def _noise_fn(self, indices):
+        # Sampler noise keyed by the global sample index if the batch carries it
+        if not indices:
+            return None
+        return CounterNoise(self.noise_seed, indices[0])
+
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(
             self.online_network.decoder.parameters(), lr=self.lr
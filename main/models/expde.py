@@ -0,0 +1,133 @@
+import torch
+import torch.nn as nn
+from models.diffusion.noise import (
+    EXPDE_COMPONENT_STREAM,
+    Z_VAE_STREAM,
+    counter_rand,
+    counter_randn,
+)
+
+
+class GaussianMixtureSampler(nn.Module):
+    """
+    A torch sampler for the Ex-PDE Gaussian mixture fitted in `expde.py`. Component
+    selection is vectorized over the batch and each component is sampled through
+    its Cholesky factor, so float32 latents can be drawn on any device.
+    :param weights: the (K,) mixture weights.
+    :param means: the (K, D) component means.
+    :param scale_tril: the (K, D, D) lower Cholesky factors of the component
+                       covariances.
+    """
+
+    def __init__(self, weights, means, scale_tril):
+        super().__init__()
+        assert means.dim() == 2 and scale_tril.dim() == 3
+        self.register_buffer("weights", weights.float())
+        self.register_buffer("means", means.float())
+        self.register_buffer("scale_tril", scale_tril.float())
+        self.register_buffer(
+            "cum_weights", torch.cumsum(weights.double(), dim=0), persistent=False
+        )
+
+    @property
+    def n_components(self):
+        return self.means.size(0)
+
+    @property
+    def dim(self):
+        return self.means.size(1)
+
+    @classmethod
+    def from_sklearn(cls, gmm):
+        """
+        Exports a fitted sklearn GaussianMixture (of any covariance type).
+        """
+        K, D = gmm.means_.shape
+        cov = torch.from_numpy(gmm.covariances_).double()
+        if gmm.covariance_type == "tied":
+            cov = cov.expand(K, D, D)
+        elif gmm.covariance_type == "diag":
+            cov = torch.diag_embed(cov)
+        elif gmm.covariance_type == "spherical":
+            cov = cov.view(K, 1, 1) * torch.eye(D, dtype=torch.float64)
+        return cls(
+            torch.from_numpy(gmm.weights_),
+            torch.from_numpy(gmm.means_),
+            torch.linalg.cholesky(cov),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a sampler saved with `save`, or exports a joblib dumped sklearn model.
+        """
+        if path.endswith(".joblib"):
+            from joblib import load
+
+            return cls.from_sklearn(load(path))
+        state = torch.load(path, map_location="cpu")
+        return cls(state["weights"], state["means"], state["scale_tril"])
+
+    def save(self, path):
+        torch.save(
+            {
+                "weights": self.weights.cpu(),
+                "means": self.means.cpu(),
+                "scale_tril": self.scale_tril.cpu(),
+            },
+            path,
+        )
+
+    def _sample_components(self, components, eps):
+        # Groups the samples by component so that no (N, D, D) factor is gathered.
+        # Accumulating in double precision keeps the (float32) latent of a sample
+        # independent of the number of samples drawn along with it.
+        z = torch.empty_like(eps)
+        for k in range(self.n_components):
+            mask = components == k
+            if mask.any():
+                z[mask] = torch.addmm(
+                    self.means[k].double(),
+                    eps[mask].double(),
+                    self.scale_tril[k].double().t(),
+                ).to(z.dtype)
+        return z
+
+    def sample(self, n_samples, generator=None):
+        """
+        Draws n_samples latents of shape (n_samples, D) from the torch RNG.
+        :param generator: if specified, the torch.Generator to draw from. The
+            random draws are made on its device and then moved to the device of
+            the mixture.
+        """
+        device = self.means.device if generator is None else generator.device
+        components = torch.multinomial(
+            self.weights.to(device),
+            n_samples,
+            replacement=True,
+            generator=generator,
+        )
+        eps = torch.randn(n_samples, self.dim, generator=generator, device=device)
+        return self._sample_components(
+            components.to(self.means.device), eps.to(self.means.device)
+        )
+
+    def sample_indexed(self, seed, indices):
+        """
+        Draws the latents of the given global sample indices using counter-based
+        noise, so that each latent only depends on (seed, index).
+        :param indices: an int or a 1-D tensor of sample indices.
+        :return: a tensor of shape (len(indices), D), or (D,) for an int index.
+        """
+        scalar = not torch.is_tensor(indices)
+        indices = torch.as_tensor(
+            indices, dtype=torch.long, device=self.means.device
+        ).view(-1)
+        u = counter_rand(seed, indices, stream=EXPDE_COMPONENT_STREAM)
+        components = torch.searchsorted(
+            self.cum_weights, u * self.cum_weights[-1], right=True
+        )
+        components = components.clamp_(max=self.n_components - 1)
+        eps = counter_randn(seed, indices, (self.dim,), stream=Z_VAE_STREAM)
+        z = self._sample_components(components, eps)
+        return z[0] if scalar else z
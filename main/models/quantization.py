@@ -0,0 +1,130 @@
+import logging
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import (
+    DeQuantStub,
+    QuantStub,
+    convert,
+    default_dynamic_qconfig,
+    get_default_qconfig,
+    prepare,
+    quantize_dynamic,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class QuantizedConv(nn.Module):
+    """
+    Runs a convolution in (static) int8 while its inputs and outputs stay in
+    float. Only the convolutions of a model are swapped by `prepare_int8`, so
+    that normalization layers (e.g. GroupNorm), activations and the residual
+    additions keep running in float.
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        # NOTE: Quantized convolutions expect contiguous inputs
+        return self.dequant(self.conv(self.quant(x.contiguous())))
+
+
+def _wrap_convs(module, qconfig):
+    for name, child in module.named_children():
+        if isinstance(child, (nn.Conv1d, nn.Conv2d)):
+            wrapper = QuantizedConv(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_convs(child, qconfig)
+
+
+def prepare_int8(module, mode="static", backend="fbgemm"):
+    """
+    Prepares a (trained) model for post-training int8 quantization in place.
+    With mode="static", every convolution gets observers recording the range of
+    its inputs and outputs, which are calibrated by running the model on a few
+    batches before calling `convert_int8`. With mode="dynamic", there is
+    nothing to calibrate.
+    :param module: the model to quantize, e.g. a UNet or the VAE decoder.
+    :param mode: one of ['static', 'dynamic'].
+    :param backend: the quantized engine to use (e.g. 'fbgemm' on x86).
+    """
+    assert mode in ["static", "dynamic"]
+    torch.backends.quantized.engine = backend
+    module.eval()
+    if mode == "static":
+        _wrap_convs(module, get_default_qconfig(backend))
+        prepare(module, inplace=True)
+    return module
+
+
+def convert_int8(module, mode="static"):
+    """
+    Converts a model prepared with `prepare_int8` (and calibrated for
+    mode="static") to int8 in place. Linear layers are always quantized
+    dynamically as they mostly process (small) embedding batches.
+    """
+    assert mode in ["static", "dynamic"]
+    if mode == "static":
+        convert(module, inplace=True)
+    quantize_dynamic(
+        module, {nn.Linear: default_dynamic_qconfig}, dtype=torch.qint8, inplace=True
+    )
+    return module
+
+
+def quantize_int8(module, calibrate_fn=None, mode="static", backend="fbgemm"):
+    """
+    Post-training int8 quantization of a model (on CPU) in place.
+    :param calibrate_fn: a callable running the model on calibration batches.
+                         Required for mode="static".
+    """
+    prepare_int8(module, mode=mode, backend=backend)
+    if mode == "static":
+        assert calibrate_fn is not None
+        with torch.no_grad():
+            calibrate_fn()
+    return convert_int8(module, mode=mode)
+
+
+def quantize_ddpm_wrapper(ddpm_wrapper, loader, mode="static", n_batches=4):
+    """
+    Quantizes the sampling decoder of a DDPMWrapper and the decoder of its VAE
+    in place. For static quantization, both are calibrated together by sampling
+    the first n_batches batches of the prediction loader.
+    """
+    ddpm_wrapper.cpu()
+    sample_nw = (
+        ddpm_wrapper.target_network
+        if ddpm_wrapper.sample_from == "target"
+        else ddpm_wrapper.online_network
+    )
+    modules = [sample_nw.decoder]
+    if ddpm_wrapper.vae is not None:
+        modules.append(ddpm_wrapper.vae.dec)
+
+    for module in modules:
+        prepare_int8(module, mode=mode)
+
+    if mode == "static":
+        n_calib = 0
+        with torch.no_grad():
+            for batch_idx, batch in zip(range(n_batches), loader):
+                ddpm_wrapper.predict_step(batch, batch_idx)
+                n_calib += 1
+        if n_calib == 0:
+            raise ValueError(
+                "Static int8 quantization needs at least one calibration batch "
+                f"(got n_batches={n_batches} and {len(loader)} batches to sample)"
+            )
+        logger.info(f"Calibrated the int8 observers on {n_calib} batches")
+
+    for module in modules:
+        convert_int8(module, mode=mode)
+    return ddpm_wrapper
@@ -1,3 +1,5 @@
+import contextlib
+
 import pytorch_lightning as pl
 import torch
 import torch.nn as nn
@@ -102,6 +104,100 @@ class ResBlock(nn.Module):
         return out
 
 
+@torch.jit.script
+def bias_gelu(x, bias):
+    # Bias addition followed by the (exact) GELU in a single fused kernel
+    x = x + bias.view(1, -1, 1, 1)
+    return x * 0.5 * (1.0 + torch.erf(x * 0.7071067811865476))
+
+
+@torch.jit.script
+def bias_residual(x, bias, residual):
+    return residual + x + bias.view(1, -1, 1, 1)
+
+
+class FusedResBlock(nn.Module):
+    """
+    Inference version of a ResBlock sharing its convolutions (so the state dict
+    is unchanged). On GPU, the convolutions run without bias and each bias is
+    added in a fused kernel along with the following GELU (or the residual
+    connection), which halves the number of elementwise passes over the
+    activations. On CPU, where the TorchScript fuser does not generate kernels,
+    the biases are added by the convolutions as in the ResBlock.
+    """
+
+    def __init__(self, block):
+        super().__init__()
+        self.down_rate = block.down_rate
+        self.residual = block.residual
+        self.c1, self.c2, self.c3, self.c4 = block.c1, block.c2, block.c3, block.c4
+
+    def forward(self, x):
+        xhat = F.gelu(x)
+        if x.is_cuda:
+            for c in [self.c1, self.c2, self.c3]:
+                xhat = bias_gelu(
+                    F.conv2d(xhat, c.weight, None, c.stride, c.padding), c.bias
+                )
+            c = self.c4
+            xhat = F.conv2d(xhat, c.weight, None, c.stride, c.padding)
+            out = (
+                bias_residual(xhat, c.bias, x)
+                if self.residual
+                else xhat + c.bias.view(1, -1, 1, 1)
+            )
+        else:
+            for c in [self.c1, self.c2, self.c3]:
+                xhat = F.gelu(c(xhat))
+            xhat = self.c4(xhat)
+            out = x + xhat if self.residual else xhat
+        if self.down_rate is not None:
+            out = F.avg_pool2d(out, kernel_size=self.down_rate, stride=self.down_rate)
+        return out
+
+
+class UpsampleConv2d(nn.Conv2d):
+    """
+    A nearest neighbour upsampling followed by a 1x1 convolution as a single op.
+    As both commute, the convolution is applied before upsampling, i.e. at
+    1 / scale_factor**2 of the cost. Shares the parameters of the convolution.
+    """
+
+    def __init__(self, conv, scale_factor):
+        assert conv.kernel_size == (1, 1) and conv.groups == 1
+        super().__init__(
+            conv.in_channels, conv.out_channels, 1, bias=conv.bias is not None
+        )
+        self.weight, self.bias = conv.weight, conv.bias
+        self.scale_factor = scale_factor
+
+    def forward(self, input):
+        out = super().forward(input)
+        return F.interpolate(out, scale_factor=self.scale_factor, mode="nearest")
+
+
+def fuse_blocks(blocks):
+    """
+    Converts a sequence of VAE blocks to their fused inference versions in place.
+    Every ResBlock is replaced by a FusedResBlock, and every nearest neighbour
+    Upsample directly followed by a 1x1 (transition) convolution by an
+    UpsampleConv2d. The parameters (and the state dict) are unchanged.
+    """
+    for i, block in enumerate(blocks):
+        if isinstance(block, ResBlock):
+            blocks[i] = FusedResBlock(block)
+        elif (
+            isinstance(block, nn.Upsample)
+            and block.mode == "nearest"
+            and i + 1 < len(blocks)
+            and type(blocks[i + 1]) is nn.Conv2d
+            and blocks[i + 1].kernel_size == (1, 1)
+        ):
+            blocks[i + 1] = UpsampleConv2d(blocks[i + 1], block.scale_factor)
+            blocks[i] = nn.Identity()
+    return blocks
+
+
 class Encoder(nn.Module):
     def __init__(self, block_config_str, channel_config_str):
         super().__init__()
@@ -137,6 +233,14 @@ class Encoder(nn.Module):
         self.mu = nn.Conv2d(channel_config[1], channel_config[1], 1, bias=False)
         self.logvar = nn.Conv2d(channel_config[1], channel_config[1], 1, bias=False)
 
+    def convert_to_fused(self):
+        """
+        Switch the encoder to the fused inference mode (see `fuse_blocks`).
+        :return: the encoder itself.
+        """
+        fuse_blocks(self.block_mod)
+        return self
+
     def forward(self, input):
         x = self.in_conv(input)
         x = self.block_mod(x)
@@ -178,6 +282,14 @@ class Decoder(nn.Module):
         self.block_mod = nn.Sequential(*blocks)
         self.last_conv = nn.Conv2d(channel_config[input_res], 3, 3, stride=1, padding=1)
 
+    def convert_to_fused(self):
+        """
+        Switch the decoder to the fused inference mode (see `fuse_blocks`).
+        :return: the decoder itself.
+        """
+        fuse_blocks(self.block_mod)
+        return self
+
     def forward(self, input):
         x = self.block_mod(input)
         x = self.last_conv(x)
@@ -196,6 +308,7 @@ class VAE(pl.LightningModule):
         dec_channel_str,
         alpha=1.0,
         lr=1e-4,
+        bf16=False,
     ):
         super().__init__()
         self.save_hyperparameters()
@@ -207,12 +320,28 @@ class VAE(pl.LightningModule):
         self.alpha = alpha
         self.lr = lr
 
+        # Whether to run the training forward pass in bfloat16 autocast. Unlike
+        # fp16 (Lightning precision=16), this needs no gradient scaling as bf16
+        # has the exponent range of float32
+        self.bf16 = bf16
+        self.recons_criterion = nn.MSELoss(reduction="sum")
+
         # Encoder architecture
         self.enc = Encoder(self.enc_block_str, self.enc_channel_str)
 
         # Decoder Architecture
         self.dec = Decoder(self.input_res, self.dec_block_str, self.dec_channel_str)
 
+    def convert_to_fused(self):
+        """
+        Switch the encoder and the decoder to the fused inference mode. The
+        state dict is unchanged.
+        :return: the model itself.
+        """
+        self.enc.convert_to_fused()
+        self.dec.convert_to_fused()
+        return self
+
     def encode(self, x):
         mu, logvar = self.enc(x)
         return mu, logvar
@@ -240,27 +369,73 @@ class VAE(pl.LightningModule):
         decoder_out = self.decode(z)
         return decoder_out
 
-    def training_step(self, batch, batch_idx):
-        x = batch
-
-        # Encoder
+    def forward_recons_multi(self, x, n_samples=1, chunk_size=None, return_z=False):
+        """
+        Generates n_samples stochastic reconstructions of each image, encoding
+        the batch only once. The reparameterized latents of all images are
+        decoded together, in micro-batches of chunk_size latents.
+        :param x: the (B, C, H, W) input images.
+        :param n_samples: the number of reconstructions K per image.
+        :param chunk_size: the maximum number of latents decoded at once. If
+                           None, all B * K latents are decoded in one call.
+        :param return_z: whether to also return the sampled latents.
+        :return: the (B, K, C, H, W) reconstructions (and (B, K, ...) latents).
+        """
         mu, logvar = self.encode(x)
-
-        # Reparameterization Trick
+        B = mu.size(0)
+        mu = mu.repeat_interleave(n_samples, dim=0)
+        logvar = logvar.repeat_interleave(n_samples, dim=0)
         z = self.reparameterize(mu, logvar)
 
-        # Decoder
-        decoder_out = self.decode(z)
+        chunk_size = z.size(0) if chunk_size is None else chunk_size
+        decoder_out = torch.cat(
+            [self.decode(z_chunk) for z_chunk in z.split(chunk_size, dim=0)], dim=0
+        )
+        decoder_out = decoder_out.view(B, n_samples, *decoder_out.shape[1:])
+        if return_z:
+            return decoder_out, z.view(B, n_samples, *z.shape[1:])
+        return decoder_out
 
-        # Compute loss
-        mse_loss = nn.MSELoss(reduction="sum")
-        recons_loss = mse_loss(decoder_out, x)
-        kl_loss = self.compute_kl(mu, logvar)
-        self.log("Recons Loss", recons_loss, prog_bar=True)
-        self.log("Kl Loss", kl_loss, prog_bar=True)
+    def compute_loss(self, x):
+        """
+        The training losses of a batch, i.e. the forward pass of training_step
+        without the logging (so it can also run outside of a Trainer).
+        :return: the total, reconstruction and KL losses, summed over the batch.
+        """
+        # NOTE: A disabled autocast region would also disable the (fp16)
+        # autocast of Lightning, hence the null context
+        autocast = (
+            torch.autocast(x.device.type, dtype=torch.bfloat16)
+            if self.bf16
+            else contextlib.nullcontext()
+        )
+        with autocast:
+            # Encoder
+            mu, logvar = self.encode(x)
+
+            # Reparameterization Trick
+            z = self.reparameterize(mu, logvar)
+
+            # Decoder
+            decoder_out = self.decode(z)
 
+        # Compute loss
+        # NOTE: The summed losses are accumulated in float32 as they easily
+        # overflow in half precision
+        recons_loss = self.recons_criterion(decoder_out.float(), x.float())
+        kl_loss = self.compute_kl(mu.float(), logvar.float())
         total_loss = recons_loss + self.alpha * kl_loss
-        self.log("Total Loss", total_loss)
+        return total_loss, recons_loss, kl_loss
+
+    def training_step(self, batch, batch_idx):
+        x = batch
+        total_loss, recons_loss, kl_loss = self.compute_loss(x)
+
+        # Log the losses per pixel so they are comparable across configs
+        n_pixels = x.numel()
+        self.log("Recons Loss", recons_loss / n_pixels, prog_bar=True)
+        self.log("Kl Loss", kl_loss / n_pixels, prog_bar=True)
+        self.log("Total Loss", total_loss / n_pixels)
         return total_loss
 
     def configure_optimizers(self):
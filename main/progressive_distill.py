@@ -0,0 +1,113 @@
+import copy
+import logging
+import os
+
+import hydra
+import pytorch_lightning as pl
+from omegaconf import OmegaConf
+from pytorch_lightning.utilities.seed import seed_everything
+
+from models.diffusion import DDPMWrapper, ProgressiveDistillWrapper
+from models.vae import VAE
+from train_ddpm import build_ddpm, get_train_loader, get_trainer_kwargs
+from util import get_ddpm_train_dataset
+
+logger = logging.getLogger(__name__)
+
+
+def __parse_str(s):
+    split = s.split(",")
+    return [int(s) for s in split if s != "" and s is not None]
+
+
+@hydra.main(config_path="configs")
+def progressive_distill(config):
+    # Get config and setup
+    config = config.dataset.ddpm
+    logger.info(OmegaConf.to_yaml(config))
+
+    # Set seed
+    seed_everything(config.training.seed, workers=True)
+
+    # Dataset
+    image_size = config.data.image_size
+    dataset = get_ddpm_train_dataset(config)
+
+    vae = VAE.load_from_checkpoint(
+        config.training.vae_chkpt_path,
+        input_res=image_size,
+    )
+    vae.eval()
+
+    for p in vae.parameters():
+        p.requires_grad = False
+
+    # Load the teacher (the student of a stage has the same architecture)
+    ddpm_type = config.training.type
+    teacher_wrapper = DDPMWrapper.load_from_checkpoint(
+        config.progressive.teacher_chkpt_path,
+        online_network=build_ddpm(config),
+        target_network=build_ddpm(config),
+        vae=vae,
+        conditional=False if ddpm_type == "uncond" else True,
+        strict=True,
+    )
+    teacher_ddpm = teacher_wrapper.target_network
+    checkpoint_resolutions = __parse_str(config.model.checkpoint_resolutions)
+
+    results_dir = config.training.results_dir
+    n_steps = config.progressive.start_steps // 2
+    while n_steps >= config.progressive.end_steps:
+        logger.info(f"Distilling {2 * n_steps} sampling steps into {n_steps}")
+
+        # The student (and its EMA copy) are initialized from the teacher
+        online_ddpm = build_ddpm(config, use_checkpoint=checkpoint_resolutions)
+        online_ddpm.load_state_dict(teacher_ddpm.state_dict())
+        target_ddpm = build_ddpm(config, decoder=copy.deepcopy(online_ddpm.decoder))
+        for p in target_ddpm.parameters():
+            p.requires_grad = False
+
+        ddpm_wrapper = ProgressiveDistillWrapper(
+            teacher_ddpm,
+            online_ddpm,
+            target_ddpm,
+            vae,
+            lr=config.training.lr,
+            cfd_rate=config.training.cfd_rate,
+            n_anneal_steps=config.training.n_anneal_steps,
+            loss=config.training.loss,
+            conditional=False if ddpm_type == "uncond" else True,
+            grad_clip_val=config.training.grad_clip,
+            z_cond=config.training.z_cond,
+            n_steps=n_steps,
+        )
+
+        # Trainer
+        train_kwargs, loader_kws = get_trainer_kwargs(config)
+        train_kwargs["max_steps"] = config.progressive.n_iters
+        train_kwargs["checkpoint_callback"] = False
+
+        # Loader
+        loader = get_train_loader(config, dataset, **loader_kws)
+
+        logger.info(f"Running Trainer with kwargs: {train_kwargs}")
+        trainer = pl.Trainer(**train_kwargs)
+        trainer.fit(ddpm_wrapper, train_dataloader=loader)
+
+        # Checkpoint the stage. It can be sampled from with the DDPM eval scripts
+        # (with skip_strategy='trailing', sample_method='ddim' and n_steps=n_steps)
+        trainer.save_checkpoint(
+            os.path.join(
+                results_dir,
+                "checkpoints",
+                f"ddpmv2-progressive-{config.training.chkpt_prefix}-steps={n_steps}.ckpt",
+            )
+        )
+
+        # The student is the teacher of the next stage
+        teacher_ddpm = target_ddpm if config.training.use_ema else online_ddpm
+        n_steps //= 2
+
+
+if __name__ == "__main__":
+    progressive_distill()
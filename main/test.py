@@ -77,6 +77,8 @@ def compare_interpolations(
 @click.option("--num-samples", default=-1)
 @click.option("--save-path", default=os.getcwd())
 @click.option("--write-mode", default="image", type=click.Choice(["numpy", "image"]))
+@click.option("--n-recons", default=1, help="Reconstructions per image")
+@click.option("--chunk-size", default=0, help="Max latents per decoder call")
 def reconstruct(
     chkpt_path,
     root,
@@ -86,6 +88,8 @@ def reconstruct(
     num_samples=-1,
     save_path=os.getcwd(),
     write_mode="image",
+    n_recons=1,
+    chunk_size=0,
 ):
     dev, _ = configure_device(device)
     if num_samples == 0:
@@ -112,11 +116,14 @@ def reconstruct(
     for _, batch in tqdm(enumerate(loader)):
         batch = batch.to(dev)
         with torch.no_grad():
-            recons = vae.forward_recons(batch)
+            # (B, K, C, H, W) reconstructions from a single encoder pass
+            recons = vae.forward_recons_multi(
+                batch, n_samples=n_recons, chunk_size=chunk_size or None
+            )
 
         if count + recons.size(0) >= num_samples and num_samples != -1:
-            img_list.append(batch[:num_samples, :, :, :].cpu())
-            sample_list.append(recons[:num_samples, :, :, :].cpu())
+            img_list.append(batch[: num_samples - count].cpu())
+            sample_list.append(recons[: num_samples - count].cpu())
             break
 
         # Not transferring to CPU leads to memory overflow in GPU!
@@ -131,11 +138,14 @@ def reconstruct(
     os.makedirs(save_path, exist_ok=True)
 
     if write_mode == "image":
-        save_as_images(
-            cat_sample,
-            file_name=os.path.join(save_path, "vae"),
-            denorm=False,
-        )
+        for k in range(n_recons):
+            save_as_images(
+                cat_sample[:, k],
+                file_name=os.path.join(
+                    save_path, "vae" if n_recons == 1 else f"vae_{k}"
+                ),
+                denorm=False,
+            )
         save_as_images(
             cat_img,
             file_name=os.path.join(save_path, "orig"),
@@ -143,7 +153,16 @@ def reconstruct(
         )
     else:
         np.save(os.path.join(save_path, "images.npy"), cat_img.numpy())
-        np.save(os.path.join(save_path, "recons.npy"), cat_sample.numpy())
+        np.save(
+            os.path.join(save_path, "recons.npy"),
+            cat_sample.squeeze(1).numpy() if n_recons == 1 else cat_sample.numpy(),
+        )
+        if n_recons > 1:
+            # Per-pixel variance of the reconstructions of each image
+            np.save(
+                os.path.join(save_path, "recons_var.npy"),
+                cat_sample.var(dim=1).numpy(),
+            )
 
 
 @cli.command()
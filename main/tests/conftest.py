@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+import torch
+import torch.nn as nn
+
+# The modules under main/ import each other relative to main/ (see train_ddpm.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.diffusion import UNetModel  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def tiny_unet():
+    """
+    Factory of small (eval mode) UNetModels or SuperResModels with 32 channels at
+    two resolution levels, for 8x8 or 16x16 inputs.
+    """
+
+    def make(decoder_cls=UNetModel, seed=0, **kwargs):
+        torch.manual_seed(seed)
+        kwargs = {
+            "in_channels": 3,
+            "model_channels": 32,
+            "out_channels": 3,
+            "num_res_blocks": 1,
+            "attention_resolutions": (2,),
+            "channel_mult": (1, 2),
+            **kwargs,
+        }
+        model = decoder_cls(**kwargs)
+        # Re-initialize the zero-initialized output convs so that the outputs
+        # are not trivial
+        for module in model.modules():
+            if isinstance(module, (nn.Conv1d, nn.Conv2d)) and not module.weight.any():
+                module.reset_parameters()
+        return model.eval()
+
+    return make
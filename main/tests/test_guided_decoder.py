@@ -0,0 +1,82 @@
+import pytest
+import torch
+
+from models.diffusion import SuperResModel, UNetModel
+from models.diffusion.sampling import GuidedDecoder
+
+
+def decoder_inputs():
+    generator = torch.Generator().manual_seed(1)
+    x = torch.randn(2, 3, 16, 16, generator=generator)
+    cond = torch.rand(2, 3, 8, 8, generator=generator) * 2 - 1
+    z = torch.randn(2, 16, generator=generator)
+    return x, cond, z
+
+
+@pytest.mark.parametrize("decoder_cls", [UNetModel, SuperResModel])
+@pytest.mark.parametrize("guidance_weight", [0.0, 0.5])
+@pytest.mark.parametrize("precompute_time_emb", [False, True])
+def test_guided_decoder_matches_direct_calls(
+    tiny_unet, decoder_cls, guidance_weight, precompute_time_emb
+):
+    decoder = tiny_unet(decoder_cls, z_dim=16, use_z=True, use_scale_shift_norm=True)
+    x, cond, z = decoder_inputs()
+    if decoder_cls is UNetModel:
+        cond = None
+    t = torch.tensor([3, 700])
+    timesteps = torch.tensor([3, 50, 700]) if precompute_time_emb else None
+
+    def direct(cond, z):
+        kwargs = {"z": z}
+        if cond is not None:
+            kwargs["low_res"] = cond
+        return decoder(x, t, **kwargs)
+
+    with torch.no_grad():
+        eps_fn = GuidedDecoder(
+            decoder,
+            cond=cond,
+            z_vae=z,
+            guidance_weight=guidance_weight,
+            timesteps=timesteps,
+        )
+        # The second call reuses the cached embeddings (and input buffer)
+        out = eps_fn(x, t)
+        out_again = eps_fn(x, t)
+
+        expected = direct(cond, z)
+        if guidance_weight != 0:
+            uncond = None if cond is None else torch.zeros_like(cond)
+            eps_uncond = direct(uncond, torch.zeros_like(z))
+            expected = (1 + guidance_weight) * expected - guidance_weight * eps_uncond
+
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(out_again, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_prepared_input_matches_low_res(tiny_unet):
+    decoder = tiny_unet(SuperResModel, z_dim=16, use_z=True, use_scale_shift_norm=True)
+    x, cond, z = decoder_inputs()
+    t = torch.tensor([3, 700])
+
+    with torch.no_grad():
+        prepared_input = decoder.prepare_input(cond, x.shape)
+        torch.testing.assert_close(
+            decoder(x, t, prepared_input=prepared_input, z=z),
+            decoder(x, t, low_res=cond, z=z),
+        )
+
+        # Reusing the buffer for a new x_t only overwrites the image channels
+        x_next = torch.randn_like(x)
+        torch.testing.assert_close(
+            decoder(x_next, t, prepared_input=prepared_input, z=z),
+            decoder(x_next, t, low_res=cond, z=z),
+        )
+
+        # x_t may also be written into the buffer in place
+        x_view = prepared_input[:, : x.size(1)]
+        x_view.copy_(x)
+        torch.testing.assert_close(
+            decoder(x_view, t, prepared_input=prepared_input, z=z),
+            decoder(x, t, low_res=cond, z=z),
+        )
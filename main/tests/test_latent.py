@@ -0,0 +1,32 @@
+import pytest
+import torch
+
+from datasets.latent import LatentDataset, UncondLatentDataset
+
+
+@pytest.mark.parametrize("share_ddpm_latent", [False, True])
+def test_lazy_latents_match_eager(share_ddpm_latent):
+    sizes = dict(z_vae_size=(300, 16, 1, 1), z_ddpm_size=(300, 3, 8, 8))
+    eager = LatentDataset(
+        **sizes, share_ddpm_latent=share_ddpm_latent, counter_noise=True, seed=3
+    )
+    lazy = LatentDataset(
+        **sizes, share_ddpm_latent=share_ddpm_latent, lazy=True, seed=3
+    )
+    assert len(lazy) == len(eager)
+    # Indices on both sides of the chunks the eager latents are generated in
+    for idx in [0, 1, 255, 256, 299]:
+        z_ddpm, z_vae, i = lazy[idx]
+        z_ddpm_eager, z_vae_eager, i_eager = eager[idx]
+        assert i == i_eager == idx
+        assert torch.equal(z_ddpm, z_ddpm_eager)
+        assert torch.equal(z_vae, z_vae_eager)
+
+
+def test_lazy_uncond_latents_match_eager():
+    eager = UncondLatentDataset((300, 3, 8, 8), counter_noise=True, seed=3)
+    lazy = UncondLatentDataset((300, 3, 8, 8), lazy=True, seed=3)
+    for idx in [0, 255, 256, 299]:
+        z_ddpm, i = lazy[idx]
+        assert i == idx
+        assert torch.equal(z_ddpm, eager[idx][0])
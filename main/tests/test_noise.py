@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from models.diffusion.noise import CounterNoise, counter_randn
+
+
+@pytest.mark.parametrize("shape", [(3, 4, 4), (3, 3, 3)])
+def test_counter_noise_independent_of_partition(shape):
+    n, seed, step = 10, 5, 3
+    x = torch.empty(n, *shape)
+    expected = CounterNoise(seed, torch.arange(n))(step, x)
+
+    # Contiguous batches of different sizes
+    batches = [torch.arange(0, 3), torch.arange(3, 4), torch.arange(4, n)]
+    out = torch.cat([CounterNoise(seed, idx)(step, x[: len(idx)]) for idx in batches])
+    assert torch.equal(out, expected)
+
+    # Strided shards (as with 2 processes), processed in reverse order
+    out = torch.empty_like(expected)
+    for idx in [torch.arange(1, n, 2), torch.arange(0, n, 2)]:
+        out[idx] = CounterNoise(seed, idx)(step, x[: len(idx)])
+    assert torch.equal(out, expected)
+
+    # A single sample drawn on its own
+    assert torch.equal(counter_randn(seed, 7, shape, step=step), expected[7])
+
+
+def test_counter_noise_keys():
+    x = torch.empty(4, 3, 8, 8)
+    noise = CounterNoise(0, torch.arange(4))(0, x)
+    assert not torch.equal(noise, CounterNoise(0, torch.arange(4))(1, x))
+    assert not torch.equal(noise, CounterNoise(1, torch.arange(4))(0, x))
+    assert not torch.equal(noise[1:], noise[:-1])
+    assert abs(noise.mean().item()) < 0.1
+    assert abs(noise.std().item() - 1) < 0.1
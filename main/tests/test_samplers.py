@@ -0,0 +1,80 @@
+import pytest
+import torch
+
+from models.diffusion import (
+    DDPM,
+    DDPMv2,
+    SpacedDiffusion,
+    SpacedDiffusionForm2,
+    SuperResModel,
+    UNetModel,
+)
+from models.diffusion.sampling import (
+    ddim_sample_loop,
+    dpm_solver_sample_loop,
+    get_sampler_plan,
+    plms_sample_loop,
+)
+from util import space_timesteps
+
+T = 100
+
+
+@pytest.fixture(scope="module", params=["form1", "form2"])
+def setup(request, tiny_unet):
+    if request.param == "form1":
+        decoder = tiny_unet(UNetModel)
+        ddpm_cls, spaced_cls, cond = DDPM, SpacedDiffusion, None
+    else:
+        decoder = tiny_unet(SuperResModel)
+        ddpm_cls, spaced_cls = DDPMv2, SpacedDiffusionForm2
+        cond = torch.rand(2, 3, 8, 8, generator=torch.Generator().manual_seed(1))
+        cond = cond * 2 - 1
+
+    # A small (but non-zero) timestep embedding keeps eps smooth enough in t for
+    # the solvers to converge on coarse grids, while still depending on t
+    torch.nn.init.normal_(decoder.time_embed[-1].weight, std=0.02)
+    diffusion = ddpm_cls(decoder, beta_2=0.2, T=T)
+
+    x_t = torch.randn(2, 3, 8, 8, generator=torch.Generator().manual_seed(2))
+    if cond is not None:
+        x_t = x_t + cond
+    return diffusion, spaced_cls, cond, x_t
+
+
+def run_sampler(loop, setup, n_steps):
+    diffusion, spaced_cls, cond, x_t = setup
+    spaced = spaced_cls(diffusion, space_timesteps(T, n_steps))
+    plan = get_sampler_plan(spaced)
+    eps_fn = spaced._eps_fn(cond, timesteps=plan.timesteps)
+    x_hat = cond if spaced_cls is SpacedDiffusionForm2 else None
+    # Clipping the x_0 predictions makes DDIM and DPM-Solver++ integrate
+    # slightly different ODEs, so it is disabled here
+    with torch.no_grad():
+        samples = loop(plan, eps_fn, x_t.clone(), x_hat=x_hat, clip_denoised=False)
+    return samples[str(n_steps)]
+
+
+@pytest.mark.parametrize("loop", [plms_sample_loop, dpm_solver_sample_loop])
+def test_agrees_with_ddim(loop, setup):
+    gaps = [
+        (run_sampler(loop, setup, n) - run_sampler(ddim_sample_loop, setup, n))
+        .abs()
+        .max()
+        .item()
+        for n in (10, 25, 100)
+    ]
+    # Both discretize the same ODE, so they agree more closely on finer grids
+    assert gaps[2] < gaps[0]
+    scale = run_sampler(ddim_sample_loop, setup, T).abs().max().item()
+    assert gaps[2] < 0.2 * scale
+
+
+@pytest.mark.parametrize("loop", [plms_sample_loop, dpm_solver_sample_loop])
+def test_converges(loop, setup):
+    reference = run_sampler(loop, setup, T)
+    errors = [
+        (run_sampler(loop, setup, n) - reference).abs().max().item()
+        for n in (10, 25, 50)
+    ]
+    assert errors[2] < errors[0]
@@ -0,0 +1,99 @@
+import copy
+
+import pytest
+import torch
+
+from models.diffusion import SuperResModel, UNetModel
+from models.diffusion.unet_openai import AttentionBlock, GroupNormSiLU, QKVAttention
+
+
+@pytest.mark.parametrize("use_scale_shift_norm", [False, True])
+@pytest.mark.parametrize("grad", [False, True])
+def test_fused_matches_unfused(tiny_unet, use_scale_shift_norm, grad):
+    model = tiny_unet(
+        z_dim=16, use_z=use_scale_shift_norm, use_scale_shift_norm=use_scale_shift_norm
+    )
+    fused = copy.deepcopy(model).convert_to_fused(channels_last=True)
+    assert any(isinstance(m, GroupNormSiLU) for m in fused.modules())
+
+    x = torch.randn(2, 3, 16, 16)
+    t = torch.tensor([3, 700])
+    z = torch.randn(2, 16) if use_scale_shift_norm else None
+    with torch.set_grad_enabled(grad):
+        expected = model(x, t, z=z)
+        out = fused(x, t, z=z)
+    assert out.is_contiguous(memory_format=torch.channels_last)
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_fused_superres_matches_unfused(tiny_unet):
+    model = tiny_unet(SuperResModel)
+    fused = copy.deepcopy(model).convert_to_fused(channels_last=True)
+    x, low_res = torch.randn(2, 3, 16, 16), torch.randn(2, 3, 8, 8)
+    t = torch.tensor([10, 20])
+    with torch.no_grad():
+        expected = model(x, t, low_res=low_res)
+        out = fused(x, t, low_res=low_res)
+        prepared = fused(x, t, prepared_input=fused.prepare_input(low_res, x.shape))
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(prepared, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_fused_keeps_state_dict(tiny_unet):
+    model = tiny_unet()
+    fused = copy.deepcopy(model).convert_to_fused(channels_last=True)
+    assert fused.state_dict().keys() == model.state_dict().keys()
+    fused.load_state_dict(model.state_dict())
+
+
+@pytest.mark.parametrize("length,chunk_size", [(50, 16), (64, 16), (50, 64)])
+def test_chunked_attention_matches_dense(length, chunk_size):
+    torch.manual_seed(0)
+    qkv = torch.randn(4, 3 * 8, length, requires_grad=True)
+    dense_qkv = qkv.detach().clone().requires_grad_(True)
+
+    out = QKVAttention(chunk_size=chunk_size)(qkv)
+    expected = QKVAttention()(dense_qkv)
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+
+    # The chunked path also runs under autograd (e.g. during training)
+    grad = torch.randn_like(out)
+    out.backward(grad)
+    expected.backward(grad)
+    torch.testing.assert_close(qkv.grad, dense_qkv.grad, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("chunk_size", [16, 24, 256])
+def test_chunked_attention_block_matches_dense(chunk_size):
+    torch.manual_seed(0)
+    block = AttentionBlock(32, num_heads=2)
+    torch.nn.init.normal_(block.proj_out.weight, std=0.1)
+    chunked = AttentionBlock(32, num_heads=2, chunk_size=chunk_size)
+    chunked.load_state_dict(block.state_dict())
+
+    x = torch.randn(2, 32, 10, 10)
+    x_chunked = x.clone().requires_grad_(True)
+    x.requires_grad_(True)
+    out, expected = chunked(x_chunked), block(x)
+    torch.testing.assert_close(out, expected, rtol=1e-4, atol=1e-5)
+
+    out.square().sum().backward()
+    expected.square().sum().backward()
+    torch.testing.assert_close(x_chunked.grad, x.grad, rtol=1e-4, atol=1e-4)
+    for p, p_expected in zip(chunked.parameters(), block.parameters()):
+        torch.testing.assert_close(p.grad, p_expected.grad, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("use_checkpoint", [(1,), (2,), True])
+def test_checkpointing_matches_gradients(tiny_unet, use_checkpoint):
+    # With dropout, the recomputed forward passes must draw the same masks
+    model = tiny_unet(dropout=0.3).train()
+    checkpointed = tiny_unet(dropout=0.3, use_checkpoint=use_checkpoint).train()
+    checkpointed.load_state_dict(model.state_dict())
+
+    x, t = torch.randn(2, 3, 16, 16), torch.tensor([3, 700])
+    for m in [model, checkpointed]:
+        torch.manual_seed(1)
+        m(x, t).square().mean().backward()
+    for (name, p), p_ckpt in zip(model.named_parameters(), checkpointed.parameters()):
+        torch.testing.assert_close(p_ckpt.grad, p.grad, msg=name)
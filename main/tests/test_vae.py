@@ -0,0 +1,58 @@
+import copy
+
+import pytest
+import torch
+
+from models.vae import VAE, FusedResBlock, UpsampleConv2d
+
+devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+
+
+def tiny_vae():
+    torch.manual_seed(0)
+    vae = VAE(
+        input_res=8,
+        enc_block_str="8x1,8d2,8t4,4x1,4d4,4t1,1x1",
+        dec_block_str="1x1,1u4,1t4,4x1,4u2,4t8,8x1",
+        enc_channel_str="8:64,4:32,1:32",
+        dec_channel_str="8:64,4:32,1:32",
+    )
+    # The convolution biases are zero-initialized, randomize them so that the
+    # fused bias additions are exercised
+    with torch.no_grad():
+        for name, p in vae.named_parameters():
+            if name.endswith("bias"):
+                p.normal_(0, 0.1)
+    return vae.eval()
+
+
+@pytest.mark.parametrize("device", devices)
+def test_fused_matches_unfused(device):
+    vae = tiny_vae().to(device)
+    fused = copy.deepcopy(vae).convert_to_fused()
+    assert any(isinstance(m, FusedResBlock) for m in fused.enc.modules())
+    assert any(isinstance(m, FusedResBlock) for m in fused.dec.modules())
+    assert any(isinstance(m, UpsampleConv2d) for m in fused.dec.modules())
+
+    x = torch.rand(4, 3, 8, 8, device=device)
+    with torch.no_grad():
+        mu, logvar = vae.encode(x)
+        fused_mu, fused_logvar = fused.encode(x)
+        torch.testing.assert_close(fused_mu, mu, rtol=1e-4, atol=1e-5)
+        torch.testing.assert_close(fused_logvar, logvar, rtol=1e-4, atol=1e-5)
+
+        z = torch.randn_like(mu)
+        torch.testing.assert_close(
+            fused.decode(z), vae.decode(z), rtol=1e-4, atol=1e-5
+        )
+
+
+def test_fused_keeps_state_dict():
+    vae = tiny_vae()
+    fused = copy.deepcopy(vae).convert_to_fused()
+    assert fused.state_dict().keys() == vae.state_dict().keys()
+
+    # Checkpoints load in both directions
+    fused.load_state_dict(vae.state_dict())
+    unfused = tiny_vae()
+    unfused.load_state_dict(fused.state_dict())
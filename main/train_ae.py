@@ -35,6 +35,8 @@ def train(config):
     batch_size = min(N, batch_size)
 
     # Model
+    if config.training.fp16 and config.training.bf16:
+        raise ValueError("Only one of fp16 and bf16 training can be enabled")
     vae = VAE(
         input_res=image_size,
         enc_block_str=config.model.enc_block_config,
@@ -43,6 +45,7 @@ def train(config):
         dec_channel_str=config.model.dec_channel_config,
         lr=config.training.lr,
         alpha=config.training.alpha,
+        bf16=config.training.bf16,
     )
 
     # Trainer
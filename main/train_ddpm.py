@@ -12,7 +12,7 @@ from torch.utils.data import DataLoader
 from models.callbacks import EMAWeightUpdate
 from models.diffusion import DDPM, DDPMv2, DDPMWrapper, SuperResModel, UNetModel
 from models.vae import VAE
-from util import configure_device, get_dataset
+from util import configure_device, get_ddpm_train_dataset
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +22,98 @@ def __parse_str(s):
     return [int(s) for s in split if s != "" and s is not None]
 
 
+def build_ddpm(
+    config,
+    dim=None,
+    n_residual=None,
+    dim_mults=None,
+    use_checkpoint=False,
+    decoder=None,
+):
+    """
+    Builds the DDPM (and its decoder) of a DDPM config. The width, depth and
+    channel multipliers of the decoder default to those of the model section.
+    :param decoder: if specified, the decoder to wrap instead of building one.
+    """
+    ddpm_type = config.training.type
+    ddpm_cls = DDPMv2 if ddpm_type == "form2" else DDPM
+    if decoder is not None:
+        return ddpm_cls(
+            decoder,
+            beta_1=config.model.beta1,
+            beta_2=config.model.beta2,
+            T=config.model.n_timesteps,
+        )
+
+    # Use the superres model for conditional training
+    decoder_cls = UNetModel if ddpm_type == "uncond" else SuperResModel
+    decoder = decoder_cls(
+        in_channels=config.data.n_channels,
+        model_channels=config.model.dim if dim is None else dim,
+        out_channels=3,
+        num_res_blocks=config.model.n_residual if n_residual is None else n_residual,
+        attention_resolutions=__parse_str(config.model.attn_resolutions),
+        channel_mult=__parse_str(
+            config.model.dim_mults if dim_mults is None else dim_mults
+        ),
+        use_checkpoint=use_checkpoint,
+        dropout=config.model.dropout,
+        num_heads=config.model.n_heads,
+        attn_chunk_size=config.model.attn_chunk_size,
+        z_dim=config.training.z_dim,
+        use_scale_shift_norm=config.training.z_cond,
+        use_z=config.training.z_cond,
+    )
+    return build_ddpm(config, decoder=decoder)
+
+
+def get_trainer_kwargs(config):
+    """
+    Returns the Trainer kwargs (logging, EMA, devices and precision) and the
+    extra DataLoader kwargs shared by the DDPM training scripts.
+    """
+    train_kwargs = {}
+    train_kwargs["default_root_dir"] = config.training.results_dir
+    train_kwargs["log_every_n_steps"] = config.training.log_step
+    train_kwargs["callbacks"] = []
+
+    if config.training.use_ema:
+        ema_callback = EMAWeightUpdate(tau=config.training.ema_decay)
+        train_kwargs["callbacks"].append(ema_callback)
+
+    device = config.training.device
+    loader_kws = {}
+    if device.startswith("gpu"):
+        _, devs = configure_device(device)
+        train_kwargs["gpus"] = devs
+
+        # Disable find_unused_parameters when using DDP training for performance reasons
+        from pytorch_lightning.plugins import DDPPlugin
+
+        train_kwargs["plugins"] = DDPPlugin(find_unused_parameters=False)
+        loader_kws["persistent_workers"] = True
+    elif device == "tpu":
+        train_kwargs["tpu_cores"] = 8
+
+    # Half precision training
+    if config.training.fp16:
+        train_kwargs["precision"] = 16
+    return train_kwargs, loader_kws
+
+
+def get_train_loader(config, dataset, **loader_kws):
+    batch_size = min(len(dataset), config.training.batch_size)
+    return DataLoader(
+        dataset,
+        batch_size,
+        num_workers=config.training.workers,
+        pin_memory=True,
+        shuffle=True,
+        drop_last=True,
+        **loader_kws,
+    )
+
+
 @hydra.main(config_path="configs")
 def train(config):
     # Get config and setup
@@ -32,57 +124,20 @@ def train(config):
     seed_everything(config.training.seed, workers=True)
 
     # Dataset
-    root = config.data.root
-    d_type = config.data.name
     image_size = config.data.image_size
-    dataset = get_dataset(
-        d_type, root, image_size, norm=config.data.norm, flip=config.data.hflip
-    )
-    N = len(dataset)
-    batch_size = config.training.batch_size
-    batch_size = min(N, batch_size)
+    dataset = get_ddpm_train_dataset(config)
 
     # Model
-    lr = config.training.lr
-    attn_resolutions = __parse_str(config.model.attn_resolutions)
-    dim_mults = __parse_str(config.model.dim_mults)
     ddpm_type = config.training.type
-
-    # Use the superres model for conditional training
-    decoder_cls = UNetModel if ddpm_type == "uncond" else SuperResModel
-    decoder = decoder_cls(
-        in_channels=config.data.n_channels,
-        model_channels=config.model.dim,
-        out_channels=3,
-        num_res_blocks=config.model.n_residual,
-        attention_resolutions=attn_resolutions,
-        channel_mult=dim_mults,
-        use_checkpoint=False,
-        dropout=config.model.dropout,
-        num_heads=config.model.n_heads,
-        z_dim=config.training.z_dim,
-        use_scale_shift_norm=config.training.z_cond,
-        use_z=config.training.z_cond,
+    online_ddpm = build_ddpm(
+        config, use_checkpoint=__parse_str(config.model.checkpoint_resolutions)
     )
 
     # EMA parameters are non-trainable
-    ema_decoder = copy.deepcopy(decoder)
-    for p in ema_decoder.parameters():
+    target_ddpm = build_ddpm(config, decoder=copy.deepcopy(online_ddpm.decoder))
+    for p in target_ddpm.parameters():
         p.requires_grad = False
 
-    ddpm_cls = DDPMv2 if ddpm_type == "form2" else DDPM
-    online_ddpm = ddpm_cls(
-        decoder,
-        beta_1=config.model.beta1,
-        beta_2=config.model.beta2,
-        T=config.model.n_timesteps,
-    )
-    target_ddpm = ddpm_cls(
-        ema_decoder,
-        beta_1=config.model.beta1,
-        beta_2=config.model.beta2,
-        T=config.model.n_timesteps,
-    )
     vae = VAE.load_from_checkpoint(
         config.training.vae_chkpt_path,
         input_res=image_size,
@@ -92,15 +147,15 @@ def train(config):
     for p in vae.parameters():
         p.requires_grad = False
 
-    assert isinstance(online_ddpm, ddpm_cls)
-    assert isinstance(target_ddpm, ddpm_cls)
-    logger.info(f"Using DDPM with type: {ddpm_cls} and data norm: {config.data.norm}")
+    logger.info(
+        f"Using DDPM with type: {type(online_ddpm)} and data norm: {config.data.norm}"
+    )
 
     ddpm_wrapper = DDPMWrapper(
         online_ddpm,
         target_ddpm,
         vae,
-        lr=lr,
+        lr=config.training.lr,
         cfd_rate=config.training.cfd_rate,
         n_anneal_steps=config.training.n_anneal_steps,
         loss=config.training.loss,
@@ -110,58 +165,24 @@ def train(config):
     )
 
     # Trainer
-    train_kwargs = {}
+    train_kwargs, loader_kws = get_trainer_kwargs(config)
     restore_path = config.training.restore_path
     if restore_path != "":
         # Restore checkpoint
         train_kwargs["resume_from_checkpoint"] = restore_path
 
     # Setup callbacks
-    results_dir = config.training.results_dir
     chkpt_callback = ModelCheckpoint(
-        dirpath=os.path.join(results_dir, "checkpoints"),
+        dirpath=os.path.join(config.training.results_dir, "checkpoints"),
         filename=f"ddpmv2-{config.training.chkpt_prefix}" + "-{epoch:02d}-{loss:.4f}",
         every_n_epochs=config.training.chkpt_interval,
         save_on_train_epoch_end=True,
     )
-
-    train_kwargs["default_root_dir"] = results_dir
     train_kwargs["max_epochs"] = config.training.epochs
-    train_kwargs["log_every_n_steps"] = config.training.log_step
-    train_kwargs["callbacks"] = [chkpt_callback]
-
-    if config.training.use_ema:
-        ema_callback = EMAWeightUpdate(tau=config.training.ema_decay)
-        train_kwargs["callbacks"].append(ema_callback)
-
-    device = config.training.device
-    loader_kws = {}
-    if device.startswith("gpu"):
-        _, devs = configure_device(device)
-        train_kwargs["gpus"] = devs
-
-        # Disable find_unused_parameters when using DDP training for performance reasons
-        from pytorch_lightning.plugins import DDPPlugin, DDPSpawnPlugin
-
-        train_kwargs["plugins"] = DDPPlugin(find_unused_parameters=False)
-        loader_kws["persistent_workers"] = True
-    elif device == "tpu":
-        train_kwargs["tpu_cores"] = 8
-
-    # Half precision training
-    if config.training.fp16:
-        train_kwargs["precision"] = 16
+    train_kwargs["callbacks"].insert(0, chkpt_callback)
 
     # Loader
-    loader = DataLoader(
-        dataset,
-        batch_size,
-        num_workers=config.training.workers,
-        pin_memory=True,
-        shuffle=True,
-        drop_last=True,
-        **loader_kws,
-    )
+    loader = get_train_loader(config, dataset, **loader_kws)
 
     # Gradient Clipping by global norm (0 value indicates no clipping) (as in Ho et al.)
     # train_kwargs["gradient_clip_val"] = config.training.grad_clip
@@ -14,6 +14,7 @@ from datasets import (
     CIFAR10Dataset,
     FFHQDataset,
 )
+from datasets.vae_cache import VAECacheDataset
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +33,17 @@ def configure_device(device):
     return device
 
 
+def get_device(device):
+    """
+    Returns the torch.device of a device string as accepted by configure_device,
+    which only returns a (device, ids) pair for GPUs.
+    """
+    if device.startswith("gpu"):
+        dev, _ = configure_device(device)
+        return torch.device(dev)
+    return torch.device(device)
+
+
 def space_timesteps(num_timesteps, desired_count, type="uniform"):
     """
     Create a list of timesteps to use from an original diffusion process,
@@ -52,6 +64,13 @@ def space_timesteps(num_timesteps, desired_count, type="uniform"):
         seq = np.linspace(0, np.sqrt(num_timesteps * 0.8), desired_count) ** 2
         seq = [int(s) for s in list(seq)]
         return seq
+    elif type == "trailing":
+        # Evenly spaced timesteps ending at the last step of the process. Unlike
+        # uniform spacing, the grid of desired_count steps is a subset of the grid
+        # of 2 * desired_count steps (see ProgressiveDistillWrapper).
+        seq = num_timesteps - num_timesteps * np.arange(desired_count) / desired_count
+        seq = [int(s) - 1 for s in np.round(seq)]
+        return sorted(seq)
     else:
         raise NotImplementedError
 
@@ -93,6 +112,30 @@ def get_dataset(name, root, image_size, norm=True, flip=False, **kwargs):
     return dataset
 
 
+def get_ddpm_train_dataset(config):
+    """
+    Returns the training dataset of a DDPM config. If training.vae_cache_path is
+    set, the images are paired with their cached VAE outputs (see VAECacheDataset).
+    """
+    dataset = get_dataset(
+        config.data.name,
+        config.data.root,
+        config.data.image_size,
+        norm=config.data.norm,
+        flip=config.data.hflip,
+    )
+    if config.training.vae_cache_path != "":
+        # Read the VAE outputs of each image from the cache instead
+        if config.data.hflip:
+            raise ValueError("The VAE cache cannot be used with random flips")
+        dataset = VAECacheDataset(
+            dataset,
+            config.training.vae_cache_path,
+            use_recons=config.training.vae_cache_recons,
+        )
+    return dataset
+
+
 def plot_interpolations(interpolations, save_path=None, figsize=(10, 5)):
     N = len(interpolations)
     # Plot all the quantities
@@ -0,0 +1,91 @@
+# # CIFAR-10 (Form-1): Distill a trained DDPM into a narrower and shallower student UNet
+# python main/distill_ddpm.py +dataset=cifar10/train \
+#                      dataset.ddpm.data.root=\'/data1/kushagrap20/datasets/\' \
+#                      dataset.ddpm.data.name='cifar10' \
+#                      dataset.ddpm.data.norm=True \
+#                      dataset.ddpm.data.hflip=True \
+#                      dataset.ddpm.model.dim=128 \
+#                      dataset.ddpm.model.dropout=0.3 \
+#                      dataset.ddpm.model.attn_resolutions=\'16,\' \
+#                      dataset.ddpm.model.n_residual=2 \
+#                      dataset.ddpm.model.dim_mults=\'1,2,2,2\' \
+#                      dataset.ddpm.model.n_heads=8 \
+#                      dataset.ddpm.distill.teacher_chkpt_path=\'/data1/kushagrap20/checkpoints/cifar10/ddpmv2-cifar10_rework_form1_28thJuly_sota_nheads=8_dropout=0.3-epoch=2500-loss=0.0192.ckpt\' \
+#                      dataset.ddpm.distill.dim=64 \
+#                      dataset.ddpm.distill.n_residual=1 \
+#                      dataset.ddpm.distill.dim_mults=\'1,2,2,2\' \
+#                      dataset.ddpm.training.type='form1' \
+#                      dataset.ddpm.training.epochs=500 \
+#                      dataset.ddpm.training.z_cond=False \
+#                      dataset.ddpm.training.batch_size=32 \
+#                      dataset.ddpm.training.vae_chkpt_path=\'/data1/kushagrap20/checkpoints/cifar10/vae-cifar10-epoch=500-train_loss=0.00.ckpt\' \
+#                      dataset.ddpm.training.device=\'gpu:0\' \
+#                      dataset.ddpm.training.results_dir=\'/data1/kushagrap20/diffusevae_cifar10_distill_form1_dim=64_nres=1/\' \
+#                      dataset.ddpm.training.workers=1 \
+#                      dataset.ddpm.training.chkpt_prefix=\'cifar10_distill_form1_dim=64_nres=1\'
+
+# # The student checkpoint is sampled from with the usual eval scripts, with the
+# # model section set to the student architecture
+# python main/eval/ddpm/sample_cond.py +dataset=cifar10/test \
+#                         dataset.ddpm.data.norm=True \
+#                         dataset.ddpm.model.attn_resolutions=\'16,\' \
+#                         dataset.ddpm.model.dropout=0.3 \
+#                         dataset.ddpm.model.dim=64 \
+#                         dataset.ddpm.model.n_residual=1 \
+#                         dataset.ddpm.model.dim_mults=\'1,2,2,2\' \
+#                         dataset.ddpm.model.n_heads=8 \
+#                         dataset.ddpm.evaluation.chkpt_path=\'/data1/kushagrap20/diffusevae_cifar10_distill_form1_dim=64_nres=1/checkpoints/ddpmv2-distill-cifar10_distill_form1_dim=64_nres=1-epoch=499-loss=0.0010.ckpt\' \
+#                         dataset.ddpm.evaluation.type='form1' \
+#                         dataset.ddpm.evaluation.resample_strategy='spaced' \
+#                         dataset.ddpm.evaluation.sample_method='ddim' \
+#                         dataset.ddpm.evaluation.sample_from='target' \
+#                         dataset.ddpm.evaluation.batch_size=64 \
+#                         dataset.ddpm.evaluation.device=\'gpu:0\' \
+#                         dataset.ddpm.evaluation.save_path=\'/data1/kushagrap20/ddpm_cifar10_distill/student/\' \
+#                         dataset.ddpm.evaluation.n_samples=10000 \
+#                         dataset.ddpm.evaluation.n_steps=100 \
+#                         dataset.vae.evaluation.chkpt_path=\'/data1/kushagrap20/checkpoints/cifar10/vae-cifar10-epoch=500-train_loss=0.00.ckpt\'
+
+# # FID of the student next to the teacher (sampled with the same settings and the teacher model section)
+# fidelity --gpu 0 --fid --input1 /data1/kushagrap20/ddpm_cifar10_distill/teacher/100/images/ --input2 cifar10-train
+# fidelity --gpu 0 --fid --input1 /data1/kushagrap20/ddpm_cifar10_distill/student/100/images/ --input2 cifar10-train
+
+# # Decoder throughput of the student next to the teacher
+# python main/benchmark.py decoder-throughput --image-size 32 --dim-mults 1,2,2,2 --attn-resolutions 16, \
+#                         --dim 128 --n-residual 2 --student-dim 64 --student-n-residual 1
+
+# # CIFAR-10 (Form-1): Progressive step distillation from 512 down to 4 (trailing DDIM) sampling steps
+# python main/progressive_distill.py +dataset=cifar10/train \
+#                      dataset.ddpm.data.root=\'/data1/kushagrap20/datasets/\' \
+#                      dataset.ddpm.data.name='cifar10' \
+#                      dataset.ddpm.data.norm=True \
+#                      dataset.ddpm.data.hflip=True \
+#                      dataset.ddpm.model.dim=128 \
+#                      dataset.ddpm.model.dropout=0.3 \
+#                      dataset.ddpm.model.attn_resolutions=\'16,\' \
+#                      dataset.ddpm.model.n_residual=2 \
+#                      dataset.ddpm.model.dim_mults=\'1,2,2,2\' \
+#                      dataset.ddpm.model.n_heads=8 \
+#                      dataset.ddpm.progressive.teacher_chkpt_path=\'/data1/kushagrap20/checkpoints/cifar10/ddpmv2-cifar10_rework_form1_28thJuly_sota_nheads=8_dropout=0.3-epoch=2500-loss=0.0192.ckpt\' \
+#                      dataset.ddpm.progressive.start_steps=512 \
+#                      dataset.ddpm.progressive.end_steps=4 \
+#                      dataset.ddpm.progressive.n_iters=50000 \
+#                      dataset.ddpm.training.type='form1' \
+#                      dataset.ddpm.training.z_cond=False \
+#                      dataset.ddpm.training.batch_size=128 \
+#                      dataset.ddpm.training.lr=1e-4 \
+#                      dataset.ddpm.training.vae_chkpt_path=\'/data1/kushagrap20/checkpoints/cifar10/vae-cifar10-epoch=500-train_loss=0.00.ckpt\' \
+#                      dataset.ddpm.training.device=\'gpu:0\' \
+#                      dataset.ddpm.training.results_dir=\'/data1/kushagrap20/diffusevae_cifar10_progressive_form1/\' \
+#                      dataset.ddpm.training.workers=1 \
+#                      dataset.ddpm.training.chkpt_prefix=\'cifar10_progressive_form1\'
+
+# # Each stage is sampled from with the usual eval scripts using its number of steps and trailing DDIM
+# python main/eval/ddpm/sample_cond.py +dataset=cifar10/test \
+#                         dataset.ddpm.evaluation.chkpt_path=\'/data1/kushagrap20/diffusevae_cifar10_progressive_form1/checkpoints/ddpmv2-progressive-cifar10_progressive_form1-steps=8.ckpt\' \
+#                         dataset.ddpm.evaluation.type='form1' \
+#                         dataset.ddpm.evaluation.resample_strategy='spaced' \
+#                         dataset.ddpm.evaluation.skip_strategy='trailing' \
+#                         dataset.ddpm.evaluation.sample_method='ddim' \
+#                         dataset.ddpm.evaluation.n_steps=8 \
+#                         dataset.ddpm.evaluation.save_path=\'/data1/kushagrap20/ddpm_cifar10_progressive/steps=8/\'
@@ -5,6 +5,28 @@
 #                                 '/data1/kushagrap20/vae-celebahq256_alpha=1.0_Jan31-epoch=499-train_loss=0.0000.ckpt' \
 #                                 ~/datasets/celeba_hq/
 
+# # FFHQ-128 on 2 GPUs (one process per GPU, rerun the same commands to resume after a crash)
+# python main/extract_latents.py extract --device gpu:0 --n-procs 2 --proc-id 0 \
+#                                 --dataset-name ffhq \
+#                                 --image-size 128 \
+#                                 --batch-size 128 \
+#                                 --workers 4 \
+#                                 --shard-size 10000 \
+#                                 --save-posterior \
+#                                 --save-path ~/ffhq128_latents/ \
+#                                 '/data1/kushagrap20/vae_ffhq128_11thJune_alpha=1.0/checkpoints/vae-ffhq128_11thJune_alpha=1.0-epoch=496-train_loss=0.0000.ckpt' \
+#                                 ~/datasets/ffhq/ &
+# python main/extract_latents.py extract --device gpu:1 --n-procs 2 --proc-id 1 \
+#                                 --dataset-name ffhq \
+#                                 --image-size 128 \
+#                                 --batch-size 128 \
+#                                 --workers 4 \
+#                                 --shard-size 10000 \
+#                                 --save-posterior \
+#                                 --save-path ~/ffhq128_latents/ \
+#                                 '/data1/kushagrap20/vae_ffhq128_11thJune_alpha=1.0/checkpoints/vae-ffhq128_11thJune_alpha=1.0-epoch=496-train_loss=0.0000.ckpt' \
+#                                 ~/datasets/ffhq/
+
 # Fit GMM CMHQ-128
 # python main/expde.py fit-gmm ~/cmhq128_latents/latents_celebamaskhq.npy --save-path '/data1/kushagrap20/cmhq128_latents/gmm_z/' --n-components 150
 
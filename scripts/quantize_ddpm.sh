@@ -0,0 +1,31 @@
+# # CIFAR-10 (Form-1): Sample on CPU with static int8 DDPM and VAE decoders (calibrated on the first batches)
+# python main/eval/ddpm/sample_cond.py +dataset=cifar10/test \
+#                         dataset.ddpm.data.norm=True \
+#                         dataset.ddpm.model.attn_resolutions=\'16,\' \
+#                         dataset.ddpm.model.dropout=0.3 \
+#                         dataset.ddpm.model.n_residual=2 \
+#                         dataset.ddpm.model.dim_mults=\'1,2,2,2\' \
+#                         dataset.ddpm.model.n_heads=8 \
+#                         dataset.ddpm.evaluation.chkpt_path=\'/data1/kushagrap20/checkpoints/cifar10/ddpmv2-cifar10_rework_form1_28thJuly_sota_nheads=8_dropout=0.3-epoch=2500-loss=0.0192.ckpt\' \
+#                         dataset.ddpm.evaluation.type='form1' \
+#                         dataset.ddpm.evaluation.resample_strategy='spaced' \
+#                         dataset.ddpm.evaluation.sample_method='ddim' \
+#                         dataset.ddpm.evaluation.device=\'cpu\' \
+#                         dataset.ddpm.evaluation.counter_noise=True \
+#                         dataset.ddpm.evaluation.quantize='static' \
+#                         dataset.ddpm.evaluation.n_calib_batches=4 \
+#                         dataset.ddpm.evaluation.batch_size=64 \
+#                         dataset.ddpm.evaluation.save_path=\'/data1/kushagrap20/ddpm_cifar10_int8/static/\' \
+#                         dataset.ddpm.evaluation.n_samples=10000 \
+#                         dataset.ddpm.evaluation.n_steps=100 \
+#                         dataset.vae.evaluation.chkpt_path=\'/data1/kushagrap20/checkpoints/cifar10/vae-cifar10-epoch=500-train_loss=0.00.ckpt\'
+
+# # FID drift: the same command with dataset.ddpm.evaluation.quantize='' gives the float32 samples. With
+# # counter_noise=True, the latents and the sampler noise only depend on the seed and the sample index (and not on
+# # the global RNG consumed by calibration), so the int8 samples can be compared with them directly
+# fidelity --gpu 0 --fid --input1 /data1/kushagrap20/ddpm_cifar10_int8/static/100/images/ --input2 /data1/kushagrap20/ddpm_cifar10_int8/float32/100/images/
+# fidelity --gpu 0 --fid --input1 /data1/kushagrap20/ddpm_cifar10_int8/static/100/images/ --input2 cifar10-train
+# fidelity --gpu 0 --fid --input1 /data1/kushagrap20/ddpm_cifar10_int8/float32/100/images/ --input2 cifar10-train
+
+# # CPU latency of the DDPM and VAE decoders in float32 and int8
+# python main/benchmark.py int8-latency --image-size 32 --batch-size 64 --dim-mults 1,2,2,2 --attn-resolutions 16, --n-heads 8
@@ -6,6 +6,17 @@
 #                                 ~/vae_celeba64_alpha\=1.0/checkpoints/vae-celeba64_alpha\=1.0-epoch\=245-train_loss\=0.0000.ckpt \
 #                                 ~/datasets/img_align_celeba/
 
+# # 16 stochastic reconstructions per image (one encoder pass, decoded in micro-batches of 256 latents)
+# python main/test.py reconstruct --device gpu:0 \
+#                                 --dataset celeba \
+#                                 --image-size 64 \
+#                                 --n-recons 16 \
+#                                 --chunk-size 256 \
+#                                 --save-path ~/vae_celeba64_recons_k=16/ \
+#                                 --write-mode numpy \
+#                                 ~/vae_celeba64_alpha\=1.0/checkpoints/vae-celeba64_alpha\=1.0-epoch\=245-train_loss\=0.0000.ckpt \
+#                                 ~/datasets/img_align_celeba/
+
 # python main/test.py reconstruct --device gpu:0 \
 #                                 --dataset ffhq \
 #                                 --image-size 128 \
@@ -194,3 +194,6 @@ python main/eval/ddpm/sample_cond.py +dataset=cifar10/test \
 #                         dataset.ddpm.evaluation.workers=1 \
 #                         dataset.vae.evaluation.chkpt_path=\'/data1/kushagrap20/vae-celebahq256_alpha=1.0_Jan31-epoch=499-train_loss=0.0000.ckpt\'
 #                         dataset.vae.evaluation.expde_model_path=\'/data1/kushagrap20/celebahq_latents/gmm_z/gmm_100.joblib\'
+
+# # Latency and numerical parity of the fused VAE (enabled in the eval scripts with dataset.ddpm.evaluation.fused_vae=True)
+# python main/benchmark.py vae-fused --image-size 256 --batch-size 8 --device cuda
@@ -49,4 +49,21 @@
 #                      dataset.vae.training.results_dir=\'/data1/kushagrap20/vae_celeba64_alpha=1.0/\' \
 #                      dataset.vae.training.workers=4 \
 #                      dataset.vae.training.chkpt_prefix=\'celeba64_alpha=1.0\' \
-#                      dataset.vae.training.alpha=1.0
\ No newline at end of file
+#                      dataset.vae.training.alpha=1.0
+# # CelebA-HQ 256 training in bf16
+# python main/train_ae.py +dataset=celebahq/train \
+#                      dataset.vae.data.root='/data1/kushagrap20/datasets/celeba_hq/' \
+#                      dataset.vae.data.name='celebahq' \
+#                      dataset.vae.data.hflip=True \
+#                      dataset.vae.training.bf16=True \
+#                      dataset.vae.training.batch_size=16 \
+#                      dataset.vae.training.log_step=50 \
+#                      dataset.vae.training.epochs=300 \
+#                      dataset.vae.training.device=\'gpu:0\' \
+#                      dataset.vae.training.results_dir=\'/data1/kushagrap20/vae_celebahq256_bf16_alpha=1.0/\' \
+#                      dataset.vae.training.workers=2 \
+#                      dataset.vae.training.chkpt_prefix=\'celebahq256_bf16_alpha=1.0\' \
+#                      dataset.vae.training.alpha=1.0
+
+# # Step time, peak memory and loss of float32, fp16 and bf16 VAE training on the CelebA-HQ 256 config
+# python main/benchmark.py vae-precision --config-path main/configs/dataset/celebahq/train.yaml --n-steps 20
@@ -90,4 +90,21 @@
 #                      dataset.ddpm.training.device=\'tpu\' \
 #                      dataset.ddpm.training.results_dir=\'/data1/kushagrap20/diffusevae_chq256_rework_form1_10thJuly_sota_nheads=8_dropout=0.1/\' \
 #                      dataset.ddpm.training.workers=1 \
-#                      dataset.ddpm.training.chkpt_prefix=\'chq256_rework_form1_10thJuly_sota_nheads=8_dropout=0.1\'
\ No newline at end of file
+#                      dataset.ddpm.training.chkpt_prefix=\'chq256_rework_form1_10thJuly_sota_nheads=8_dropout=0.1\'
+
+# # CIFAR-10 (Form-1) with a precomputed VAE cache (no random flips, the VAE is not run during training)
+# python main/extract_latents.py cache-vae \'/data1/kushagrap20/checkpoints/cifar10/vae-cifar10-epoch=500-train_loss=0.00.ckpt\' \
+#                      \'/data1/kushagrap20/datasets/\' --dataset-name cifar10 --image-size 32 \
+#                      --save-path \'/data1/kushagrap20/vae_cache/cifar10/\' --save-recons
+# python main/train_ddpm.py +dataset=cifar10/train \
+#                      dataset.ddpm.data.root=\'/data1/kushagrap20/datasets/\' \
+#                      dataset.ddpm.data.name='cifar10' \
+#                      dataset.ddpm.data.norm=True \
+#                      dataset.ddpm.data.hflip=False \
+#                      dataset.ddpm.training.type='form1' \
+#                      dataset.ddpm.training.vae_chkpt_path=\'/data1/kushagrap20/checkpoints/cifar10/vae-cifar10-epoch=500-train_loss=0.00.ckpt\' \
+#                      dataset.ddpm.training.vae_cache_path=\'/data1/kushagrap20/vae_cache/cifar10/\' \
+#                      dataset.ddpm.training.vae_cache_recons=True \
+#                      dataset.ddpm.training.device=\'gpu:0\' \
+#                      dataset.ddpm.training.results_dir=\'/data1/kushagrap20/diffusevae_cifar10_vae_cache_form1/\' \
+#                      dataset.ddpm.training.chkpt_prefix=\'cifar10_vae_cache_form1\'